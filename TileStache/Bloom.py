@@ -0,0 +1,132 @@
+""" Compact probabilistic membership filters for cache tiers.
+
+A Bloom filter answers "is this key in the set?" with either "definitely not"
+or "maybe", using a fixed number of bits per key. The Multi cache uses one per
+tier to skip tiers that definitely do not have a tile, which saves a full miss
+round-trip on slow remote storage such as S3.
+
+Keys can't be taken back out of a plain Bloom filter, so removing a tile from
+a tier leaves its key in place. This only costs an occasional wasted read, and
+rebuilding the filter from a listing of the tier clears out old keys.
+
+Filters are saved to a small binary file: a 16 byte header with the magic
+string "TSBF", the number of bits and the number of hash functions, followed
+by the bits themselves.
+"""
+from os import write, close, rename, unlink
+from os.path import dirname, exists
+from tempfile import mkstemp
+from threading import Lock
+from struct import pack, unpack, calcsize
+from hashlib import md5
+from binascii import hexlify, unhexlify
+from math import ceil, log
+
+_header = '<4sQI'
+
+def tile_key(layer_name, coord, format):
+    """ Return a filter key string for a tile.
+    """
+    tile = '%(zoom)d/%(column)d/%(row)d' % coord.__dict__
+    return str('%s/%s.%s' % (layer_name, tile, format.lower()))
+
+class BloomFilter:
+    """ Fixed-size Bloom filter of string keys.
+
+        Constructor arguments:
+        - capacity: expected number of keys.
+        - error_rate: acceptable rate of false "maybe" answers at capacity.
+    """
+    def __init__(self, capacity=1000000, error_rate=0.01, size=None, hashes=None):
+        if size is None:
+            size = int(ceil(-capacity * log(error_rate) / log(2) ** 2))
+
+        if hashes is None:
+            hashes = int(round(float(size) / capacity * log(2)))
+
+        self.size = max(8, size)
+        self.hashes = max(1, hashes)
+        self.bits = bytearray((self.size + 7) / 8)
+        self._lock = Lock()
+
+    def _offsets(self, key):
+        """ Generate bit offsets for a key using double hashing.
+        """
+        h1, h2 = unpack('<QQ', md5(key).digest())
+
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, key):
+        """ Add a key to the filter.
+        """
+        with self._lock:
+            for offset in self._offsets(key):
+                self.bits[offset >> 3] |= 1 << (offset & 7)
+
+    def __contains__(self, key):
+        """ Return false if the key is definitely not in the filter.
+        """
+        for offset in self._offsets(key):
+            if not self.bits[offset >> 3] & (1 << (offset & 7)):
+                return False
+
+        return True
+
+    def clear(self):
+        """ Remove all keys from the filter.
+        """
+        with self._lock:
+            self.bits = bytearray(len(self.bits))
+
+    def update(self, other):
+        """ Add every key of another filter with the same size to this one.
+        """
+        if (other.size, other.hashes) != (self.size, self.hashes):
+            raise ValueError('Filters of different sizes cannot be merged')
+
+        with self._lock:
+            # or the bits together as two big numbers, much faster than by byte.
+            bits = long(hexlify(self.bits) or '0', 16) | long(hexlify(other.bits) or '0', 16)
+            self.bits = bytearray(unhexlify('%0*x' % (len(self.bits) * 2, bits)))
+
+    def save(self, path):
+        """ Write the filter to a file, atomically replacing any old one.
+        """
+        with self._lock:
+            data = pack(_header, 'TSBF', self.size, self.hashes) + str(self.bits)
+
+        handle, tmp_path = mkstemp(dir=dirname(path) or '.', suffix='.bloom')
+
+        try:
+            write(handle, data)
+            close(handle)
+            rename(tmp_path, path)
+        except:
+            if exists(tmp_path):
+                unlink(tmp_path)
+            raise
+
+def load(path):
+    """ Load a filter from a file written by BloomFilter.save().
+
+        Returns None if the file is missing or does not look like a filter.
+    """
+    if not exists(path):
+        return None
+
+    data = open(path, 'rb').read()
+    offset = calcsize(_header)
+
+    if len(data) < offset:
+        return None
+
+    magic, size, hashes = unpack(_header, data[:offset])
+
+    if magic != 'TSBF' or len(data) - offset != (size + 7) / 8:
+        return None
+
+    bloom = BloomFilter(size=size, hashes=hashes)
+    bloom.bits = bytearray(data[offset:])
+
+    return bloom
@@ -7,9 +7,11 @@ own and pull them into TileStache dynamically by class name.
 Built-in providers:
 - test
 - disk
+- memory
 - multi
 - memcache
 - s3
+- inventory
 
 Example built-in cache, for JSON configuration file:
 
@@ -44,20 +46,38 @@ The save() method accepts an additional argument before the others:
 
 - body: raw content to save to the cache.
 
+A cache may also provide a removeTiles() method for removing a whole range of
+tiles at once, used by tilestache-clean.py through removeTiles() below.
+
 TODO: add stale_lock_timeout and cache_lifespan to cache API in v2.
 """
 
 import os
 import sys
 import time
+import errno
 import gzip
+import shutil
+import atexit
+import logging
+
+from threading import Thread, Lock, Condition
+from weakref import ref, WeakSet
+from multiprocessing.pool import ThreadPool
+from Queue import Queue, Empty, Full
+from collections import OrderedDict
 
 from tempfile import mkstemp
-from os.path import isdir, exists, dirname, basename, join as pathjoin
+from os.path import isdir, exists, dirname, basename, relpath, join as pathjoin
+
+from ModestMaps.Core import Coordinate
 
 from .Core import KnownUnknown
 from . import Memcache
+from . import Bloom
 from . import S3
+from . import Inventory
+from .Generations import split_cache_name
 
 def getCacheByName(name):
     """ Retrieve a cache object by name.
@@ -70,6 +90,9 @@ def getCacheByName(name):
     elif name.lower() == 'disk':
         return Disk
 
+    elif name.lower() == 'memory':
+        return Memory
+
     elif name.lower() == 'multi':
         return Multi
 
@@ -79,8 +102,102 @@ def getCacheByName(name):
     elif name.lower() == 's3':
         return S3.Cache
 
+    elif name.lower() == 'inventory':
+        return Inventory.Cache
+
     raise Exception('Unknown cache name: "%s"' % name)
 
+def removeTiles(cache, layer, format, zoom, row1, column1, row2, column2):
+    """ Remove cached tiles in a range of rows and columns at one zoom level.
+    
+        Uses the cache's own removeTiles() method with the same arguments for
+        bulk removal where it has one, and removes tiles one by one otherwise.
+    """
+    if hasattr(cache, 'removeTiles'):
+        return cache.removeTiles(layer, format, zoom, row1, column1, row2, column2)
+    
+    for row in range(row1, row2 + 1):
+        for column in range(column1, column2 + 1):
+            cache.remove(layer, Coordinate(row, column, zoom), format)
+
+def _rmdir(dirpath):
+    """ Remove a directory if it's empty.
+    """
+    try:
+        os.rmdir(dirpath)
+    except OSError, e:
+        if e.errno not in (errno.ENOTEMPTY, errno.ENOENT, errno.ENOTDIR):
+            raise
+
+# Multi caches with filters to save at exit, forgotten as they're discarded.
+_filtered_multis = WeakSet()
+
+def _saveMultiFilters():
+    """ Save the filters of every Multi cache still around, at exit.
+    """
+    for multi in list(_filtered_multis):
+        try:
+            multi.saveFilters()
+        except:
+            logging.exception('TileStache.Caches._saveMultiFilters() failed to save filters')
+
+atexit.register(_saveMultiFilters)
+
+def _workFilters(multi_ref):
+    """ Build the missing filters of a Multi cache, then save them now and then.
+
+        Holds only a weak reference between rounds, and stops once
+        the cache is discarded.
+    """
+    multi = multi_ref()
+
+    if multi is None:
+        return
+
+    indexes = [index for (index, bloom) in enumerate(multi.filters)
+               if bloom is not None and not multi._filters_ready[index]]
+
+    if indexes:
+        multi.rebuildFilters(*indexes)
+
+    interval, multi = multi._filters_interval, None
+
+    while True:
+        time.sleep(interval)
+        multi = multi_ref()
+
+        if multi is None:
+            return
+
+        try:
+            multi.saveFilters()
+        except:
+            logging.exception('TileStache.Caches._workFilters() failed to save filters')
+
+        multi = None
+
+class _RateLimit:
+    """ Limit on the rate of something across threads, or no limit without a rate.
+    """
+    def __init__(self, rate=None):
+        self.interval = rate and 1. / rate or 0
+        self.next = time.time()
+        self.lock = Lock()
+    
+    def wait(self):
+        """ Block until the next thing is allowed.
+        """
+        if not self.interval:
+            return
+        
+        with self.lock:
+            now = time.time()
+            self.next = max(self.next, now) + self.interval
+            delay = self.next - self.interval - now
+        
+        if delay > 0:
+            time.sleep(delay)
+
 class Test:
     """ Simple cache that doesn't actually cache anything.
     
@@ -190,7 +307,7 @@ class Disk:
     def _filepath(self, layer, coord, format):
         """
         """
-        l = layer.name()
+        l = layer.cacheName()
         z = '%d' % coord.zoom
         e = format.lower()
         e += self._is_compressed(format) and '.gz' or ''
@@ -275,14 +392,7 @@ class Disk:
     def remove(self, layer, coord, format):
         """ Remove a cached tile.
         """
-        fullpath = self._fullpath(layer, coord, format)
-        
-        try:
-            os.remove(fullpath)
-        except OSError, e:
-            # errno=2 means that the file does not exist, which is fine
-            if e.errno != 2:
-                raise
+        self._unlink(self._fullpath(layer, coord, format))
         
     def read(self, layer, coord, format):
         """ Read a cached tile.
@@ -304,19 +414,225 @@ class Disk:
             body = open(fullpath, 'rb').read()
             return body
     
-    def save(self, body, layer, coord, format):
-        """ Save a cached tile.
+    def removeGenerations(self, layer):
+        """ Remove tiles cached under other generations of a layer.
+        
+            Each generation has a directory of its own, removed entirely.
         """
-        fullpath = self._fullpath(layer, coord, format)
+        layer_name, current = layer.name(), split_cache_name(layer.cacheName())[1]
+        
+        if not isdir(self.cachepath):
+            return
+        
+        for entry in os.listdir(self.cachepath):
+            name, generation = split_cache_name(entry)
+            
+            if name == layer_name and generation != current:
+                shutil.rmtree(pathjoin(self.cachepath, entry), True)
+    
+    def removeTiles(self, layer, format, zoom, row1, column1, row2, column2):
+        """ Remove cached tiles in a range of rows and columns at one zoom level.
+        
+            Walks only the directories that overlap the range, and removes
+            whole any directory inside the range that holds nothing but tiles
+            of this format.
+        """
+        suffix = '.' + format.lower() + (self._is_compressed(format) and '.gz' or '')
+        zoompath = pathjoin(self.cachepath, layer.cacheName(), '%d' % zoom)
+        
+        # directory levels below the zoom, as (axis, tiles per name) pairs.
+        levels = {'safe': [('column', 1000), ('column', 1), ('row', 1000)],
+                  'portable': [('column', 1)]}.get(self.dirs)
+        
+        if levels is None:
+            raise KnownUnknown('Please provide a valid "dirs" parameter to the Disk cache, either "safe" or "portable" but not "%s"' % self.dirs)
+        
+        if isdir(zoompath):
+            area = row1, column1, row2, column2
+            self._removeTiles(zoompath, levels, suffix, area, (0, 0), (2**zoom, 2**zoom), 2**zoom)
+    
+    def _removeTiles(self, path, levels, suffix, area, corner, extent, size):
+        """ Remove tiles in an area from a directory of tiles.
+        
+            Corner is the (row, column) of the first tile the directory could
+            hold, and extent the (rows, columns) it covers.
+        """
+        row1, column1, row2, column2 = area
+        row, column = corner
+        
+        if not levels:
+            for name in os.listdir(path):
+                y = name[:-len(suffix)]
+                
+                if name.endswith(suffix) and y.isdigit() and row1 <= row + int(y) <= row2:
+                    self._unlink(pathjoin(path, name))
+            return
+        
+        (axis, count), levels = levels[0], levels[1:]
+        
+        for name in os.listdir(path):
+            if not name.isdigit():
+                # lock directories and the like.
+                continue
+            
+            if axis == 'column':
+                top, left = row, column + int(name) * count
+                height, width = extent[0], count
+            else:
+                top, left = row + int(name) * count, column
+                height, width = count, extent[1]
+            
+            bottom, right = min(top + height, size) - 1, min(left + width, size) - 1
+            
+            if bottom < row1 or top > row2 or right < column1 or left > column2:
+                continue
+            
+            childpath = pathjoin(path, name)
+            covered = row1 <= top and bottom <= row2 and column1 <= left and right <= column2
+            
+            if covered and self._holdsOnly(childpath, suffix):
+                shutil.rmtree(childpath, True)
+            else:
+                self._removeTiles(childpath, levels, suffix, area, (top, left), (height, width), size)
+    
+    def _holdsOnly(self, path, suffix):
+        """ Return true if a directory tree holds nothing but files ending in suffix.
+        """
+        for (dirpath, dirnames, filenames) in os.walk(path):
+            for name in filenames:
+                if not name.endswith(suffix):
+                    return False
+            
+            for name in dirnames:
+                if not name.isdigit():
+                    return False
+        
+        return True
+    
+    def _unlink(self, fullpath):
+        try:
+            os.remove(fullpath)
+        except OSError, e:
+            # errno=2 means that the file does not exist, which is fine
+            if e.errno != 2:
+                raise
+    
+    def sweepExpired(self, layer, threads=1, rate=None):
+        """ Remove tiles of a layer older than its cache lifespan, return a count.
+        
+            Directories of the layer are walked by a pool of threads, which
+            remove expired tiles and then any directories left empty. Rate is
+            an optional limit on files looked at per second by all threads,
+            to leave some disk time for everything else.
+        """
+        layerpath = pathjoin(self.cachepath, layer.cacheName())
+        
+        if not layer.cache_lifespan or not isdir(layerpath):
+            return 0
+        
+        due = time.time() - layer.cache_lifespan
+        limit = _RateLimit(rate)
+        
+        # zoom level directories, and their first level of subdirectories.
+        zoompaths = [pathjoin(layerpath, name) for name in os.listdir(layerpath)]
+        dirpaths = [pathjoin(zoompath, name) for zoompath in zoompaths if isdir(zoompath)
+                    for name in os.listdir(zoompath)]
         
+        pool = ThreadPool(threads)
+        
+        try:
+            sweep = lambda dirpath: self._sweep(dirpath, due, limit)
+            count = sum(pool.imap_unordered(sweep, dirpaths))
+        finally:
+            pool.close()
+            pool.join()
+        
+        for zoompath in zoompaths:
+            _rmdir(zoompath)
+        
+        return count
+    
+    def _sweep(self, dirpath, due, limit):
+        """ Remove files modified before due from a directory tree, return a count.
+        """
+        count = 0
+        
+        for (path, dirnames, filenames) in os.walk(dirpath, topdown=False):
+            for name in filenames:
+                limit.wait()
+                filepath = pathjoin(path, name)
+                
+                try:
+                    if os.stat(filepath).st_mtime < due:
+                        os.remove(filepath)
+                        count += 1
+                except OSError, e:
+                    # errno=2 means that the file is gone already, which is fine
+                    if e.errno != 2:
+                        raise
+            
+            if not path.endswith('.lock'):
+                # empty lock directories are locks in use.
+                _rmdir(path)
+        
+        return count
+    
+    def listTiles(self, sizes=False):
+        """ Generate a (layer name, coordinate, format) tuple for every cached tile.
+        
+            Walks the whole cache directory, so this may take a while.
+            With sizes, tuples have a fourth member for the file size.
+        """
+        depth = {'safe': 5, 'portable': 3}.get(self.dirs, None)
+        
+        for (dirpath, dirnames, filenames) in os.walk(self.cachepath):
+            # lock directories never contain tiles.
+            dirnames[:] = [name for name in dirnames if not name.endswith('.lock')]
+            
+            parts = relpath(dirpath, self.cachepath).split(os.sep)
+            
+            if len(parts) != depth:
+                continue
+            
+            for filename in filenames:
+                if '.' not in filename or filename.endswith('.lock'):
+                    continue
+            
+                y, ext = filename.split('.', 1)
+                
+                if ext.endswith('.gz'):
+                    ext = ext[:-3]
+                
+                try:
+                    if self.dirs == 'safe':
+                        l, z, x1, x2, y1 = parts
+                        coord = Coordinate(int(y1 + y), int(x1 + x2), int(z))
+                    else:
+                        l, z, x = parts
+                        coord = Coordinate(int(y), int(x), int(z))
+                except ValueError:
+                    continue
+                
+                if sizes:
+                    yield l, coord, ext, os.path.getsize(pathjoin(dirpath, filename))
+                else:
+                    yield l, coord, ext
+    
+    def _makedirs(self, dirpath):
         try:
             umask_old = os.umask(self.umask)
-            os.makedirs(dirname(fullpath), 0777&~self.umask)
+            os.makedirs(dirpath, 0777&~self.umask)
         except OSError, e:
             if e.errno != 17:
                 raise
         finally:
             os.umask(umask_old)
+    
+    def save(self, body, layer, coord, format):
+        """ Save a cached tile.
+        """
+        fullpath = self._fullpath(layer, coord, format)
+        self._makedirs(dirname(fullpath))
 
         suffix = '.' + format.lower()
         suffix += self._is_compressed(format) and '.gz' or ''
@@ -334,12 +650,128 @@ class Disk:
         
         try:
             os.rename(tmp_path, fullpath)
-        except OSError:
-            os.unlink(fullpath)
+        except OSError, e:
+            if e.errno == 2:
+                # directory was emptied and removed meanwhile, see sweepExpired().
+                self._makedirs(dirname(fullpath))
+            else:
+                os.unlink(fullpath)
+            
             os.rename(tmp_path, fullpath)
 
         os.chmod(fullpath, 0666&~self.umask)
 
+class Memory:
+    """ Caches tiles in memory, within a single process.
+    
+        Memory cache is fast but small and private to one process, so it works
+        best as the first tier of a Multi cache in front of Disk or S3.
+        
+        Example configuration:
+
+            "cache": {
+              "name": "Memory",
+              "limit": 67108864
+            }
+
+        Extra parameters:
+        - limit: optional maximum number of bytes of tile content to store.
+          Least-recently used tiles are discarded to stay under the limit.
+          Defaults to 64MB.
+
+        Tiles older than their layer's cache lifespan are not returned. Locks
+        are held in memory too, so they can't be left behind by a crashed
+        process and are never forced after the stale lock timeout.
+    """
+    def __init__(self, limit=64*1024*1024):
+        self.limit = int(limit)
+        self.size = 0
+        
+        # tile keys in least- to most-recently used order.
+        self._tiles = OrderedDict()
+        self._tiles_lock = Lock()
+        
+        self._locked = set()
+        self._locked_cond = Condition()
+
+    def _key(self, layer, coord, format):
+        """
+        """
+        return layer.cacheName(), coord.zoom, coord.column, coord.row, format.lower()
+    
+    def lock(self, layer, coord, format):
+        """ Acquire a cache lock for this tile.
+        
+            Returns nothing, but blocks until the lock has been acquired.
+        """
+        key = self._key(layer, coord, format)
+        
+        with self._locked_cond:
+            while key in self._locked:
+                self._locked_cond.wait()
+            
+            self._locked.add(key)
+    
+    def unlock(self, layer, coord, format):
+        """ Release a cache lock for this tile.
+        """
+        key = self._key(layer, coord, format)
+        
+        with self._locked_cond:
+            self._locked.discard(key)
+            self._locked_cond.notify_all()
+        
+    def remove(self, layer, coord, format):
+        """ Remove a cached tile.
+        """
+        key = self._key(layer, coord, format)
+        
+        with self._tiles_lock:
+            if key in self._tiles:
+                body, saved = self._tiles.pop(key)
+                self.size -= len(body)
+        
+    def read(self, layer, coord, format):
+        """ Read a cached tile.
+        """
+        key = self._key(layer, coord, format)
+        
+        with self._tiles_lock:
+            if key not in self._tiles:
+                return None
+            
+            # move the tile to the most-recently used end.
+            body, saved = self._tiles.pop(key)
+            
+            if layer.cache_lifespan and time.time() - saved > layer.cache_lifespan:
+                self.size -= len(body)
+                return None
+            
+            self._tiles[key] = body, saved
+            return body
+    
+    def save(self, body, layer, coord, format):
+        """ Save a cached tile.
+        
+            Least-recently used tiles are removed to stay under the limit.
+        """
+        key = self._key(layer, coord, format)
+        
+        if len(body) > self.limit:
+            return
+        
+        with self._tiles_lock:
+            if key in self._tiles:
+                old_body, saved = self._tiles.pop(key)
+                self.size -= len(old_body)
+            
+            self._tiles[key] = body, time.time()
+            self.size += len(body)
+            
+            while self.size > self.limit:
+                old_key, (old_body, saved) = self._tiles.popitem(last=False)
+                self.size -= len(old_body)
+
 class Multi:
     """ Caches tiles to multiple, ordered caches.
         
@@ -362,7 +794,9 @@ class Multi:
                      "name": "Disk",
                      "path": "/tmp/stache"
                   }
-              ]
+              ],
+              "hedge": 50,
+              "backfill": "background"
             }
 
         Multi cache parameters:
@@ -373,9 +807,312 @@ class Multi:
             most remote cache should be at the end. Memcache and S3 together
             make a great pair.
 
+          hedge
+            Optional number of milliseconds to wait for one tier to answer
+            before also asking the next one. Answers are taken from whichever
+            tier finds the tile first. Defaults to None, for strictly
+            sequential reads.
+
+          backfill
+            Optional string saying how a tile found in a later tier is saved
+            back to earlier tiers: "inline" saves before the read returns,
+            "background" hands the saves to a queue worked by a separate
+            thread. Defaults to "inline". Background saves are dropped when
+            the queue is full, and may be lost when a short-lived process
+            such as a CGI script exits.
+
+          filter
+            Optional dictionary in any tier configuration, for a Bloom filter
+            of keys in that tier. Tiers are skipped when the filter says they
+            definitely lack a tile, which is useful in front of slow remote
+            storage where most misses are for tiles that exist nowhere yet.
+            Keys are added as tiles are saved; removed tiles stay in the filter
+            until it's rebuilt. Filter parameters are "capacity", the expected
+            number of tiles (default 1000000), "error_rate", the acceptable
+            rate of wasted reads (default 0.01) and "path", an optional file
+            for keeping the filter between restarts. A filter without a saved
+            file is built from a complete listing of its tier in a background
+            thread, started with the first read or save; rebuildFilters() does
+            the same in the foreground, e.g. from a script. Filters only work
+            on tiers with a listTiles() method and are ignored with a warning
+            on others. A filter is only used to skip its tier once it has been
+            loaded or fully built.
+            
+            Filters are kept per-process. Every minute in that same background
+            thread, and at exit, each process merges the saved file into its
+            own filter and saves the result, so processes sharing a file pick
+            up each other's tiles. Until then, a tile saved by another process
+            may be rendered again.
+        
+        Example tier with a filter:
+        
+            {
+              "name": "S3",
+              "bucket": "tiles",
+              "access": "<access key>",
+              "secret": "<secret key>",
+              "filter": {"capacity": 50000000, "path": "/var/cache/s3.bloom"}
+            }
+
+        Per-tier hit and miss counts are kept in the hits and misses lists,
+        and reads skipped thanks to a filter are counted in skips. Hedged
+        reads are made by a small pool of threads shared by all reads, and
+        every tier that answers is counted, including late answers that come
+        after another tier has already found the tile. Those late hits are
+        also counted in lates.
     """
-    def __init__(self, tiers):
+    # seconds between saves of filters with a file.
+    _filters_interval = 60
+
+    def __init__(self, tiers, hedge=None, backfill='inline', filters=None):
+        if backfill not in ('inline', 'background'):
+            raise KnownUnknown('Please provide a valid "backfill" parameter to the Multi cache, either "inline" or "background" but not "%s"' % backfill)
+        
         self.tiers = tiers
+        self.hedge = hedge and float(hedge) / 1000 or None
+        self.backfill = backfill
+        
+        self.hits = [0] * len(tiers)
+        self.misses = [0] * len(tiers)
+        self.skips = [0] * len(tiers)
+        self.lates = [0] * len(tiers)
+        self._counts_lock = Lock()
+        
+        self._probes = None
+        self._probes_lock = Lock()
+        
+        self._backfills = None
+        self._backfills_lock = Lock()
+        
+        self._filter_args = list(filters or [None] * len(tiers))
+        self.filters = [None] * len(tiers)
+        self._filters_ready = [False] * len(tiers)
+        self._filters_building = [None] * len(tiers)
+        self._filters_pid = None
+        self._filters_lock = Lock()
+
+        for (index, args) in enumerate(self._filter_args):
+            if not args:
+                continue
+            
+            if not hasattr(tiers[index], 'listTiles'):
+                logging.warning('TileStache.Caches.Multi() tier %d has no listTiles() method, so its filter could never be built and is not used', index)
+                self._filter_args[index] = None
+                continue
+            
+            path = args.get('path', None)
+            bloom = path and Bloom.load(path)
+            
+            if bloom is not None:
+                self.filters[index] = bloom
+                self._filters_ready[index] = True
+                continue
+            
+            # built later, see _startFilters().
+            self.filters[index] = Bloom.BloomFilter(int(args.get('capacity', 1000000)),
+                                                    float(args.get('error_rate', 0.01)))
+        
+        if [args for args in self._filter_args if args and args.get('path')]:
+            _filtered_multis.add(self)
+
+    def _startFilters(self):
+        """ Start the background thread for filters in this process, if needed.
+        """
+        if self._filters_pid == os.getpid() or self.filters == [None] * len(self.tiers):
+            return
+        
+        with self._filters_lock:
+            if self._filters_pid == os.getpid():
+                return
+            
+            self._filters_pid = os.getpid()
+            
+            worker = Thread(target=_workFilters, args=(ref(self), ))
+            worker.setDaemon(True)
+            worker.start()
+
+    def rebuildFilters(self, *indexes):
+        """ Rebuild tier filters from complete listings of their tiers.
+        
+            Optional arguments are tier indexes, defaulting to every tier with
+            a filter. Tiers provide a listTiles() method that generates (layer
+            name, coordinate, format) tuples. A new filter is built alongside
+            the old one, which goes on being used until the listing is done.
+            If listing fails, the filter is not used until a later rebuild.
+        """
+        for index in (indexes or range(len(self.tiers))):
+            old, cache = self.filters[index], self.tiers[index]
+            
+            if old is None:
+                continue
+            
+            # tiles saved while listing are added to the new filter too.
+            bloom = Bloom.BloomFilter(size=old.size, hashes=old.hashes)
+            self._filters_building[index] = bloom
+            
+            try:
+                for (name, coord, format) in cache.listTiles():
+                    bloom.add(Bloom.tile_key(name, coord, format))
+            except:
+                logging.exception('TileStache.Caches.Multi.rebuildFilters() failed to list tier %d, not using its filter', index)
+                self._filters_ready[index] = False
+                continue
+            finally:
+                self._filters_building[index] = None
+            
+            self.filters[index] = bloom
+            self._filters_ready[index] = True
+            self._saveFilter(index, False)
+
+    def saveFilters(self):
+        """ Merge tier filters with their files and write them back, if they have one.
+        """
+        for index in range(len(self.tiers)):
+            self._saveFilter(index, True)
+
+    def _saveFilter(self, index, merge):
+        """ Write one tier filter to its file, if it has one and it's usable.
+        
+            With merge, keys saved to the file by other processes are added
+            to this filter first. Filters that aren't ready are never saved,
+            so that a partial filter is never loaded as a complete one.
+        """
+        bloom, args = self.filters[index], self._filter_args[index]
+        
+        if bloom is None or not self._filters_ready[index] or not args.get('path'):
+            return
+        
+        if not isdir(dirname(args['path']) or '.'):
+            logging.debug('TileStache.Caches.Multi._saveFilter() has nowhere to save tier %d filter', index)
+            return
+        
+        if merge:
+            other = Bloom.load(args['path'])
+            
+            if other is not None and (other.size, other.hashes) == (bloom.size, bloom.hashes):
+                bloom.update(other)
+        
+        bloom.save(args['path'])
+
+    def _excludes(self, index, layer, coord, format):
+        """ Return true if a tier definitely does not have a tile.
+        """
+        bloom = self.filters[index]
+        
+        if bloom is None or not self._filters_ready[index]:
+            return False
+        
+        return Bloom.tile_key(layer.cacheName(), coord, format) not in bloom
+
+    def _remember(self, index, layer, coord, format):
+        """ Add a tile to the filter of a tier, if it has one.
+        """
+        for bloom in (self.filters[index], self._filters_building[index]):
+            if bloom is not None:
+                bloom.add(Bloom.tile_key(layer.cacheName(), coord, format))
+
+    def _count(self, index, body):
+        """ Record a hit or a miss for a tier.
+        """
+        with self._counts_lock:
+            if body:
+                self.hits[index] += 1
+            else:
+                self.misses[index] += 1
+
+    def _backfill(self, body, layer, coord, format, index):
+        """ Save a tile found in one tier back to all the earlier tiers.
+        """
+        for other in range(index):
+            self._remember(other, layer, coord, format)
+        
+        if self.backfill == 'inline':
+            for cache in self.tiers[:index]:
+                cache.save(body, layer, coord, format)
+            return
+        
+        with self._backfills_lock:
+            if self._backfills is None:
+                self._backfills = Queue(1000)
+                
+                worker = Thread(target=self._work_backfills)
+                worker.setDaemon(True)
+                worker.start()
+        
+        for cache in self.tiers[:index]:
+            try:
+                self._backfills.put_nowait((cache, body, layer, coord, format))
+            except Full:
+                logging.debug('TileStache.Caches.Multi._backfill() dropped a save, queue is full')
+
+    def _work_backfills(self):
+        """ Save queued tiles to their tiers, forever.
+        """
+        while True:
+            cache, body, layer, coord, format = self._backfills.get()
+            
+            try:
+                cache.save(body, layer, coord, format)
+            except:
+                logging.exception('TileStache.Caches.Multi._work_backfills() failed to save a tile')
+
+    def _read_hedged(self, layer, coord, format, indexes):
+        """ Read a cached tile, asking later tiers when earlier ones are slow.
+        
+            Each of the given tier indexes is read in a thread of the shared
+            pool. If a tier has not answered within the hedge time, the next
+            tier is asked too. Tiers count their own answers as they come.
+            Returns a pair of tier index and body, or None and None for a miss.
+        """
+        answers, started, outstanding = Queue(), 0, 0
+        ask_next, found = True, []
+        
+        def probe(index, cache):
+            try:
+                body = cache.read(layer, coord, format)
+            except:
+                logging.exception('TileStache.Caches.Multi._read_hedged() failed to read tier %d', index)
+                body = None
+            
+            with self._counts_lock:
+                if body:
+                    self.hits[index] += 1
+                    self.lates[index] += found and 1 or 0
+                    found.append(index)
+                else:
+                    self.misses[index] += 1
+            
+            answers.put((index, body))
+        
+        with self._probes_lock:
+            if self._probes is None:
+                self._probes = ThreadPool(4 * len(self.tiers))
+        
+        while True:
+            if ask_next and started < len(indexes):
+                index = indexes[started]
+                self._probes.apply_async(probe, (index, self.tiers[index]))
+                started, outstanding = started + 1, outstanding + 1
+            
+            if outstanding == 0:
+                break
+
+            try:
+                timeout = started < len(indexes) and self.hedge or None
+                index, body = answers.get(True, timeout)
+            except Empty:
+                # the outstanding tiers are slow, so ask one more.
+                ask_next = True
+                continue
+            
+            outstanding -= 1
+            
+            if body:
+                return index, body
+            
+            ask_next = (outstanding == 0)
+        
+        return None, None
 
     def lock(self, layer, coord, format):
         """ Acquire a cache lock for this tile in the first tier.
@@ -391,24 +1128,75 @@ class Multi:
         
     def remove(self, layer, coord, format):
         """ Remove a cached tile from every tier.
+        
+            Tier filters keep the tile key until they are rebuilt.
         """
         for (index, cache) in enumerate(self.tiers):
             cache.remove(layer, coord, format)
+    
+    def removeTiles(self, layer, format, zoom, row1, column1, row2, column2):
+        """ Remove cached tiles in a range of rows and columns from every tier.
+        """
+        for cache in self.tiers:
+            removeTiles(cache, layer, format, zoom, row1, column1, row2, column2)
+    
+    def sweepExpired(self, layer, threads=1, rate=None):
+        """ Remove tiles of a layer older than its cache lifespan, return a count.
+        
+            Tiers without a sweepExpired() method are left alone.
+        """
+        return sum([cache.sweepExpired(layer, threads, rate)
+                    for cache in self.tiers if hasattr(cache, 'sweepExpired')])
+    
+    def removeGenerations(self, layer):
+        """ Remove tiles cached under other generations of a layer.
+        
+            Tiers without a removeGenerations() method are left alone.
+        """
+        for cache in self.tiers:
+            if hasattr(cache, 'removeGenerations'):
+                cache.removeGenerations(layer)
+        
+    def flush(self):
+        """ Write out anything held back by tiers with a flush() method.
+        """
+        for cache in self.tiers:
+            if hasattr(cache, 'flush'):
+                cache.flush()
         
     def read(self, layer, coord, format):
         """ Read a cached tile.
         
             Start at the first tier and work forwards until a cached tile
             is found. When found, save it back to the earlier tiers for faster
-            access on future requests.
+            access on future requests. Tiers whose filter rules out the tile
+            are skipped.
         """
-        for (index, cache) in enumerate(self.tiers):
-            body = cache.read(layer, coord, format)
+        self._startFilters()
+        indexes = []
+        
+        for index in range(len(self.tiers)):
+            if self._excludes(index, layer, coord, format):
+                with self._counts_lock:
+                    self.skips[index] += 1
+            else:
+                indexes.append(index)
+        
+        if self.hedge:
+            index, body = self._read_hedged(layer, coord, format, indexes)
+            
+            if body:
+                self._backfill(body, layer, coord, format, index)
+            
+            return body
+        
+        for index in indexes:
+            body = self.tiers[index].read(layer, coord, format)
+            self._count(index, body)
             
             if body:
                 # save the body in earlier tiers for speedier access
-                for cache in self.tiers[:index]:
-                    cache.save(body, layer, coord, format)
+                self._backfill(body, layer, coord, format, index)
                 
                 return body
         
@@ -419,5 +1207,8 @@ class Multi:
         
             Every tier gets a saved copy.
         """
+        self._startFilters()
+        
         for (index, cache) in enumerate(self.tiers):
             cache.save(body, layer, coord, format)
+            self._remember(index, layer, coord, format)
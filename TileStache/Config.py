@@ -54,6 +54,11 @@ Configuration also supports these additional settings:
   by mimetypes.guess_type. A simple text greeting is displayed if no index
   is provided.
 
+- "generations": optional path to a JSON file of per-layer cache generation
+  numbers, relative to the configuration location. Bumping a layer's
+  generation invalidates all of its cached tiles at once. More detail can be
+  found in the TileStache.Generations module documentation.
+
 In-depth explanations of the layer components can be found in the module
 documentation for TileStache.Providers, TileStache.Core, and TileStache.Geography.
 """
@@ -79,6 +84,8 @@ import Core
 import Caches
 import Providers
 import Geography
+import Generations
+import Pyramid
 
 class Configuration:
     """ A complete site configuration, with a collection of Layer objects.
@@ -114,10 +121,14 @@ class Configuration:
             Local filesystem path for this configuration,
             useful for expanding relative paths.
           
-        Optional attribute:
+        Optional attributes:
         
           index:
             Mimetype, content tuple for default index response.
+        
+          generations:
+            TileStache.Generations.Generations instance with per-layer
+            cache generation numbers, or None.
     """
     def __init__(self, cache, dirpath):
         self.cache = cache
@@ -125,6 +136,7 @@ class Configuration:
         self.layers = {}
         
         self.index = 'text/plain', 'TileStache bellows hello.'
+        self.generations = None
 
 class Bounds:
     """ Coordinate bounding box for tiles.
@@ -223,6 +235,15 @@ def buildConfiguration(config_dict, dirpath='.'):
         
         config.index = index_type[0], index_body
     
+    if 'generations' in config_dict:
+        for name in config.layers:
+            if '@' in name:
+                # cache names of layers are "name@generation", see Generations.
+                raise Core.KnownUnknown('Layer name "%s" can\'t be used with generations, because "@" separates a layer name from its generation in the cache.' % name)
+        
+        generations_path = enforcedLocalPath(config_dict['generations'], dirpath, 'Generations path')
+        config.generations = Generations.Generations(generations_path)
+    
     if 'logging' in config_dict:
         level = config_dict['logging'].upper()
     
@@ -291,15 +312,34 @@ def _parseConfigfileCache(cache_dict, dirpath):
             
             add_kwargs('dirs', 'gzip')
         
+        elif _class is Caches.Memory:
+            add_kwargs('limit')
+        
         elif _class is Caches.Multi:
             kwargs['tiers'] = [_parseConfigfileCache(tier_dict, dirpath)
                                for tier_dict in cache_dict['tiers']]
+            
+            filters = [tier_dict.get('filter', None) for tier_dict in cache_dict['tiers']]
+            
+            for filter_dict in filters:
+                if filter_dict and 'path' in filter_dict:
+                    filter_dict['path'] = enforcedLocalPath(filter_dict['path'], dirpath, 'Multi cache filter path')
+            
+            if [filter_dict for filter_dict in filters if filter_dict]:
+                kwargs['filters'] = filters
+            
+            add_kwargs('hedge', 'backfill')
     
         elif _class is Caches.Memcache.Cache:
             add_kwargs('servers', 'lifespan', 'revision', 'key_prefix')
     
         elif _class is Caches.S3.Cache:
-            add_kwargs('bucket', 'access', 'secret', 'use_locks')
+            add_kwargs('bucket', 'access', 'secret', 'use_locks', 'host', 'port', 'secure')
+    
+        elif _class is Caches.Inventory.Cache:
+            kwargs['path'] = enforcedLocalPath(cache_dict['path'], dirpath, 'Inventory cache path')
+            kwargs['cache'] = _parseConfigfileCache(cache_dict['cache'], dirpath)
+            add_kwargs('trust')
     
         else:
             raise Exception('Unknown cache: %s' % cache_dict['name'])
@@ -374,6 +414,19 @@ def _parseConfigfileLayer(layer_dict, config, dirpath):
     if 'fallback layer' in layer_dict:
         layer_kwargs['fallback_layer'] = layer_dict['fallback layer']
 
+    if 'prefetch' in layer_dict:
+        prefetch_dict = layer_dict['prefetch']
+        layer_kwargs['prefetch_neighbors'] = int(prefetch_dict.get('neighbors', 0))
+        layer_kwargs['prefetch_children'] = bool(prefetch_dict.get('children', False))
+
+    if 'downsample' in layer_dict:
+        downsample_dict = layer_dict['downsample']
+        layer_kwargs['downsample_zoom'] = int(downsample_dict['zoom'])
+        layer_kwargs['downsample_filter'] = str(downsample_dict.get('filter', 'antialias'))
+        
+        if layer_kwargs['downsample_filter'] not in Pyramid.filters:
+            raise Core.KnownUnknown('Layer downsample filter must be one of %s, not "%s"' % (', '.join(sorted(Pyramid.filters)), layer_kwargs['downsample_filter']))
+
     #
     # Do the bounds
     #
@@ -26,6 +26,8 @@ configuration file as a dictionary:
           "redirects": ...,
           "tile height": ...,
           "fallback layer": ...,
+          "prefetch": { ... },
+          "downsample": { ... },
           "jpeg options": ...,
           "png options": ...
         }
@@ -72,6 +74,11 @@ configuration file as a dictionary:
   to create double-size, double-resolution tiles for high-density phone screens.
 - "fallback layer" is an alternate layer to use if this layer doesn't return
   a tile image.
+- "prefetch" is an optional dictionary of neighboring and child metatiles to
+  render in the background after a cache miss, explained in TileStache.Prefetch.
+- "downsample" is an optional dictionary with a zoom level below which tiles
+  are built from their four children instead of rendered, and a resampling
+  filter, explained in TileStache.Pyramid.
 - "jpeg options" is an optional dictionary of JPEG creation options, passed
   through to PIL: http://www.pythonware.com/library/pil/handbook/format-jpeg.htm.
 - "png options" is an optional dictionary of PNG creation options, passed
@@ -142,6 +149,8 @@ from urlparse import urljoin
 from time import time
 
 from Pixels import load_palette, apply_palette
+from Generations import cache_name
+import Pyramid
 
 try:
     from PIL import Image
@@ -314,8 +323,20 @@ class Layer:
 
           fallback_layer:
             A fallback layer to use, in case that this layer doesn't return a tile image.
+
+          prefetch_neighbors:
+            Rings of adjacent metatiles to render after a cache miss, default 0.
+
+          prefetch_children:
+            Render metatiles of the next zoom level after a cache miss, default false.
+
+          downsample_zoom:
+            Zoom level below which tiles are built from their children, default None.
+
+          downsample_filter:
+            Name of resampling filter for building tiles from children, default "antialias".
     """
-    def __init__(self, config, projection, metatile, stale_lock_timeout=15, cache_lifespan=None, write_cache=True, allowed_origin=None, max_cache_age=None, redirects=None, preview_lat=37.80, preview_lon=-122.26, preview_zoom=10, preview_ext='png', bounds=None, tile_height=256, fallback_layer=None):
+    def __init__(self, config, projection, metatile, stale_lock_timeout=15, cache_lifespan=None, write_cache=True, allowed_origin=None, max_cache_age=None, redirects=None, preview_lat=37.80, preview_lon=-122.26, preview_zoom=10, preview_ext='png', bounds=None, tile_height=256, fallback_layer=None, prefetch_neighbors=0, prefetch_children=False, downsample_zoom=None, downsample_filter='antialias'):
         self.provider = None
         self.config = config
         self.projection = projection
@@ -338,6 +359,12 @@ class Layer:
 
         self.fallback_layer = fallback_layer
 
+        self.prefetch_neighbors = prefetch_neighbors
+        self.prefetch_children = prefetch_children
+
+        self.downsample_zoom = downsample_zoom
+        self.downsample_filter = downsample_filter
+
         self.bitmap_palette = None
         self.jpeg_options = {}
         self.png_options = {}
@@ -354,11 +381,39 @@ class Layer:
 
         return None
 
+    def cacheName(self):
+        """ Figure out the name to use in cache keys and paths.
+
+            This is the layer name, with the layer's generation added if
+            there is one. See TileStache.Generations for more information.
+        """
+        name = self.name()
+        generations = getattr(self.config, 'generations', None)
+
+        if generations is None or name is None:
+            return name
+
+        return cache_name(name, generations.get(name))
+
     def doMetatile(self):
         """ Return True if we have a real metatile and the provider is OK with it.
         """
         return self.metatile.isForReal() and hasattr(self.provider, 'renderArea')
 
+    def doDownsample(self, coord, format, tile_scale=1):
+        """ Return True if this tile should be built from its children instead of rendered.
+
+            Children are only cached at scale 1, so tiles at other scales
+            are always rendered.
+        """
+        if self.downsample_zoom is None or coord.zoom >= self.downsample_zoom:
+            return False
+
+        if tile_scale != 1:
+            return False
+
+        return Pyramid.canDownsample(format)
+
     def render(self, coord, format, tile_scale=1):
         """ Render a tile for a coordinate, return PIL Image-like object.
 
@@ -375,15 +430,20 @@ class Layer:
 
         provider = self.provider
         metatile = self.metatile
+        downsample = self.doDownsample(coord, format, tile_scale)
 
-        if self.doMetatile():
+        if self.doMetatile() and not downsample:
             # adjust render size and coverage for metatile
             xmin, ymin, xmax, ymax = self.metaEnvelope(coord)
             width, height = self.metaSize(coord)
 
             subtiles = self.metaSubtiles(coord)
 
-        if self.doMetatile() or hasattr(provider, 'renderArea'):
+        if downsample:
+            # shrink four children into one tile
+            tile = Pyramid.downsample(self, coord, format)
+
+        elif self.doMetatile() or hasattr(provider, 'renderArea'):
             # draw an area, defined in projected coordinates
             tile = provider.renderArea(width, height, srs, xmin, ymin, xmax, ymax, coord, tile_scale)
 
@@ -408,7 +468,7 @@ class Layer:
                 t_index = self.png_options.get('transparency', None)
                 tile = apply_palette(tile, self.bitmap_palette, t_index)
 
-        if self.doMetatile():
+        if self.doMetatile() and not downsample:
             # tile will be set again later
             tile, surtile = None, tile
 
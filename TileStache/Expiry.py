@@ -0,0 +1,135 @@
+""" Expired tile lists, for keeping a cache up to date with a changing database.
+
+Tools like osm2pgsql write a list of expired tiles after each update, one
+Z/X/Y coordinate per line and all at one zoom level. Each expired tile also
+dirties its parents at lower zoom levels and its children at higher ones, so
+expiredMetatiles() propagates the list to every zoom in a range and collapses
+the result to a set of unique metatiles, which expiredCoordinates() turns back
+into a stream of tiles for removing from a cache or seeding anew.
+
+An expired tile at zoom 14 with a range of 12 to 16 and 4x4 metatiles dirties
+one parent tile each at zooms 12 and 13, itself at zoom 14, and its 4 and 16
+children at zooms 15 and 16, which is one metatile at each zoom. Neighboring
+expired tiles mostly land in the same metatiles at lower zooms, and however
+many times a metatile comes up, it's only dealt with once.
+
+The script tilestache-expire.py reads expiry files or watches a directory for
+new ones, and removes or re-renders the tiles they expire.
+"""
+import os
+import logging
+
+from os.path import join, getmtime
+from time import time
+
+from ModestMaps.Core import Coordinate
+
+# suffix of expiry files marked done by markDone().
+_done_suffix = '.done'
+
+def readExpiry(filename):
+    """ Generate (zoom, column, row) tuples from a file of Z/X/Y coordinates.
+
+        Malformed lines and tiles outside the world are logged and skipped,
+        so that one bad line doesn't cost the rest of the file.
+    """
+    for (number, line) in enumerate(open(filename, 'r')):
+        if not line.strip():
+            continue
+
+        try:
+            zoom, column, row = map(int, line.strip().split('/'))
+        except ValueError:
+            logging.warning('TileStache.Expiry.readExpiry() skipped line %d of %s: %s', number + 1, filename, repr(line.strip()))
+            continue
+
+        if zoom < 0 or not (0 <= column < 2**zoom and 0 <= row < 2**zoom):
+            logging.warning('TileStache.Expiry.readExpiry() skipped line %d of %s, tile is outside the world: %s', number + 1, filename, line.strip())
+            continue
+
+        yield zoom, column, row
+
+def expiredMetatiles(tiles, metatile, minzoom=None, maxzoom=None):
+    """ Return a set of (zoom, x, y) metatiles dirtied by expired tiles.
+
+        Tiles are (zoom, column, row) tuples, e.g. from readExpiry(), and are
+        propagated to every zoom level from minzoom to maxzoom, to parents
+        above their own zoom and to children below it. Without a range, tiles
+        stay at their own zoom level. Metatile x, y are in metatile units.
+    """
+    rows, columns = metatile.rows, metatile.columns
+    metatiles = set()
+
+    for (zoom, column, row) in tiles:
+        low = zoom if minzoom is None else minzoom
+        high = zoom if maxzoom is None else maxzoom
+
+        for z in range(low, high + 1):
+            if z <= zoom:
+                shift = zoom - z
+                metatiles.add((z, (column >> shift) // columns, (row >> shift) // rows))
+                continue
+
+            # children cover a block of tiles, and maybe a few metatiles.
+            shift = z - zoom
+            x1, x2 = (column << shift) // columns, (((column + 1) << shift) - 1) // columns
+            y1, y2 = (row << shift) // rows, (((row + 1) << shift) - 1) // rows
+
+            for y in range(y1, y2 + 1):
+                for x in range(x1, x2 + 1):
+                    metatiles.add((z, x, y))
+
+    return metatiles
+
+def expiredCoordinates(metatiles, metatile):
+    """ Generate a stream of (offset, count, coordinate) tuples from a set of metatiles.
+
+        Tiles come in metatile order, by zoom and then row by row, limited
+        to the edges of the world.
+    """
+    rows, columns = metatile.rows, metatile.columns
+
+    def tiles(zoom, x, y):
+        size = 2**zoom
+        return [(row, column, zoom)
+                for row in range(y * rows, min((y + 1) * rows, size))
+                for column in range(x * columns, min((x + 1) * columns, size))]
+
+    keys = sorted(metatiles)
+    count = sum([len(tiles(*key)) for key in keys])
+    offset = 0
+
+    for key in keys:
+        for (row, column, zoom) in tiles(*key):
+            yield (offset, count, Coordinate(row, column, zoom))
+            offset += 1
+
+def newExpiryFiles(dirpath, settle=5):
+    """ Return a sorted list of new expiry files in a directory.
+
+        Files modified in the last few seconds may still be in the middle of
+        being written, and are left for later. Hidden files and files already
+        marked done with markDone() are skipped.
+    """
+    filenames = []
+
+    for name in os.listdir(dirpath):
+        filename = join(dirpath, name)
+
+        if name.startswith('.') or name.endswith(_done_suffix):
+            continue
+
+        if not os.path.isfile(filename) or time() - getmtime(filename) < settle:
+            continue
+
+        filenames.append((getmtime(filename), name, filename))
+
+    return [filename for (mtime, name, filename) in sorted(filenames)]
+
+def markDone(filename, remove=False):
+    """ Mark an expiry file done, by renaming it or removing it.
+    """
+    if remove:
+        os.remove(filename)
+    else:
+        os.rename(filename, filename + _done_suffix)
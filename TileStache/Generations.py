@@ -0,0 +1,174 @@
+""" Per-layer generation numbers, for invalidating a whole layer at once.
+
+A generation is a small number kept for each layer in a JSON sidecar file. It's
+built into the name that caches use for the layer in tile keys and paths, so
+bumping a layer's generation makes every tile cached under the old one
+unreachable right away, without visiting a single tile. Tiles of old
+generations can be removed later at leisure, see tilestache-clean.py.
+
+Example configuration:
+
+    {
+      "cache": { ... },
+      "layers": { ... },
+      "generations": "generations.json"
+    }
+
+The sidecar file is a JSON dictionary of layer names and generation numbers,
+e.g. {"osm": 3, "roads": 1}, and is created when a generation is first bumped.
+Layers that aren't listed are at generation zero, and are cached under their
+plain name as before. Running servers notice changes to the file within a
+second or so. Layer names can't include "@" when generations are configured.
+Bumps from several processes at once are serialized with a lock directory
+next to the file.
+
+Caches that expire tiles on their own (Memory, Memcache, LimitedDisk,
+SharedMemory) just let old generations age out. Caches that don't (Disk, S3,
+and tiers of Multi) can remove them with a removeGenerations() method.
+The MBTiles cache holds a single layer with no name in its keys, so it
+doesn't use generations at all.
+"""
+import os
+import errno
+
+from time import time, sleep
+from threading import Lock
+from tempfile import mkstemp
+from os.path import exists, dirname
+
+try:
+    from json import load as json_load, dumps as json_dumps
+except ImportError:
+    from simplejson import load as json_load, dumps as json_dumps
+
+def cache_name(layer_name, generation):
+    """ Return a layer name for use in cache keys and paths.
+    """
+    if not generation:
+        return layer_name
+
+    return '%s@%d' % (layer_name, generation)
+
+def split_cache_name(name):
+    """ Return layer name and generation from a cache_name() result.
+    """
+    layer_name, sep, generation = name.rpartition('@')
+
+    if sep and generation.isdigit():
+        return layer_name, int(generation)
+
+    return name, 0
+
+# seconds after which someone else's lock on the file is considered stale.
+_stale_lock_timeout = 10
+
+def _stamp(path):
+    """ Return a value that changes whenever a file is replaced.
+    """
+    stat = os.stat(path)
+    return stat.st_ino, stat.st_mtime
+
+class Generations:
+    """ Layer generation numbers, read from a JSON file.
+
+        The file is looked at again whenever it's been more than interval
+        seconds since the last look, and read again only if it has changed.
+        Changes are always made by replacing the file, so its inode number
+        and modification time together tell when it's changed.
+    """
+    def __init__(self, path, interval=1):
+        self.path = path
+        self.interval = interval
+
+        self._generations = {}
+        self._seen = None
+        self._checked = 0
+        self._lock = Lock()
+
+    def _reload(self):
+        """ Read the generations file if it has changed since last time.
+        """
+        if time() - self._checked < self.interval:
+            return
+
+        with self._lock:
+            self._checked = time()
+            stamp = exists(self.path) and _stamp(self.path) or None
+
+            if stamp == self._seen:
+                return
+
+            self._generations = stamp and json_load(open(self.path)) or {}
+            self._seen = stamp
+
+    def get(self, layer_name):
+        """ Return the current generation of a layer.
+        """
+        self._reload()
+        return int(self._generations.get(layer_name, 0))
+
+    def bump(self, layer_name):
+        """ Increment the generation of a layer, return the new one.
+
+            The file is replaced atomically, so that readers never see it
+            half-written, and read again under a lock so that no other
+            process's bump is lost.
+        """
+        self._acquire()
+
+        try:
+            return self._bump(layer_name)
+        finally:
+            self._release()
+
+    def _acquire(self):
+        """ Acquire the lock directory next to the generations file.
+        """
+        lockpath = self.path + '.lock'
+        due = time() + _stale_lock_timeout
+
+        while True:
+            try:
+                os.mkdir(lockpath)
+                return
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+            if time() > due:
+                # someone left the door locked.
+                try:
+                    os.rmdir(lockpath)
+                except OSError:
+                    pass
+
+            sleep(.1)
+
+    def _release(self):
+        try:
+            os.rmdir(self.path + '.lock')
+        except OSError:
+            pass
+
+    def _bump(self, layer_name):
+        with self._lock:
+            # always read afresh, the lock holder before us may have changed it.
+            generations = exists(self.path) and json_load(open(self.path)) or {}
+            generations[layer_name] = int(generations.get(layer_name, 0)) + 1
+
+            handle, tmp_path = mkstemp(dir=dirname(self.path) or '.', suffix='.json')
+
+            try:
+                os.write(handle, json_dumps(generations))
+                os.close(handle)
+                os.chmod(tmp_path, 0644)
+                os.rename(tmp_path, self.path)
+            except:
+                if exists(tmp_path):
+                    os.unlink(tmp_path)
+                raise
+
+            self._generations = generations
+            self._seen = _stamp(self.path)
+
+        return generations[layer_name]
@@ -45,7 +45,7 @@ except ImportError:
 def tile_key(layer, coord, format):
     """ Return a tile key string.
     """
-    name = layer.name()
+    name = layer.cacheName()
     tile = '%(zoom)d/%(column)d/%(row)d' % coord.__dict__
     ext = format.lower()
 
@@ -14,14 +14,64 @@ Example TileStache cache configuration, with a 16MB limit:
         "limit": 16777216
     }
 }
+
+Cache parameters:
+
+  path
+    Required local directory path where files should be stored.
+
+  limit
+    Required maximum number of bytes to store.
+
+  umask
+    Optional permission mask for stored files. Defaults to 0022.
+
+  low_water
+    Optional number of bytes to trim the cache down to when the limit is
+    passed, so that eviction happens in occasional batches rather than one
+    tile at a time. Defaults to 90% of the limit.
+
+  quotas
+    Optional dictionary of maximum bytes to store for individual layers, so
+    that one busy layer can't push every other layer out of the cache. Layers
+    over quota are trimmed by the same proportion as the whole cache.
+
+  eviction
+    Optional string saying when to trim the cache: "inline" trims during the
+    save that passes a limit, "background" leaves it to a separate thread so
+    that no request waits on deleting files. Defaults to "inline".
+
+  interval
+    Optional number of seconds between checks by the background eviction
+    thread, which is also woken whenever a save passes a limit. Defaults to 60.
+
+Example configuration with background eviction and a quota for one layer:
+
+"cache":
+{
+    "class": "TileStache.Goodies.Caches.LimitedDisk.Cache",
+    "kwargs": {
+        "path": "/tmp/limited-cache",
+        "limit": 1073741824,
+        "quotas": {"osm": 268435456},
+        "eviction": "background"
+    }
+}
+
+The total size of the cache is kept as a running count in the database, so
+saving a tile never has to add up the whole tiles table. Last-read times are
+buffered in memory and written in batches, so reads don't wait on the SQLite
+write lock. The database is used in write-ahead log mode, with one persistent
+connection per thread.
 """
 
 import os
-import sys
 import time
+import logging
 
 from math import ceil as _ceil
 from tempfile import mkstemp
+from threading import local, Lock, Thread, Event
 from os.path import isdir, exists, dirname, basename, join as pathjoin
 from sqlite3 import connect, OperationalError, IntegrityError
 
@@ -31,82 +81,161 @@ _create_tables = """
         column  INTEGER,
         zoom    INTEGER,
         format  TEXT,
-        
+
         PRIMARY KEY (row, column, zoom, format)
     )
     """, """
     CREATE TABLE IF NOT EXISTS tiles (
         path    TEXT PRIMARY KEY,
         used    INTEGER,
-        size    INTEGER
+        size    INTEGER,
+        layer   TEXT
     )
     """, """
     CREATE INDEX IF NOT EXISTS tiles_used ON tiles (used)
     """
 
+_create_layer_tables = """
+    CREATE INDEX IF NOT EXISTS tiles_layer_used ON tiles (layer, used)
+    """, """
+    CREATE TABLE IF NOT EXISTS usage (
+        layer   TEXT PRIMARY KEY,
+        total   INTEGER
+    )
+    """
+
+# how many last-read times to buffer, and for how long.
+_used_batch = 256
+_used_delay = 10
+
+# how many tiles to evict per query.
+_evict_batch = 64
+
 class Cache:
 
-    def __init__(self, path, limit, umask=0022):
+    def __init__(self, path, limit, umask=0022, low_water=None, quotas=None, eviction='inline', interval=60):
+        if eviction not in ('inline', 'background'):
+            raise Exception('LimitedDisk eviction must be "inline" or "background", not "%s"' % eviction)
+
         self.cachepath = path
         self.dbpath = pathjoin(self.cachepath, 'stache.db')
         self.umask = umask
         self.limit = limit
+        self.low_water = low_water is None and int(limit * .9) or low_water
+        self.quotas = dict(quotas or {})
+        self.eviction = eviction
+        self.interval = interval
+
+        self._local = local()
+        self._used, self._used_lock = {}, Lock()
+        self._used_flushed = time.time()
+
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
 
-        db = connect(self.dbpath).cursor()
-        
         for create_table in _create_tables:
             db.execute(create_table)
 
-        db.connection.close()
+        self._upgrade(db)
+
+        for create_table in _create_layer_tables:
+            db.execute(create_table)
+
+        db.execute('COMMIT')
+
+        if self.eviction == 'background':
+            self._wake = Event()
+
+            evictor = Thread(target=self._work_evictions)
+            evictor.setDaemon(True)
+            evictor.start()
+
+    def _upgrade(self, db):
+        """ Bring a database made by an older version of this cache up to date.
+
+            Older tiles tables lack a layer column, and older usage tables
+            counted a single total rather than one per layer.
+        """
+        columns = [row[1] for row in db.execute('PRAGMA table_info(tiles)')]
+
+        if 'layer' not in columns:
+            db.execute('ALTER TABLE tiles ADD COLUMN layer TEXT')
+
+            paths = [row[0] for row in db.execute('SELECT path FROM tiles')]
+            db.executemany('UPDATE tiles SET layer=? WHERE path=?',
+                           [(path.split(os.sep)[0], path) for path in paths])
+
+        columns = [row[1] for row in db.execute('PRAGMA table_info(usage)')]
+
+        if columns and 'layer' not in columns:
+            db.execute('DROP TABLE usage')
+            columns = []
+
+        if not columns:
+            # count it all up just once.
+            for create_table in _create_layer_tables:
+                db.execute(create_table)
+
+            db.execute("""INSERT INTO usage (layer, total)
+                          SELECT layer, SUM(size) FROM tiles GROUP BY layer""")
+
+    def _db(self):
+        """ Return a persistent database connection for the current thread.
+
+            Connection is in autocommit mode, with explicit transactions
+            wherever more than one statement needs to be atomic.
+        """
+        db = getattr(self._local, 'db', None)
+
+        if db is None:
+            db = connect(self.dbpath, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+
+        return db
 
     def _filepath(self, layer, coord, format):
         """
         """
-        l = layer.name()
+        l = layer.cacheName()
         z = '%d' % coord.zoom
         e = format.lower()
-        
+
         x = '%06d' % coord.column
         y = '%06d' % coord.row
 
         x1, x2 = x[:3], x[3:]
         y1, y2 = y[:3], y[3:]
-        
+
         filepath = os.sep.join( (l, z, x1, x2, y1, y2 + '.' + e) )
 
         return filepath
 
     def lock(self, layer, coord, format):
         """ Acquire a cache lock for this tile.
-        
-            Returns nothing, but (TODO) blocks until the lock has been acquired.
+
+            Returns nothing, but blocks until the lock has been acquired.
             Lock is implemented as a row in the "locks" table.
         """
-        sys.stderr.write('lock %d/%d/%d, %s' % (coord.zoom, coord.column, coord.row, format))
-
         due = time.time() + layer.stale_lock_timeout
-        
+        db = self._db()
+
         while True:
             if time.time() > due:
                 # someone left the door locked.
-                sys.stderr.write('...force %d/%d/%d, %s' % (coord.zoom, coord.column, coord.row, format))
                 self.unlock(layer, coord, format)
-            
-            # try to acquire a lock, repeating if necessary.
-            db = connect(self.dbpath, isolation_level='EXCLUSIVE').cursor()
 
+            # try to acquire a lock, repeating if necessary.
             try:
                 db.execute("""INSERT INTO locks
                               (row, column, zoom, format)
                               VALUES (?, ?, ?, ?)""",
                            (coord.row, coord.column, coord.zoom, format))
             except IntegrityError:
-                db.connection.close()
                 time.sleep(.2)
                 continue
             else:
-                db.connection.commit()
-                db.connection.close()
                 break
 
     def unlock(self, layer, coord, format):
@@ -114,53 +243,81 @@ class Cache:
 
             Lock is implemented as a row in the "locks" table.
         """
-        sys.stderr.write('unlock %d/%d/%d, %s' % (coord.zoom, coord.column, coord.row, format))
-
-        db = connect(self.dbpath, isolation_level='EXCLUSIVE').cursor()
+        db = self._db()
         db.execute("""DELETE FROM locks
                       WHERE row=? AND column=? AND zoom=? AND format=?""",
                    (coord.row, coord.column, coord.zoom, format))
-        db.connection.commit()
-        db.connection.close()
-        
+
     def remove(self, layer, coord, format):
         """ Remove a cached tile.
         """
-        # TODO: write me
-        raise NotImplementedError('LimitedDisk Cache does not yet implement the .remove() method.')
-        
+        path = self._filepath(layer, coord, format)
+
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+
+        try:
+            row = db.execute('SELECT size, layer FROM tiles WHERE path=?', (path, )).fetchone()
+
+            if row:
+                db.execute('DELETE FROM tiles WHERE path=?', (path, ))
+                db.execute('UPDATE usage SET total = total - ? WHERE layer=?', row)
+
+            db.execute('COMMIT')
+
+        except:
+            db.execute('ROLLBACK')
+            raise
+
+        self._remove(path)
+
     def read(self, layer, coord, format):
         """ Read a cached tile.
-        
-            If found, update the used column in the tiles table with current time.
-        """
-        sys.stderr.write('read %d/%d/%d, %s' % (coord.zoom, coord.column, coord.row, format))
 
+            If found, remember the current time as its last-read time, to be
+            written to the tiles table with a batch of others.
+        """
         path = self._filepath(layer, coord, format)
         fullpath = pathjoin(self.cachepath, path)
-        
-        if exists(fullpath):
-            body = open(fullpath, 'r').read()
-
-            sys.stderr.write('...hit %s, set used=%d' % (path, time.time()))
-
-            db = connect(self.dbpath).cursor()
-            db.execute("""UPDATE tiles
-                          SET used=?
-                          WHERE path=?""",
-                       (int(time.time()), path))
-            db.connection.commit()
-            db.connection.close()
-        
-        else:
-            sys.stderr.write('...miss')
-            body = None
+
+        if not exists(fullpath):
+            return None
+
+        body = open(fullpath, 'r').read()
+
+        with self._used_lock:
+            self._used[path] = int(time.time())
+            due = len(self._used) >= _used_batch or time.time() > self._used_flushed + _used_delay
+
+        if due:
+            self._flush_used()
 
         return body
 
+    def flush(self):
+        """ Write buffered last-read times to the tiles table right away.
+        """
+        self._flush_used()
+
+    def _flush_used(self):
+        """ Write buffered last-read times to the tiles table.
+        """
+        with self._used_lock:
+            used, self._used = self._used, {}
+            self._used_flushed = time.time()
+
+        if not used:
+            return
+
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        db.executemany('UPDATE tiles SET used=? WHERE path=?',
+                       [(when, path) for (path, when) in used.items()])
+        db.execute('COMMIT')
+
     def _write(self, body, path, format):
         """ Actually write the file to the cache directory, return its size.
-        
+
             If filesystem block size is known, try to return actual disk space used.
         """
         fullpath = pathjoin(self.cachepath, path)
@@ -177,7 +334,7 @@ class Cache:
         fh, tmp_path = mkstemp(dir=self.cachepath, suffix='.' + format.lower())
         os.write(fh, body)
         os.close(fh)
-        
+
         try:
             os.rename(tmp_path, fullpath)
         except OSError:
@@ -185,10 +342,10 @@ class Cache:
             os.rename(tmp_path, fullpath)
 
         os.chmod(fullpath, 0666&~self.umask)
-        
+
         stat = os.stat(fullpath)
         size = stat.st_size
-        
+
         if hasattr(stat, 'st_blksize'):
             blocks = _ceil(size / float(stat.st_blksize))
             size = int(blocks * stat.st_blksize)
@@ -200,45 +357,134 @@ class Cache:
         """
         fullpath = pathjoin(self.cachepath, path)
 
-        os.unlink(fullpath)
-    
-    def save(self, body, layer, coord, format):
+        try:
+            os.unlink(fullpath)
+        except OSError, e:
+            # errno=2 means that the file does not exist, which is fine
+            if e.errno != 2:
+                raise
+
+    def _evict(self, layer_name, target):
+        """ Remove least-recently used tiles in batches down to a target size.
+
+            Layer name limits eviction to a single layer, or None for all.
         """
+        db = self._db()
+
+        if layer_name is None:
+            total_q, rows_q, args = 'SELECT SUM(total) FROM usage', 'SELECT path, size, layer FROM tiles ORDER BY used ASC LIMIT ?', ()
+        else:
+            total_q, rows_q, args = 'SELECT total FROM usage WHERE layer=?', 'SELECT path, size, layer FROM tiles WHERE layer=? ORDER BY used ASC LIMIT ?', (layer_name, )
+
+        while True:
+            db.execute('BEGIN IMMEDIATE')
+
+            try:
+                row = db.execute(total_q, args).fetchone()
+                total = row and row[0] or 0
+
+                if total <= target:
+                    db.execute('COMMIT')
+                    break
+
+                rows = db.execute(rows_q, args + (_evict_batch, )).fetchall()
+                evicted = []
+
+                for (path, size, layer) in rows:
+                    if total <= target:
+                        break
+
+                    evicted.append(path)
+                    db.execute('UPDATE usage SET total = total - ? WHERE layer=?', (size, layer))
+                    total -= size
+
+                db.executemany('DELETE FROM tiles WHERE path=?', [(path, ) for path in evicted])
+                db.execute('COMMIT')
+
+            except:
+                db.execute('ROLLBACK')
+                raise
+
+            for path in evicted:
+                self._remove(path)
+
+            if not rows:
+                break
+
+    def _over(self):
+        """ Return true if the cache or any layer with a quota is too big.
+        """
+        totals = dict(self._db().execute('SELECT layer, total FROM usage').fetchall())
+
+        if sum(totals.values()) > self.limit:
+            return True
+
+        for (layer_name, quota) in self.quotas.items():
+            if totals.get(layer_name, 0) > quota:
+                return True
+
+        return False
+
+    def trim(self):
+        """ Trim any layers over quota and then the whole cache, if needed.
+
+            Each is trimmed down to its low-water mark, in proportion to
+            the low-water mark of the whole cache.
+        """
+        self._flush_used()
+        ratio = float(self.low_water) / self.limit
+
+        for (layer_name, quota) in self.quotas.items():
+            self._evict(layer_name, int(quota * ratio))
+
+        self._evict(None, self.low_water)
+
+    def _work_evictions(self):
+        """ Trim the cache whenever it's too big, forever.
+        """
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+            try:
+                if self._over():
+                    self.trim()
+            except:
+                logging.exception('TileStache.Goodies.Caches.LimitedDisk._work_evictions() failed to trim the cache')
+
+    def save(self, body, layer, coord, format):
+        """ Save a cached tile.
+
+            Adjusts the running total size, and trims the cache if it's too big.
         """
-        sys.stderr.write('save %d/%d/%d, %s' % (coord.zoom, coord.column, coord.row, format))
-        
         path = self._filepath(layer, coord, format)
         size = self._write(body, path, format)
+        layer_name = layer.name()
+
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
 
-        db = connect(self.dbpath).cursor()
-        
         try:
-            db.execute("""INSERT INTO tiles
-                          (size, used, path)
-                          VALUES (?, ?, ?)""",
-                       (size, int(time.time()), path))
-        except IntegrityError:
-            db.execute("""UPDATE tiles
-                          SET size=?, used=?
-                          WHERE path=?""",
-                       (size, int(time.time()), path))
-        
-        row = db.execute('SELECT SUM(size) FROM tiles').fetchone()
-        
-        if row and (row[0] > self.limit):
-            over = row[0] - self.limit
-            
-            while over > 0:
-                row = db.execute('SELECT path, size FROM tiles ORDER BY used ASC LIMIT 1').fetchone()
-                
-                if row is None:
-                    break
+            row = db.execute('SELECT size FROM tiles WHERE path=?', (path, )).fetchone()
+            old_size = row and row[0] or 0
 
-                path, size = row
-                db.execute('DELETE FROM tiles WHERE path=?', (path, ))
-                self._remove(path)
-                over -= size
-                sys.stderr.write('delete ' + path)
-        
-        db.connection.commit()
-        db.connection.close()
+            db.execute("""REPLACE INTO tiles
+                          (size, used, path, layer)
+                          VALUES (?, ?, ?, ?)""",
+                       (size, int(time.time()), path, layer_name))
+
+            db.execute('INSERT OR IGNORE INTO usage (layer, total) VALUES (?, 0)', (layer_name, ))
+            db.execute('UPDATE usage SET total = total + ? WHERE layer=?', (size - old_size, layer_name))
+            db.execute('COMMIT')
+
+        except:
+            db.execute('ROLLBACK')
+            raise
+
+        if not self._over():
+            return
+
+        if self.eviction == 'background':
+            self._wake.set()
+        else:
+            self.trim()
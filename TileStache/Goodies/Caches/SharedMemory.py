@@ -0,0 +1,369 @@
+""" Cache that shares recently-used tiles between processes on one host.
+
+This cache keeps tiles in a fixed-size memory-mapped file, so that every worker
+process of a preforking server (gunicorn, uWSGI, etc.) sees tiles rendered by
+the others, without a network hop to Memcache. Put the file on a memory-backed
+filesystem such as /dev/shm to keep it out of disk I/O altogether.
+
+Example TileStache cache configuration, with a 256MB table:
+
+"cache":
+{
+    "class": "TileStache.Goodies.Caches.SharedMemory:Cache",
+    "kwargs": {
+        "path": "/dev/shm/tilestache.cache",
+        "size": 268435456
+    }
+}
+
+Cache parameters:
+
+  path
+    Required local file path for the shared table. It's created if missing,
+    and replaced with a new, empty file if it was made with different
+    parameters. Processes still using the old file keep it until they exit.
+
+  size
+    Optional number of bytes in the table. Defaults to 64MB.
+
+  slabs
+    Optional list of slot sizes in bytes, one for each slab class. The table
+    is split evenly between classes, and each tile is stored in the smallest
+    slot that fits it. Tiles larger than the largest slot aren't cached.
+    Defaults to [4096, 16384, 65536].
+
+The table is a set-associative hash table: each tile key hashes to one set of
+eight slots in each slab class, and a full set gives up a slot using the CLOCK
+algorithm, so recently read tiles tend to stay. Sets are guarded by a fixed
+number of lock stripes using fcntl() byte-range locks, which the kernel drops
+when a process dies. Each set of each slab class has one stripe, and a tile
+takes the stripes of all its sets, in order. Every slot has a CRC32 checksum written after its content,
+so a slot half-written by a killed worker reads as empty rather than corrupt.
+
+Tile render locks are fcntl() locks too, and are likewise released by the
+kernel if a worker is killed mid-render.
+"""
+
+import os
+import mmap
+import fcntl
+
+from os.path import dirname
+from tempfile import mkstemp
+
+from time import time
+from zlib import crc32
+from hashlib import md5
+from struct import pack, unpack, calcsize
+from threading import Lock
+
+_magic = 'TSSM'
+_version = 1
+
+# magic, version, size, number of slab classes, then slot size and set count per class.
+_header = '<4sIQI'
+_header_length = 4096
+
+# slot key hash, saved time, content length, checksum, CLOCK reference bit.
+_slot = '<QdIIB7x'
+_slot_length = calcsize(_slot)
+
+_ways = 8
+_stripes = 256
+
+# byte offsets of fcntl() lock ranges, beyond the end of any real table.
+_stripe_locks = 2**40
+_render_locks = 2**41
+
+def _hash(layer, coord, format):
+    """ Return a non-zero 64-bit hash for a tile.
+    """
+    key = '%s/%d/%d/%d.%s' % (layer.cacheName(), coord.zoom, coord.column, coord.row, format.lower())
+    value = unpack('<Q', md5(key).digest()[:8])[0]
+
+    return value or 1
+
+def _checksum(key_hash, saved, body):
+    """ Return an unsigned CRC32 checksum of slot contents.
+    """
+    return crc32(pack('<Qd', key_hash, saved) + body) & 0xffffffff
+
+class Cache:
+    """
+    """
+    def __init__(self, path, size=64*1024*1024, slabs=(4096, 16384, 65536)):
+        self.path = path
+        self.size = int(size)
+        self.slabs = sorted([int(slot_size) for slot_size in slabs])
+
+        # slot size, set count, and byte offset for each slab class.
+        self.classes = []
+        offset = _header_length
+        share = (self.size - offset) / len(self.slabs)
+
+        for slot_size in self.slabs:
+            sets = share / ((_slot_length + slot_size) * _ways + 1)
+
+            if sets < 1:
+                raise Exception('SharedMemory cache size of %d bytes is too small for %d byte slots' % (self.size, slot_size))
+
+            self.classes.append((slot_size, sets, offset))
+            offset += sets + (_slot_length + slot_size) * _ways * sets
+
+        self._thread_stripes = [Lock() for i in range(_stripes)]
+        self._thread_renders, self._thread_renders_lock = {}, Lock()
+
+        self._fd = self._open()
+        self._map = mmap.mmap(self._fd, self.size)
+
+    def _open(self):
+        """ Open the table file, replacing it first if its header doesn't match.
+
+            Returns a file descriptor. A mismatched file is never changed in
+            place, since other processes may still have it mapped and would
+            crash on access to a truncated file. A new file is renamed over
+            it instead.
+        """
+        classes = ''.join([pack('<IQ', slot_size, sets) for (slot_size, sets, o) in self.classes])
+        header = pack(_header, _magic, _version, self.size, len(self.classes)) + classes
+
+        while True:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0666)
+            fcntl.lockf(fd, fcntl.LOCK_EX, 1, 0)
+
+            try:
+                if os.fstat(fd).st_ino == os.stat(self.path).st_ino:
+                    os.lseek(fd, 0, os.SEEK_SET)
+
+                    if os.read(fd, len(header)) == header and os.fstat(fd).st_size == self.size:
+                        return fd
+
+                    self._replace(fd, header)
+
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN, 1, 0)
+
+            # the file was replaced, by us or by another process, so open it again.
+            os.close(fd)
+
+    def _replace(self, fd, header):
+        """ Rename a new, empty table file over the old one.
+        """
+        # a new file is all zeroes, so every slot starts out empty.
+        new_fd, new_path = mkstemp(dir=dirname(self.path) or '.', suffix='.tmp')
+
+        try:
+            os.ftruncate(new_fd, self.size)
+            os.write(new_fd, header)
+            os.fchmod(new_fd, os.fstat(fd).st_mode & 0777)
+            os.rename(new_path, self.path)
+        finally:
+            os.close(new_fd)
+
+            if os.path.exists(new_path):
+                os.unlink(new_path)
+
+    def _stripes_for(self, key_hash):
+        """ Return a sorted list of stripes for the sets of a key hash.
+
+            Each set of each slab class always has the same stripe, so that
+            two keys in one set never change it at the same time.
+        """
+        return sorted(set([(offset + key_hash % sets) % _stripes
+                           for (slot_size, sets, offset) in self.classes]))
+
+    def _acquire_stripe(self, key_hash):
+        """ Lock the stripes for a key hash against other threads and processes.
+
+            Stripes are always taken in order, so that keys sharing some
+            of their stripes can't deadlock.
+        """
+        taken = []
+
+        try:
+            for stripe in self._stripes_for(key_hash):
+                self._thread_stripes[stripe].acquire()
+
+                try:
+                    fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, _stripe_locks + stripe)
+                except:
+                    self._thread_stripes[stripe].release()
+                    raise
+
+                taken.append(stripe)
+        except:
+            self._unlock_stripes(taken)
+            raise
+
+    def _release_stripe(self, key_hash):
+        """ Unlock the stripes for a key hash.
+        """
+        self._unlock_stripes(self._stripes_for(key_hash))
+
+    def _unlock_stripes(self, stripes):
+        for stripe in reversed(stripes):
+            try:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, _stripe_locks + stripe)
+            finally:
+                self._thread_stripes[stripe].release()
+
+    def _slots(self, key_hash):
+        """ Generate slot size, hand offset, and slot offsets for a key hash.
+
+            One tuple is generated for each slab class.
+        """
+        for (slot_size, sets, offset) in self.classes:
+            index = key_hash % sets
+            hand = offset + index
+            first = offset + sets + index * (_slot_length + slot_size) * _ways
+            slots = [first + way * (_slot_length + slot_size) for way in range(_ways)]
+
+            yield slot_size, hand, slots
+
+    def _clear(self, key_hash):
+        """ Empty every slot holding a key hash. Stripe must be locked.
+        """
+        for (slot_size, hand, slots) in self._slots(key_hash):
+            for slot in slots:
+                if unpack('<Q', self._map[slot:slot+8])[0] == key_hash:
+                    self._map[slot:slot+8] = pack('<Q', 0)
+
+    def lock(self, layer, coord, format):
+        """ Acquire a cache lock for this tile.
+
+            Returns nothing, but blocks until the lock has been acquired.
+        """
+        key_hash = _hash(layer, coord, format)
+
+        with self._thread_renders_lock:
+            lock, count = self._thread_renders.get(key_hash, (None, 0))
+            lock = lock or Lock()
+            self._thread_renders[key_hash] = lock, count + 1
+
+        lock.acquire()
+
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, _render_locks + key_hash % 2**40)
+        except:
+            self.unlock(layer, coord, format)
+            raise
+
+    def unlock(self, layer, coord, format):
+        """ Release a cache lock for this tile.
+        """
+        key_hash = _hash(layer, coord, format)
+
+        with self._thread_renders_lock:
+            if key_hash not in self._thread_renders:
+                return
+
+            lock, count = self._thread_renders[key_hash]
+
+            if count > 1:
+                self._thread_renders[key_hash] = lock, count - 1
+            else:
+                del self._thread_renders[key_hash]
+
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, _render_locks + key_hash % 2**40)
+        finally:
+            lock.release()
+
+    def remove(self, layer, coord, format):
+        """ Remove a cached tile.
+        """
+        key_hash = _hash(layer, coord, format)
+        self._acquire_stripe(key_hash)
+
+        try:
+            self._clear(key_hash)
+        finally:
+            self._release_stripe(key_hash)
+
+    def read(self, layer, coord, format):
+        """ Read a cached tile.
+
+            Slots with a bad checksum are treated as empty.
+        """
+        key_hash = _hash(layer, coord, format)
+        self._acquire_stripe(key_hash)
+
+        try:
+            for (slot_size, hand, slots) in self._slots(key_hash):
+                for slot in slots:
+                    head = self._map[slot:slot+_slot_length]
+                    slot_hash, saved, length, checksum, used = unpack(_slot, head)
+
+                    if slot_hash != key_hash or length > slot_size:
+                        continue
+
+                    start = slot + _slot_length
+                    body = self._map[start:start+length]
+
+                    if _checksum(slot_hash, saved, body) != checksum:
+                        # a write was interrupted, most likely by a dead process.
+                        self._map[slot:slot+8] = pack('<Q', 0)
+                        continue
+
+                    if layer.cache_lifespan and time() - saved > layer.cache_lifespan:
+                        return None
+
+                    if not used:
+                        self._map[slot:slot+_slot_length] = pack(_slot, slot_hash, saved, length, checksum, 1)
+
+                    return body
+
+            return None
+
+        finally:
+            self._release_stripe(key_hash)
+
+    def save(self, body, layer, coord, format):
+        """ Save a cached tile.
+
+            Slot is chosen from the smallest slab class that fits the tile,
+            using the CLOCK algorithm if all the slots in its set are full.
+        """
+        key_hash = _hash(layer, coord, format)
+        saved = time()
+
+        self._acquire_stripe(key_hash)
+
+        try:
+            self._clear(key_hash)
+
+            for (slot_size, hand, slots) in self._slots(key_hash):
+                if len(body) <= slot_size:
+                    break
+            else:
+                # too big for any slot.
+                return
+
+            way = ord(self._map[hand]) % _ways
+
+            for other in range(_ways):
+                if unpack('<Q', self._map[slots[other]:slots[other]+8])[0] == 0:
+                    # an empty slot is as good as it gets.
+                    way = other
+                    break
+            else:
+                while True:
+                    slot_hash, s, length, checksum, used = unpack(_slot, self._map[slots[way]:slots[way]+_slot_length])
+
+                    if not used:
+                        break
+
+                    self._map[slots[way]:slots[way]+_slot_length] = pack(_slot, slot_hash, s, length, checksum, 0)
+                    way = (way + 1) % _ways
+
+                self._map[hand] = chr((way + 1) % _ways)
+
+            slot, start = slots[way], slots[way] + _slot_length
+
+            # empty the slot first, and write the header last.
+            self._map[slot:slot+8] = pack('<Q', 0)
+            self._map[start:start+len(body)] = body
+            self._map[slot:slot+_slot_length] = pack(_slot, key_hash, saved, len(body), _checksum(key_hash, saved, body), 0)
+
+        finally:
+            self._release_stripe(key_hash)
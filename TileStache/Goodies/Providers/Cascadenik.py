@@ -25,22 +25,21 @@ class Provider (ImageProvider):
     
         - workdir (optional)
             Directory path for working files, tempfile.gettempdir() by default.
+    
+        - pool_size, global_lock (optional)
+            Same as for Mapnik.ImageProvider.
     """
-    def __init__(self, layer, mapfile, fonts=None, workdir=None):
+    def __init__(self, layer, mapfile, fonts=None, workdir=None, pool_size=None, global_lock=False):
         """ Initialize Cascadenik provider with layer and mapfile.
         """
         self.workdir = workdir or gettempdir()
-        self.mapnik = None
 
-        ImageProvider.__init__(self, layer, mapfile, fonts)
+        ImageProvider.__init__(self, layer, mapfile, fonts, pool_size, global_lock)
 
-    def renderArea(self, width, height, srs, xmin, ymin, xmax, ymax, coord, tile_scale):
-        """ Mostly hand off functionality to Mapnik.ImageProvider.renderArea()
+    def loadMap(self):
+        """ Return a new mapnik.Map for the pool, loaded from the MML file.
         """
-        zoom = coord.zoom
-
-        if self.mapnik is None:
-            self.mapnik = mapnik.Map(0, 0)
-            load_map(self.mapnik, str(self.mapfile), self.workdir, cache_dir=self.workdir)
+        mmap = mapnik.Map(0, 0)
+        load_map(mmap, str(self.mapfile), self.workdir, cache_dir=self.workdir)
         
-        return ImageProvider.renderArea(self, width, height, srs, xmin, ymin, xmax, ymax, zoom)
+        return mmap
@@ -0,0 +1,251 @@
+""" Inventory of cached tiles, for existence checks and statistics.
+
+None of the caches can say which tiles they have without a read for each one.
+The Inventory cache wraps another cache and keeps an index of its tiles in a
+small SQLite file, updated as tiles are saved and removed, so that questions
+like "which tiles of this metatile are cached?" or "how many bytes of zoom 14
+are there?" are a quick indexed query instead.
+
+Example configuration:
+
+    "cache": {
+      "name": "Inventory",
+      "path": "/var/cache/tilestache-inventory.db",
+      "cache": {
+        "name": "S3",
+        "bucket": "<bucket name>",
+        "access": "<access key>",
+        "secret": "<secret key>"
+      }
+    }
+
+Inventory cache parameters:
+
+  path
+    Required local path to the SQLite index file, created if necessary.
+
+  cache
+    Required configuration of the cache to keep an inventory of.
+
+  trust
+    Optional boolean flag for whether to believe the index about missing
+    tiles, and answer cache reads for them without asking the cache. Only
+    useful when nothing else writes to the cache. False by default.
+
+The index only knows about tiles saved through it, so it starts out empty in
+front of an existing cache. It can be rebuilt from a complete listing of a
+cache with a listTiles() method, such as Disk, S3, or the MBTiles cache. The
+script tilestache-inventory.py rebuilds indexes and prints tile counts, zoom
+level coverage, and byte totals, and tilestache-seed.py uses an index to skip
+tiles that are already cached with its --skip-existing option.
+
+Tiles are indexed under the layer name their cache uses, including any cache
+generation, see TileStache.Generations. Each thread keeps its own connection
+to the index, and several processes can share one index file.
+"""
+from threading import local
+from itertools import islice
+
+# Heroku is missing standard python's sqlite3 package, so this will ImportError.
+from sqlite3 import connect as _connect, OperationalError
+
+from ModestMaps.Core import Coordinate
+
+from .Core import KnownUnknown
+from .Generations import split_cache_name
+
+# rows written to the index at a time by rebuild().
+_rebuild_batch = 1000
+
+_create_table = """CREATE TABLE IF NOT EXISTS %s
+                   (
+                     layer TEXT, format TEXT,
+                     zoom_level INTEGER, tile_row INTEGER, tile_column INTEGER,
+                     size INTEGER,
+                     PRIMARY KEY (layer, format, zoom_level, tile_row, tile_column)
+                   )"""
+
+_replace_tile = 'REPLACE INTO tiles (layer, format, zoom_level, tile_row, tile_column, size) VALUES (?, ?, ?, ?, ?, ?)'
+_rebuild_tile = 'REPLACE INTO tiles_rebuild (layer, format, zoom_level, tile_row, tile_column, size) VALUES (?, ?, ?, ?, ?, ?)'
+_delete_tile = 'DELETE FROM tiles WHERE layer=? AND format=? AND zoom_level=? AND tile_row=? AND tile_column=?'
+_select_tile = 'SELECT 1 FROM tiles WHERE layer=? AND format=? AND zoom_level=? AND tile_row=? AND tile_column=?'
+_delete_block = """DELETE FROM tiles
+                   WHERE layer=? AND format=? AND zoom_level=?
+                     AND tile_row BETWEEN ? AND ? AND tile_column BETWEEN ? AND ?"""
+_select_block = """SELECT tile_row, tile_column FROM tiles
+                   WHERE layer=? AND format=? AND zoom_level=?
+                     AND tile_row BETWEEN ? AND ? AND tile_column BETWEEN ? AND ?"""
+
+class Cache:
+    """ Cache wrapper that keeps an index of tiles in another cache.
+    """
+    def __init__(self, path, cache, trust=False):
+        self.path = path
+        self.cache = cache
+        self.trust = bool(trust)
+
+        self._local = local()
+        self._db().execute(_create_table % 'tiles')
+
+    def _db(self):
+        """ Return a persistent connection for the current thread.
+        """
+        if not hasattr(self._local, 'db'):
+            db = _connect(self.path, timeout=60, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+
+        return self._local.db
+
+    def lock(self, layer, coord, format):
+        return self.cache.lock(layer, coord, format)
+
+    def unlock(self, layer, coord, format):
+        return self.cache.unlock(layer, coord, format)
+
+    def remove(self, layer, coord, format):
+        """ Remove a cached tile, and forget it.
+        """
+        self.cache.remove(layer, coord, format)
+
+        key = layer.cacheName(), format.lower(), coord.zoom, coord.row, coord.column
+        self._db().execute(_delete_tile, key)
+
+    def removeTiles(self, layer, format, zoom, row1, column1, row2, column2):
+        """ Remove cached tiles in a range of rows and columns, and forget them.
+        """
+        from .Caches import removeTiles
+
+        removeTiles(self.cache, layer, format, zoom, row1, column1, row2, column2)
+
+        key = layer.cacheName(), format.lower(), zoom, row1, row2, column1, column2
+        self._db().execute(_delete_block, key)
+
+    def removeGenerations(self, layer):
+        """ Remove tiles cached under other generations of a layer, and forget them.
+        """
+        if hasattr(self.cache, 'removeGenerations'):
+            self.cache.removeGenerations(layer)
+
+        layer_name, current = split_cache_name(layer.cacheName())
+        db = self._db()
+
+        for (cache_name, ) in db.execute('SELECT DISTINCT layer FROM tiles').fetchall():
+            name, generation = split_cache_name(cache_name)
+
+            if name == layer_name and generation != current:
+                db.execute('DELETE FROM tiles WHERE layer=?', (cache_name, ))
+
+    def read(self, layer, coord, format):
+        """ Read a cached tile, or skip the read if trusting the index about a missing one.
+        """
+        if self.trust and not self.has(layer, coord, format):
+            return None
+
+        return self.cache.read(layer, coord, format)
+
+    def save(self, body, layer, coord, format):
+        """ Save a cached tile, and remember it.
+        """
+        self.cache.save(body, layer, coord, format)
+
+        key = layer.cacheName(), format.lower(), coord.zoom, coord.row, coord.column
+        self._db().execute(_replace_tile, key + (len(body), ))
+
+    def has(self, layer, coord, format):
+        """ Return true if a tile is in the index.
+        """
+        key = layer.cacheName(), format.lower(), coord.zoom, coord.row, coord.column
+        return self._db().execute(_select_tile, key).fetchone() is not None
+
+    def existingTiles(self, layer, format, zoom, row1, column1, row2, column2):
+        """ Return a set of (row, column) tiles in the index from a range of tiles.
+        """
+        key = layer.cacheName(), format.lower(), zoom, row1, row2, column1, column2
+        return set(self._db().execute(_select_block, key).fetchall())
+
+    def listTiles(self, sizes=False):
+        """ Generate a (layer name, coordinate, format) tuple for every indexed tile.
+
+            With sizes, tuples have a fourth member for the size in bytes.
+        """
+        rows = self._db().execute('SELECT layer, format, zoom_level, tile_row, tile_column, size FROM tiles')
+
+        for (name, format, zoom, row, column, size) in rows:
+            if sizes:
+                yield name, Coordinate(row, column, zoom), format, size
+            else:
+                yield name, Coordinate(row, column, zoom), format
+
+    def rebuild(self):
+        """ Replace the index with a complete listing of the cache.
+
+            The cache must provide a listTiles() method with a sizes argument,
+            which may take a while. The new index is built in a table of its
+            own, a batch of rows at a time, so that tiles can go on being saved
+            and removed meanwhile. It replaces the old one once complete, along
+            with any tiles saved to the old one since the rebuild began.
+        """
+        if not hasattr(self.cache, 'listTiles'):
+            raise KnownUnknown('Cache %s has no listTiles() method, so its inventory cannot be rebuilt.' % self.cache.__class__.__name__)
+
+        tiles = self.cache.listTiles(sizes=True)
+        rows = ((name, format.lower(), coord.zoom, coord.row, coord.column, size)
+                for (name, coord, format, size) in tiles)
+
+        db = self._db()
+        db.execute('DROP TABLE IF EXISTS tiles_rebuild')
+        db.execute(_create_table % 'tiles_rebuild')
+
+        # saved tiles are replaced with new rows, which come after this one.
+        last_row = db.execute('SELECT MAX(rowid) FROM tiles').fetchone()[0] or 0
+
+        try:
+            while True:
+                # list outside of a transaction, to keep the index unlocked.
+                batch = list(islice(rows, _rebuild_batch))
+
+                if not batch:
+                    break
+
+                db.execute('BEGIN')
+                db.executemany(_rebuild_tile, batch)
+                db.execute('COMMIT')
+
+            db.execute('BEGIN IMMEDIATE')
+            db.execute('REPLACE INTO tiles_rebuild SELECT * FROM tiles WHERE rowid > ?', (last_row, ))
+            db.execute('DROP TABLE tiles')
+            db.execute('ALTER TABLE tiles_rebuild RENAME TO tiles')
+            db.execute('COMMIT')
+
+        except:
+            try:
+                db.execute('ROLLBACK')
+            except OperationalError:
+                # no transaction was open.
+                pass
+
+            db.execute('DROP TABLE IF EXISTS tiles_rebuild')
+            raise
+
+    def stats(self, layer_name=None):
+        """ Return a list of per-zoom statistics dictionaries.
+
+            Each has "layer", "format", "zoom", "tiles", "coverage" of the
+            whole world at that zoom as a fraction, and "bytes", optionally
+            limited to layers cached under a given name. Bytes are None for
+            tiles of unknown size.
+        """
+        q = 'SELECT layer, format, zoom_level, COUNT(*), SUM(size) FROM tiles'
+        args = ()
+
+        if layer_name is not None:
+            q += ' WHERE layer=?'
+            args = (layer_name, )
+
+        q += ' GROUP BY layer, format, zoom_level ORDER BY layer, format, zoom_level'
+
+        return [dict(layer=name, format=format, zoom=zoom, tiles=count, bytes=size,
+                     coverage=float(count) / 4**zoom)
+                for (name, format, zoom, count, size) in self._db().execute(q, args)]
@@ -0,0 +1,187 @@
+""" Completion journal for resumable seeding.
+
+A journal is a directory with one small bitmap file per zoom level, with a bit
+for each metatile in the area being seeded. A bit is set once every tile of its
+metatile has been seeded, so that a seeding run that dies after days of work
+can be started again with tilestache-seed.py --resume and skip straight past
+the finished metatiles, without reading a single tile from the cache.
+
+Each file starts with a header describing the area and metatile size it was
+made for, and a journal can only be resumed for the same ones. Bitmap files
+are created whole under a temporary name and then moved into place, and are
+mapped into memory for updates. Bits are only ever set, never cleared, so a
+crash at any point leaves each file with some subset of the finished metatiles
+marked, and at worst a few of them are seeded again. Files are flushed to disk
+every few seconds and when the journal is closed.
+
+Journals are written by a single process, the one handing out work.
+"""
+import os
+import struct
+
+from os.path import join, exists, getsize
+from mmap import mmap
+from time import time
+
+from .Core import KnownUnknown
+
+# magic, metatile rows and columns, area top row, left column, bottom row, right column.
+_header = struct.Struct('<4sHHiiii')
+_magic = 'TSJ1'
+
+class _Bitmap:
+    """ Completion bits for metatiles in one zoom level.
+    """
+    def __init__(self, path, rows, columns, area, resume):
+        row1, col1, row2, col2 = area
+
+        # bounds of the area in whole metatiles.
+        self.xmin, self.ymin = col1 // columns, row1 // rows
+        self.width = col2 // columns + 1 - self.xmin
+        self.height = row2 // rows + 1 - self.ymin
+
+        header = _header.pack(_magic, rows, columns, row1, col1, row2, col2)
+        length = _header.size + (self.width * self.height + 7) // 8
+
+        if not (resume and exists(path)):
+            _create(path, header, length)
+
+        elif getsize(path) != length or open(path, 'rb').read(_header.size) != header:
+            raise KnownUnknown('Journal file %s was made for a different area or metatile size, so it cannot be resumed.' % path)
+
+        self.file = open(path, 'r+b')
+        self.bits = mmap(self.file.fileno(), length)
+
+    def _position(self, x, y):
+        """ Return byte offset and bit mask for a metatile.
+        """
+        index = (y - self.ymin) * self.width + (x - self.xmin)
+        return _header.size + (index >> 3), 1 << (index & 7)
+
+    def isDone(self, x, y):
+        offset, mask = self._position(x, y)
+        return bool(ord(self.bits[offset]) & mask)
+
+    def setDone(self, x, y):
+        offset, mask = self._position(x, y)
+        self.bits[offset] = chr(ord(self.bits[offset]) | mask)
+
+    def flush(self):
+        self.bits.flush()
+
+    def close(self):
+        self.bits.close()
+        self.file.close()
+
+def _create(path, header, length):
+    """ Create an empty bitmap file with a header, replacing any old one.
+    """
+    tmp_path = path + '.tmp'
+    file = open(tmp_path, 'wb')
+
+    try:
+        file.write(header)
+        file.truncate(length)
+        file.flush()
+        os.fsync(file.fileno())
+    finally:
+        file.close()
+
+    os.rename(tmp_path, path)
+
+class Journal:
+    """ Completion journal for a seeding run.
+
+        Constructor arguments:
+        - dirpath: directory for bitmap files, created if necessary.
+        - metatile: Core.Metatile of the layer being seeded.
+        - areas: list of (zoom, top row, left column, bottom row, right column)
+          tile areas being seeded, e.g. from Seeding.tileAreas() or
+          Seeding.geometryAreas().
+        - resume: keep finished work from an existing journal, instead of
+          starting afresh.
+        - interval: seconds between flushes to disk, default 5.
+
+        Metatiles are announced with expect() as their tiles are handed out,
+        tiles are reported one at a time with tileDone() and tileFailed(), and
+        a metatile is marked done when all of its expected tiles are.
+    """
+    def __init__(self, dirpath, metatile, areas, resume=False, interval=5):
+        if not exists(dirpath):
+            os.makedirs(dirpath)
+
+        self.rows, self.columns = metatile.rows, metatile.columns
+        self.interval = interval
+
+        self._areas = dict([(area[0], area[1:]) for area in areas])
+        self._bitmaps = {}
+
+        # remaining tile counts of metatiles in progress.
+        self._remaining = {}
+        self._flushed = time()
+
+        for (zoom, area) in self._areas.items():
+            path = join(dirpath, '%d.journal' % zoom)
+            self._bitmaps[zoom] = _Bitmap(path, self.rows, self.columns, area, resume)
+
+    def isDone(self, zoom, x, y):
+        """ Return true if the metatile at x, y in metatile units is done.
+        """
+        return self._bitmaps[zoom].isDone(x, y)
+
+    def expect(self, zoom, x, y, count):
+        """ Note the number of tiles to be seeded in a metatile.
+
+            Called for each metatile as its tiles are handed out. A metatile
+            with no tiles left to seed is done right away.
+        """
+        if count > 0:
+            self._remaining[(zoom, x, y)] = count
+        else:
+            self._bitmaps[zoom].setDone(x, y)
+
+    def tileDone(self, coord):
+        """ Note a successfully seeded tile.
+        """
+        zoom = coord.zoom
+        x, y = int(coord.column) // self.columns, int(coord.row) // self.rows
+        key = zoom, x, y
+
+        if key not in self._remaining:
+            # failed already, or not expected at all.
+            return
+
+        self._remaining[key] -= 1
+
+        if self._remaining[key] > 0:
+            return
+
+        del self._remaining[key]
+        self._bitmaps[zoom].setDone(x, y)
+
+        if time() - self._flushed > self.interval:
+            self.flush()
+
+    def tileFailed(self, coord):
+        """ Note a tile that failed, leaving its metatile to be seeded again.
+        """
+        key = coord.zoom, int(coord.column) // self.columns, int(coord.row) // self.rows
+
+        self._remaining.pop(key, None)
+
+    def flush(self):
+        """ Write marked metatiles to disk.
+        """
+        for bitmap in self._bitmaps.values():
+            bitmap.flush()
+
+        self._flushed = time()
+
+    def close(self):
+        """ Flush and close all bitmap files.
+        """
+        for bitmap in self._bitmaps.values():
+            bitmap.flush()
+            bitmap.close()
+
+        self._bitmaps = {}
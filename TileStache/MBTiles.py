@@ -34,16 +34,41 @@ MBTiles provider parameters:
 
   tileset:
     Required local file path to MBTiles tileset file, a SQLite 3 database file.
+
+  prefetch:
+    Optional size of a square block of tiles to read all at once, in tiles.
+    When a tile is requested, the rest of its block is read in the same query
+    and kept briefly in memory, where requests for neighboring tiles find it.
+    Useful when a client asks for whole screens of tiles at a time. Defaults
+    to 1, or no prefetching.
+
+The provider keeps one read-only connection per thread open for the life of
+the process, and reads the tileset format from its metadata only once.
 """
+import atexit
 import logging
+from time import time, sleep
+from threading import Thread, Lock, Event, local
+from Queue import Queue, Empty, Full
 from urlparse import urlparse, urljoin
 from os.path import exists
 
 # Heroku is missing standard python's sqlite3 package, so this will ImportError.
-from sqlite3 import connect as _connect
+from sqlite3 import connect as _connect, OperationalError
 
 from ModestMaps.Core import Coordinate
 
+from .Core import KnownUnknown, Metatile, _addRecentTile, _getRecentTile
+
+# bytes of tileset to memory-map for reading.
+_mmap_size = 256 * 1024 * 1024
+
+# constant statements, so that sqlite3 prepares each just once per connection.
+_select_tile = 'SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?'
+_select_block = """SELECT tile_column, tile_row, tile_data FROM tiles
+                   WHERE zoom_level=? AND tile_column BETWEEN ? AND ?
+                     AND tile_row BETWEEN ? AND ?"""
+
 def create_tileset(filename, name, type, version, description, format, bounds=None):
     """ Create a tileset 1.1 with the given filename and metadata.
     
@@ -147,6 +172,59 @@ def list_tiles(filename, flip_y=True):
     
     return tiles
 
+def _tile_queries(db, zooms=None, bounds=None, flip_y=True):
+    """ Generate SQL conditions and arguments selecting tiles one zoom at a time.
+    
+        Bounds are a pair of upper-left and lower-right coordinates, or None.
+    """
+    if zooms is None:
+        zooms = [zoom for (zoom, ) in db.execute('SELECT DISTINCT zoom_level FROM tiles')]
+    
+    for zoom in sorted(zooms):
+        if bounds is None:
+            yield 'zoom_level=?', (zoom, )
+            continue
+        
+        ul = bounds[0].zoomTo(zoom).container()
+        lr = bounds[1].zoomTo(zoom).container()
+        row1, row2 = int(ul.row), int(lr.row)
+        
+        if flip_y:
+            row1, row2 = (2**zoom - 1) - row2, (2**zoom - 1) - row1 # Hello, Paul Ramsey.
+        
+        where = 'zoom_level=? AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?'
+        yield where, (zoom, int(ul.column), int(lr.column), row1, row2)
+
+def count_tiles(filename, zooms=None, bounds=None, flip_y=True):
+    """ Count tiles in a tileset, optionally limited to a list of zooms and bounds.
+    """
+    db = _connect(filename)
+    count = 0
+    
+    for (where, args) in _tile_queries(db, zooms, bounds, flip_y):
+        count += db.execute('SELECT COUNT(*) FROM tiles WHERE ' + where, args).fetchone()[0]
+    
+    return count
+
+def iter_tiles(filename, zooms=None, bounds=None, flip_y=True):
+    """ Generate (coordinate, content) pairs for tiles in a tileset.
+    
+        Tiles are read from a single cursor in index order, zoom by zoom,
+        so memory use stays the same however big the tileset. Optional
+        zooms and bounds are applied in the query, see count_tiles().
+    """
+    db = _connect(filename)
+    db.text_factory = bytes
+    
+    for (where, args) in _tile_queries(db, zooms, bounds, flip_y):
+        q = 'SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles WHERE %s ORDER BY tile_column, tile_row' % where
+        
+        for (zoom, column, row, content) in db.execute(q, args):
+            if flip_y:
+                row = (2**zoom - 1) - row # Hello, Paul Ramsey.
+            
+            yield Coordinate(row, column, zoom), str(content)
+
 def get_tile(filename, coord, tile_scale, flip_y=True):
     """ Retrieve the mime-type and raw content of a tile by coordinate.
     
@@ -218,7 +296,7 @@ class Provider:
     
         See module documentation for explanation of constructor arguments.
     """
-    def __init__(self, layer, tileset):
+    def __init__(self, layer, tileset, prefetch=1):
         """
         """
         sethref = urljoin(layer.config.dirpath, tileset)
@@ -229,19 +307,85 @@ class Provider:
         
         self.tileset = path
         self.layer = layer
+        self.block = Metatile(rows=prefetch, columns=prefetch)
+        
+        self._local = local()
+        self._format = self._readFormat()
     
     @staticmethod
     def prepareKeywordArgs(config_dict):
         """ Convert configured parameters to keyword args for __init__().
         """
-        return {'tileset': config_dict['tileset']}
+        kwargs = {'tileset': config_dict['tileset']}
+        
+        if 'prefetch' in config_dict:
+            kwargs['prefetch'] = int(config_dict['prefetch'])
+        
+        return kwargs
+    
+    def _db(self):
+        """ Return a persistent read-only connection for the current thread.
+        """
+        if not hasattr(self._local, 'db'):
+            db = _connect(self.tileset)
+            db.text_factory = bytes
+            db.execute('PRAGMA query_only=1')
+            db.execute('PRAGMA mmap_size=%d' % _mmap_size)
+            self._local.db = db
+        
+        return self._local.db
+    
+    def _readFormat(self):
+        """ Return the PIL format of the tileset, or None if it's not known yet.
+        """
+        if not tileset_exists(self.tileset):
+            # maybe it's still to be created, so look again later.
+            return None
+        
+        format = self._db().execute("SELECT value FROM metadata WHERE name='format'").fetchone()
+        formats = {'png': 'PNG', 'jpg': 'JPEG'}
+        
+        return formats.get(format and format[0] or None, None)
+    
+    def _prefetch(self, coord, tile_scale):
+        """ Read a whole block of tiles into recent tiles, return the one for coord.
+        """
+        coords = self.block.allCoords(coord)
+        first, last = coords[0], coords[-1]
+        
+        # tileset rows are flipped, so the last row is the lowest.
+        flip = 2**coord.zoom - 1
+        args = coord.zoom, first.column, last.column, flip - last.row, flip - first.row
+        
+        content = None
+        
+        for (column, tile_row, body) in self._db().execute(_select_block, args):
+            other = Coordinate(flip - tile_row, column, coord.zoom)
+            
+            if other == coord:
+                content = body
+            else:
+                _addRecentTile(self.layer, other, self._format, body, tile_scale)
+        
+        return content
     
     def renderTile(self, width, height, srs, coord, tile_scale):
         """ Retrieve a single tile, return a TileResponse instance.
         """
-        mime_type, content = get_tile(self.tileset, coord, tile_scale)
-        formats = {'image/png': 'PNG', 'image/jpeg': 'JPEG', None: None}
-        return TileResponse(formats[mime_type], content)
+        if self._format is None:
+            self._format = self._readFormat()
+        
+        content = _getRecentTile(self.layer, coord, self._format, tile_scale)
+        
+        if content is None and self.block.isForReal():
+            content = self._prefetch(coord, tile_scale)
+        
+        elif content is None:
+            tile_row = (2**coord.zoom - 1) - coord.row # Hello, Paul Ramsey.
+            content = self._db().execute(_select_tile, (coord.zoom, coord.column, tile_row)).fetchone()
+            content = content and content[0] or None
+        
+        return TileResponse(self._format, content)
 
     def tileMetadata(self, coord):
         """ Retrieve metadata for a single tile, return a json-like object.
@@ -292,14 +436,221 @@ class Cache:
         Instead, this cache provider is provided for use with the script
         tilestache-seed.py, which can be called with --to-mbtiles option
         to write cached tiles to a new tileset.
+        
+        Writes are handed to a single writer thread with its own persistent
+        connection, and committed in transactions of up to "batch" tiles or
+        "interval" seconds, whichever comes first. The tileset is kept in
+        write-ahead log mode while open, so that several seeding processes
+        can write to one file, each waiting its turn for the write lock.
+        Tiles waiting to be written are still visible to read().
+        
+        A batch that can't be committed is tried three times and then given
+        up, and the next flush() or close() raises an exception saying how
+        many tiles were lost. If the writer thread itself fails, every later
+        save(), flush() and close() raises an exception.
     """
-    def __init__(self, filename, format, name):
+    def __init__(self, filename, format, name, batch=256, interval=5):
         """
         """
         self.filename = filename
+        self.format = format
+        self.name = name
+        self.batch = batch
+        self.interval = interval
         
         if not tileset_exists(filename):
             create_tileset(filename, name, 'baselayer', '0', '', format.lower())
+        
+        self._local = local()
+        self._pending, self._pending_lock = {}, Lock()
+        self._queue = Queue(batch * 4)
+        self._closed = False
+        
+        # failures of the writer thread, see _check().
+        self._dead, self._lost = None, 0
+        
+        writer = Thread(target=self._work_writes)
+        writer.setDaemon(True)
+        writer.start()
+        
+        atexit.register(self.close)
+    
+    def _db(self):
+        """ Return a persistent read connection for the current thread.
+        """
+        if not hasattr(self._local, 'db'):
+            self._local.db = _connect(self.filename, timeout=60)
+            self._local.db.text_factory = bytes
+        
+        return self._local.db
+    
+    def _check(self):
+        """ Raise an exception if the writer thread has died.
+        """
+        if self._dead is not None:
+            raise Exception('MBTiles writer for %s has failed, no more tiles can be written: %s' % (self.filename, self._dead))
+    
+    def _put(self, item):
+        """ Add an item to the writer queue, unless the writer has died.
+        """
+        while True:
+            self._check()
+            
+            try:
+                return self._queue.put(item, True, 1)
+            except Full:
+                continue
+    
+    def _wait(self, action):
+        """ Queue a flush or close action and wait for the writer to do it.
+        
+            Raise an exception if the writer dies, or if any tiles have
+            been lost since the last time this was checked.
+        """
+        event = Event()
+        self._put((action, event))
+        
+        while not event.wait(1):
+            self._check()
+        
+        with self._pending_lock:
+            lost, self._lost = self._lost, 0
+        
+        if lost:
+            raise Exception('%d tiles could not be written to %s' % (lost, self.filename))
+    
+    def _work_writes(self):
+        """ Run the writer thread, recording a failure for everyone else.
+        """
+        try:
+            self._write_batches()
+        except Exception, e:
+            logging.exception('TileStache.MBTiles.Cache._work_writes() writer for %s has died', self.filename)
+            self._dead = str(e) or e.__class__.__name__
+    
+    def _write_batches(self):
+        """ Write queued tiles to the tileset in batches, until closed.
+        """
+        db = _connect(self.filename, timeout=60, isolation_level=None)
+        db.text_factory = bytes
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        
+        closing = False
+        
+        while not closing:
+            writes, events = [], []
+            deadline = time() + self.interval
+            
+            while len(writes) < self.batch:
+                try:
+                    action, args = self._queue.get(timeout=max(0, deadline - time()))
+                except Empty:
+                    break
+                
+                if action == 'write':
+                    writes.append(args)
+                else:
+                    # flushing or closing: commit what's here right away.
+                    events.append(args)
+                    closing = closing or (action == 'close')
+                    break
+            
+            if writes:
+                self._write(db, writes)
+            
+            if closing:
+                try:
+                    # leave a single self-contained file behind for other readers.
+                    db.execute('PRAGMA journal_mode=DELETE')
+                except OperationalError:
+                    # another connection still has the tileset open.
+                    pass
+                
+                db.close()
+            
+            for event in events:
+                event.set()
+    
+    def _write(self, db, writes):
+        """ Commit a list of (key, content) writes in one transaction.
+        
+            Content of None deletes a tile. A failed transaction is tried
+            three times, and then its tiles are counted as lost.
+        """
+        for attempt in (1, 2, 3):
+            try:
+                db.execute('BEGIN IMMEDIATE')
+                
+                for ((zoom, column, tile_row), content) in writes:
+                    if content is None:
+                        q = 'DELETE FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?'
+                        db.execute(q, (zoom, column, tile_row))
+                    else:
+                        q = 'REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)'
+                        db.execute(q, (zoom, column, tile_row, buffer(content)))
+                
+                db.execute('COMMIT')
+                break
+            
+            except:
+                logging.exception('TileStache.MBTiles.Cache._write() failed to write %d tiles to %s, attempt %d of 3', len(writes), self.filename, attempt)
+                
+                try:
+                    db.execute('ROLLBACK')
+                except OperationalError:
+                    # no transaction was left open to roll back.
+                    pass
+                
+                if attempt < 3:
+                    sleep(attempt)
+                    continue
+                
+                with self._pending_lock:
+                    self._lost += len(writes)
+        
+        with self._pending_lock:
+            for (key, content) in writes:
+                # a newer write of the same tile may still be queued.
+                if key in self._pending and self._pending[key] is content:
+                    del self._pending[key]
+    
+    def _enqueue(self, coord, content):
+        """ Queue a tile write, or a removal if content is None.
+        """
+        key = coord.zoom, coord.column, (2**coord.zoom - 1) - coord.row # Hello, Paul Ramsey.
+        
+        self._check()
+        
+        with self._pending_lock:
+            self._pending[key] = content
+        
+        self._put(('write', (key, content)))
+    
+    def flush(self):
+        """ Block until all queued tiles have been committed.
+        
+            Raises an exception if tiles were lost or the writer has died.
+        """
+        if self._closed:
+            return
+        
+        self._wait('flush')
+    
+    def close(self):
+        """ Commit all queued tiles and stop the writer thread.
+        """
+        if self._closed:
+            return
+        
+        if hasattr(self._local, 'db'):
+            self._local.db.close()
+            del self._local.db
+        
+        try:
+            self._wait('close')
+        finally:
+            self._closed = True
     
     def lock(self, layer, coord, format):
         return
@@ -310,14 +661,59 @@ class Cache:
     def remove(self, layer, coord, format):
         """ Remove a cached tile.
         """
-        delete_tile(self.filename, coord)
+        self._enqueue(coord, None)
+        
+    def removeTiles(self, layer, format, zoom, row1, column1, row2, column2):
+        """ Remove tiles in a range of rows and columns at one zoom level.
+        
+            Tiles waiting to be written are committed first, and the range is
+            removed with a single DELETE.
+        """
+        self.flush()
+        
+        # rows are flipped, so the range is too.
+        tile_row1, tile_row2 = (2**zoom - 1) - row2, (2**zoom - 1) - row1 # Hello, Paul Ramsey.
+        
+        q = """DELETE FROM tiles WHERE zoom_level=?
+               AND tile_column BETWEEN ? AND ? AND tile_row BETWEEN ? AND ?"""
         
+        db = _connect(self.filename, timeout=60)
+        db.execute(q, (zoom, column1, column2, tile_row1, tile_row2))
+        db.commit()
+        db.close()
+    
     def read(self, layer, coord, format):
         """ Return raw tile content from tileset.
         """
-        return get_tile(self.filename, coord)[1]
+        key = coord.zoom, coord.column, (2**coord.zoom - 1) - coord.row # Hello, Paul Ramsey.
+        
+        with self._pending_lock:
+            if key in self._pending:
+                return self._pending[key]
+        
+        content = self._db().execute(_select_tile, key).fetchone()
+        
+        return content and content[0] or None
     
     def save(self, body, layer, coord, format):
         """ Write raw tile content to tileset.
         """
-        put_tile(self.filename, coord, body)
+        self._enqueue(coord, body)
+    
+    def listTiles(self, sizes=False):
+        """ Generate a (layer name, coordinate, format) tuple for every tile.
+        
+            Tiles waiting to be written are committed first. With sizes,
+            tuples have a fourth member for the tile size.
+        """
+        self.flush()
+        
+        q = 'SELECT zoom_level, tile_column, tile_row, LENGTH(tile_data) FROM tiles'
+        
+        for (zoom, column, tile_row, size) in self._db().execute(q):
+            coord = Coordinate((2**zoom - 1) - tile_row, column, zoom) # Hello, Paul Ramsey.
+            
+            if sizes:
+                yield self.name, coord, self.format, size
+            else:
+                yield self.name, coord, self.format
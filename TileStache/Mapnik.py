@@ -3,10 +3,21 @@
 ImageProvider is known as "mapnik" in TileStache config, GridProvider is
 known as "mapnik grid". Both require Mapnik to be installed; Grid requires
 Mapnik 2.0.0 and above.
+
+Each provider keeps a MapPool of mapnik.Map instances loaded from its mapfile,
+so that threads of one process render in parallel, each with a map of its own.
+Maps are loaded as they are first needed, up to the "pool size" of the provider.
+Older versions of Mapnik can behave strangely when run in threads, and the
+"global lock" option renders with just one map at a time in the whole process.
+With "render workers", maps are instead kept in separate worker processes, see
+TileStache.MapnikWorkers.
 """
 from time import time
 from os.path import exists
 from thread import allocate_lock
+from threading import Condition
+from contextlib import contextmanager
+from multiprocessing import cpu_count
 from urlparse import urlparse, urljoin
 from itertools import count
 from glob import glob
@@ -20,6 +31,7 @@ import mapnik
 
 from TileStache.Core import KnownUnknown
 from TileStache.Geography import getProjectionByName
+from TileStache.MapnikWorkers import getFarm
 
 try:
     from PIL import Image
@@ -37,6 +49,77 @@ if 'mapnik' in locals():
 
 global_mapnik_lock = allocate_lock()
 
+def register_fonts(dirpath):
+    """ Register every *.ttf font file in a directory with Mapnik.
+    """
+    engine = mapnik.FontEngine.instance()
+    
+    for font in glob(dirpath.rstrip('/') + '/*.ttf'):
+        engine.register_font(str(font))
+
+class MapPool:
+    """ Pool of mapnik.Map instances for one provider.
+    
+        Maps are checked out for one render at a time and checked back in
+        after, so that no two threads ever share a map. Up to size maps are
+        made with the load function as they are needed, and threads wait for
+        one to be checked in after that.
+    """
+    def __init__(self, load, size):
+        self.load = load
+        self.size = size
+        
+        self._idle, self._count = [], 0
+        self._condition = Condition()
+    
+    def checkout(self):
+        """ Return an idle map, loading a new one if the pool isn't full.
+        """
+        with self._condition:
+            while not self._idle and self._count >= self.size:
+                self._condition.wait()
+            
+            if self._idle:
+                return self._idle.pop()
+            
+            self._count += 1
+        
+        try:
+            # loading takes a while, and needs no lock.
+            return self.load()
+        except:
+            with self._condition:
+                self._count -= 1
+                self._condition.notify()
+            raise
+    
+    def checkin(self, mmap):
+        """ Return a checked-out map to the pool.
+        """
+        with self._condition:
+            self._idle.append(mmap)
+            self._condition.notify()
+
+@contextmanager
+def _checkout(pool, global_lock):
+    """ Check a map out of a pool for the duration of a with statement.
+    
+        With global_lock, also hold the process-wide global_mapnik_lock.
+    """
+    mmap = pool.checkout()
+    
+    if global_lock:
+        global_mapnik_lock.acquire()
+    
+    try:
+        yield mmap
+    
+    finally:
+        if global_lock:
+            global_mapnik_lock.release()
+        
+        pool.checkin(mmap)
+
 class ImageProvider:
     """ Built-in Mapnik provider. Renders map images from Mapnik XML files.
     
@@ -50,13 +133,27 @@ class ImageProvider:
         - fonts (optional)
             Local directory path to *.ttf font files.
     
+        - pool size (optional)
+            Most mapnik.Map instances to render with at once, defaults to the
+            number of processors.
+    
+        - global lock (optional)
+            Render one tile at a time in the whole process, for versions of
+            Mapnik that aren't safe to use in threads. Defaults to false.
+    
+        - render workers (optional)
+            Number of separate processes to render with instead of this one,
+            see TileStache.MapnikWorkers. Defaults to 0, for none. A worker
+            that takes five minutes on a tile is killed, and its next
+            request waits for a new one to load the map, up to two minutes.
+    
         More information on Mapnik and Mapnik XML:
         - http://mapnik.org
         - http://trac.mapnik.org/wiki/XMLGettingStarted
         - http://trac.mapnik.org/wiki/XMLConfigReference
     """
     
-    def __init__(self, layer, mapfile, fonts=None):
+    def __init__(self, layer, mapfile, fonts=None, pool_size=None, global_lock=False, render_workers=0):
         """ Initialize Mapnik provider with layer and mapfile.
             
             XML mapfile keyword arg comes from TileStache config,
@@ -71,19 +168,24 @@ class ImageProvider:
             self.mapfile = maphref
         
         self.layer = layer
-        self.mapnik = None
+        self.maps = MapPool(self.loadMap, pool_size or cpu_count())
+        self.global_lock = bool(global_lock)
+        self.farm = None
         
-        engine = mapnik.FontEngine.instance()
+        fontpath = None
         
         if fonts:
             fontshref = urljoin(layer.config.dirpath, fonts)
-            scheme, h, path, q, p, f = urlparse(fontshref)
+            scheme, h, fontpath, q, p, f = urlparse(fontshref)
             
             if scheme not in ('file', ''):
                 raise Exception('Fonts from "%s" can\'t be used by Mapnik' % fontshref)
         
-            for font in glob(path.rstrip('/') + '/*.ttf'):
-                engine.register_font(str(font))
+            register_fonts(fontpath)
+        
+        if render_workers:
+            options = dict(kind='image', mapfile=self.mapfile, fonts=fontpath)
+            self.farm = getFarm(options, render_workers)
 
     @staticmethod
     def prepareKeywordArgs(config_dict):
@@ -94,30 +196,42 @@ class ImageProvider:
         if 'fonts' in config_dict:
             kwargs['fonts'] = config_dict['fonts']
         
+        if 'pool size' in config_dict:
+            kwargs['pool_size'] = int(config_dict['pool size'])
+        
+        if 'global lock' in config_dict:
+            kwargs['global_lock'] = bool(config_dict['global lock'])
+        
+        if 'render workers' in config_dict:
+            kwargs['render_workers'] = int(config_dict['render workers'])
+        
         return kwargs
     
+    def loadMap(self):
+        """ Return a new mapnik.Map for the pool.
+        """
+        start_time = time()
+        mmap = get_mapnikMap(self.mapfile)
+        
+        logging.debug('TileStache.Mapnik.ImageProvider.loadMap() %.3f to load %s', time() - start_time, self.mapfile)
+        
+        return mmap
+    
     def renderArea(self, width, height, srs, xmin, ymin, xmax, ymax, coord, tile_scale):
         """
         """
         start_time = time()
         
-        if self.mapnik is None:
-            self.mapnik = get_mapnikMap(self.mapfile)
-            logging.debug('TileStache.Mapnik.ImageProvider.renderArea() %.3f to load %s', time() - start_time, self.mapfile)
-        
-        #
-        # Mapnik can behave strangely when run in threads, so place a lock on the instance.
-        #
-        if global_mapnik_lock.acquire():
-            self.mapnik.width = width
-            self.mapnik.height = height
-            self.mapnik.zoom_to_box(Box2d(xmin, ymin, xmax, ymax))
-            
-            img = mapnik.Image(width, height)
-            mapnik.render(self.mapnik, img)
-            global_mapnik_lock.release()
+        bbox = xmin, ymin, xmax, ymax
+        
+        if self.farm is not None:
+            data = self.farm.render(dict(width=width, height=height, bbox=bbox))
+        
+        else:
+            with _checkout(self.maps, self.global_lock) as mmap:
+                data = render_image(mmap, width, height, bbox).tostring()
         
-        img = Image.fromstring('RGBA', (width, height), img.tostring())
+        img = Image.fromstring('RGBA', (width, height), data)
 
         logging.error('Mapnik.renderArea: {"ts":%.0f,"mapfile":"%s","z":%d,"x":%d,"y":%d,"time":%f}', start_time, self.mapfile, coord.zoom, coord.column, coord.row, time() - start_time)
         logging.debug('TileStache.Mapnik.ImageProvider.renderArea() %dx%d in %.3f from %s', width, height, time() - start_time, self.mapfile)
@@ -182,18 +296,22 @@ class GridProvider:
           layer name added, keyed by this value. Useful for distingushing
           between data items.
         
+        - pool size, global lock, render workers (optional)
+          Same as for ImageProvider.
+        
         Information and examples for UTF Grid:
         - https://github.com/mapbox/utfgrid-spec/blob/master/1.2/utfgrid.md
         - http://mapbox.github.com/wax/interaction-leaf.html
     """
-    def __init__(self, layer, mapfile, fields=None, layers=None, layer_index=0, scale=4, layer_id_key=None):
+    def __init__(self, layer, mapfile, fields=None, layers=None, layer_index=0, scale=4, layer_id_key=None, pool_size=None, global_lock=False, render_workers=0):
         """ Initialize Mapnik grid provider with layer and mapfile.
             
             XML mapfile keyword arg comes from TileStache config,
             and is an absolute path by the time it gets here.
         """
-        self.mapnik = None
         self.layer = layer
+        self.maps = MapPool(self.loadMap, pool_size or cpu_count())
+        self.global_lock = bool(global_lock)
 
         maphref = urljoin(layer.config.dirpath, mapfile)
         scheme, h, path, q, p, f = urlparse(maphref)
@@ -210,6 +328,13 @@ class GridProvider:
             self.layers = layers
         else:
             self.layers = [[layer_index or 0, fields]]
+        
+        self.farm = None
+        
+        if render_workers:
+            options = dict(kind='grid', mapfile=self.mapfile, layers=self.layers,
+                           scale=scale, layer_id_key=layer_id_key)
+            self.farm = getFarm(options, render_workers)
 
     @staticmethod
     def prepareKeywordArgs(config_dict):
@@ -221,55 +346,40 @@ class GridProvider:
             if key in config_dict:
                 kwargs[key] = config_dict[key]
         
+        if 'pool size' in config_dict:
+            kwargs['pool_size'] = int(config_dict['pool size'])
+        
+        if 'global lock' in config_dict:
+            kwargs['global_lock'] = bool(config_dict['global lock'])
+        
+        if 'render workers' in config_dict:
+            kwargs['render_workers'] = int(config_dict['render workers'])
+        
         return kwargs
     
+    def loadMap(self):
+        """ Return a new mapnik.Map for the pool.
+        """
+        start_time = time()
+        mmap = get_mapnikMap(self.mapfile)
+        
+        logging.debug('TileStache.Mapnik.GridProvider.loadMap() %.3f to load %s', time() - start_time, self.mapfile)
+        
+        return mmap
+    
     def renderArea(self, width, height, srs, xmin, ymin, xmax, ymax, coord, tile_scale):
         """
         """
         start_time = time()
-
-        zoom = coord.zoom        
-
-        if self.mapnik is None:
-            self.mapnik = get_mapnikMap(self.mapfile)
-            logging.debug('TileStache.Mapnik.GridProvider.renderArea() %.3f to load %s', time() - start_time, self.mapfile)
         
-        #
-        # Mapnik can behave strangely when run in threads, so place a lock on the instance.
-        #
-        if global_mapnik_lock.acquire():
-            self.mapnik.width = width
-            self.mapnik.height = height
-            self.mapnik.zoom_to_box(Box2d(xmin, ymin, xmax, ymax))
-            
-            if self.layer_id_key is not None:
-                grids = []
-    
-                for (index, fields) in self.layers:
-                    datasource = self.mapnik.layers[index].datasource
-                    fields = (type(fields) is list) and map(str, fields) or datasource.fields()
-                    
-                    grid = mapnik.render_grid(self.mapnik, index, resolution=self.scale, fields=fields)
-    
-                    for key in grid['data']:
-                        grid['data'][key][self.layer_id_key] = self.mapnik.layers[index].name
-    
-                    grids.append(grid)
+        bbox = xmin, ymin, xmax, ymax
         
-                global_mapnik_lock.release()
-                outgrid = reduce(merge_grids, grids)
-           
-            else:
-                grid = mapnik.Grid(width, height)
-    
-                for (index, fields) in self.layers:
-                    datasource = self.mapnik.layers[index].datasource
-                    fields = (type(fields) is list) and map(str, fields) or datasource.fields()
-    
-                    mapnik.render_layer(self.mapnik, grid, layer=index, fields=fields)
-    
-                global_mapnik_lock.release()
-                outgrid = grid.encode('utf', resolution=self.scale, features=True)
+        if self.farm is not None:
+            outgrid = self.farm.render(dict(width=width, height=height, bbox=bbox))
+        
+        else:
+            with _checkout(self.maps, self.global_lock) as mmap:
+                outgrid = render_grid(mmap, width, height, bbox, self.layers, self.scale, self.layer_id_key)
 
         logging.debug('TileStache.Mapnik.GridProvider.renderArea() %dx%d at %d in %.3f from %s', width, height, self.scale, time() - start_time, self.mapfile)
 
@@ -376,6 +486,51 @@ def decode_char(char):
         id = id - 1
     return id - 32
 
+def render_image(mmap, width, height, bbox):
+    """ Render a map to a new mapnik.Image, for a (xmin, ymin, xmax, ymax) bbox.
+    """
+    mmap.width = width
+    mmap.height = height
+    mmap.zoom_to_box(Box2d(*bbox))
+    
+    img = mapnik.Image(width, height)
+    mapnik.render(mmap, img)
+    
+    return img
+
+def render_grid(mmap, width, height, bbox, layers, scale, layer_id_key=None):
+    """ Render a list of (layer index, fields) map layers to a UTF Grid dictionary.
+    """
+    mmap.width = width
+    mmap.height = height
+    mmap.zoom_to_box(Box2d(*bbox))
+    
+    if layer_id_key is not None:
+        grids = []
+
+        for (index, fields) in layers:
+            datasource = mmap.layers[index].datasource
+            fields = (type(fields) is list) and map(str, fields) or datasource.fields()
+            
+            grid = mapnik.render_grid(mmap, index, resolution=scale, fields=fields)
+
+            for key in grid['data']:
+                grid['data'][key][layer_id_key] = mmap.layers[index].name
+
+            grids.append(grid)
+        
+        return reduce(merge_grids, grids)
+    
+    grid = mapnik.Grid(width, height)
+
+    for (index, fields) in layers:
+        datasource = mmap.layers[index].datasource
+        fields = (type(fields) is list) and map(str, fields) or datasource.fields()
+
+        mapnik.render_layer(mmap, grid, layer=index, fields=fields)
+    
+    return grid.encode('utf', resolution=scale, features=True)
+
 def get_mapnikMap(mapfile):
     """ Get a new mapnik.Map instance for a mapfile
     """
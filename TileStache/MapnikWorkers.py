@@ -0,0 +1,395 @@
+""" Out-of-process Mapnik rendering, for the "render workers" provider option.
+
+A RenderFarm keeps a fixed set of long-lived worker processes, each of which
+loads its own mapnik.Map once and then renders for as long as it lives. This
+keeps Mapnik out of the web server process entirely: a crash in Mapnik takes
+down one worker instead of the server, and threads of the server never share
+Mapnik state at all.
+
+Requests go to each worker as one line of JSON over a local Unix socket.
+Images come back through a file of shared memory, in /dev/shm where there is
+one, so the RGBA buffer of a tile is copied once instead of being pickled and
+pushed through the socket. Grids are small and come back in the JSON reply.
+
+A worker that dies or stops answering is killed, and started afresh for the
+next request; a request whose worker died before answering is tried once
+more, in a fresh worker. A fresh worker loads its map again before it renders
+anything, so the request after a timeout waits for that, for as long as
+_startup_timeout seconds. Workers are started as they are first needed, and
+again in any process forked after that, so a farm can be made before a server
+forks. Providers with the same options share one farm, see getFarm(), so a
+configuration reload doesn't start a second set of workers, and a farm's
+workers are stopped once no provider uses it.
+
+Example configuration, with four workers:
+
+    {
+      "layers":
+      {
+        "osm":
+        {
+          "provider":
+          {
+            "name": "mapnik",
+            "mapfile": "style.xml",
+            "render workers": 4
+          }
+        }
+      }
+    }
+
+Run as a script, this module is a single worker; RenderFarm starts them.
+"""
+import os
+import sys
+import mmap
+import json
+import atexit
+import socket
+import logging
+
+from time import time
+from shutil import rmtree
+from tempfile import mkdtemp
+from traceback import format_exc
+from threading import Condition, Lock
+from weakref import WeakValueDictionary
+from subprocess import Popen
+from os.path import join, isdir
+
+# seconds a new worker has to load its map and connect.
+_startup_timeout = 120
+
+# bytes of shared memory to start with, enough for a 512x512 image.
+_initial_size = 512 * 512 * 4
+
+# farms by their options, see getFarm().
+_farms = WeakValueDictionary()
+_farms_lock = Lock()
+
+def getFarm(options, size, timeout=300):
+    """ Return a RenderFarm, shared by all providers asking with the same arguments.
+
+        Providers built again on a configuration reload get the farm of the
+        ones they replace, and a farm stops its workers once the last of its
+        providers is gone.
+    """
+    key = json.dumps(options, sort_keys=True), size, timeout
+
+    with _farms_lock:
+        farm = _farms.get(key)
+
+        if farm is None:
+            farm = RenderFarm(options, size, timeout)
+            _farms[key] = farm
+
+        return farm
+
+def _closeFarms():
+    """ Stop the workers of every farm still around, at exit.
+    """
+    for farm in _farms.values():
+        farm.close()
+
+atexit.register(_closeFarms)
+
+class RenderError (Exception):
+    """ Raised when a worker fails to render, with the worker's traceback.
+    """
+    pass
+
+class _WorkerDied (Exception):
+    pass
+
+class RenderFarm:
+    """ A set of worker processes rendering for one provider.
+
+        Options are passed to each worker and are all JSON-friendly:
+        kind ("image" or "grid"), mapfile, and fonts for images or
+        layers, scale, and layer_id_key for grids. An optional module
+        names where workers find their rendering functions, and defaults
+        to TileStache.Mapnik; tests use a stand-in without Mapnik.
+    """
+    def __init__(self, options, size, timeout=300):
+        self.options = options
+        self.size = size
+        self.timeout = timeout
+
+        self.pid = None
+        self.workers = None
+        self.dirpath = None
+        self.condition = Condition()
+
+    def __del__(self):
+        """ Stop workers of a farm that's no longer used.
+        """
+        try:
+            self.close()
+        except:
+            # too late to do anything about it.
+            pass
+
+    def _setup(self):
+        """ Make a fresh set of workers if there are none in this process yet.
+
+            Workers are started lazily, one by one as they're checked out.
+            Call with the condition held.
+        """
+        if self.pid == os.getpid():
+            return
+
+        # a forked copy of a farm must not touch its parent's workers.
+        self.pid = os.getpid()
+        self.dirpath = mkdtemp(prefix='tilestache-mapnik-', dir=(isdir('/dev/shm') and '/dev/shm' or None))
+        self.workers = [_Worker(self.options, self.dirpath, i, self.timeout) for i in range(self.size)]
+        self.idle = list(self.workers)
+
+    def _checkout(self):
+        self.condition.acquire()
+
+        try:
+            self._setup()
+
+            while not self.idle:
+                self.condition.wait()
+
+            return self.idle.pop()
+        finally:
+            self.condition.release()
+
+    def _checkin(self, worker):
+        self.condition.acquire()
+
+        try:
+            if worker in self.workers:
+                self.idle.append(worker)
+                self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def render(self, request):
+        """ Render a dictionary of width, height and bbox in some worker.
+
+            Return a string of RGBA image data for images, or a dictionary
+            for grids. Raise RenderError if the worker fails to render.
+        """
+        for attempt in (1, 2):
+            worker = self._checkout()
+
+            try:
+                try:
+                    return worker.render(request)
+                except _WorkerDied, e:
+                    logging.warning('TileStache.MapnikWorkers.RenderFarm.render() worker %d died: %s', worker.index, e)
+
+                    if attempt == 2:
+                        raise RenderError('Mapnik render worker died twice: %s' % e)
+            finally:
+                self._checkin(worker)
+
+    def close(self):
+        """ Stop all workers and remove their shared memory.
+        """
+        self.condition.acquire()
+
+        try:
+            if self.pid != os.getpid():
+                return
+
+            for worker in self.workers:
+                worker.stop()
+
+            rmtree(self.dirpath, True)
+            self.pid, self.workers, self.idle = None, None, None
+        finally:
+            self.condition.release()
+
+class _Worker:
+    """ Parent side of one worker process, started when first needed.
+    """
+    def __init__(self, options, dirpath, index, timeout):
+        self.options = options
+        self.index = index
+        self.timeout = timeout
+
+        self.sockpath = join(dirpath, 'worker-%d.sock' % index)
+        self.shmpath = join(dirpath, 'worker-%d.shm' % index)
+
+        self.process = None
+        self.sock = None
+        self.reader = None
+        self.shm = None
+
+    def start(self):
+        """ Start a worker process, and wait for it to connect back.
+        """
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        if os.path.exists(self.sockpath):
+            os.unlink(self.sockpath)
+
+        listener.bind(self.sockpath)
+        listener.listen(1)
+        listener.settimeout(1)
+
+        self.shm = _SharedMemory(self.shmpath, _initial_size)
+
+        args = dict(self.options, socket=self.sockpath, shm=self.shmpath)
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([p for p in sys.path if p]))
+
+        self.process = Popen([sys.executable, '-m', 'TileStache.MapnikWorkers', json.dumps(args)], env=env, close_fds=True)
+        deadline = time() + _startup_timeout
+
+        try:
+            while True:
+                try:
+                    self.sock, address = listener.accept()
+                    break
+                except socket.timeout:
+                    if self.process.poll() is not None:
+                        raise _WorkerDied('exited with status %d while starting' % self.process.returncode)
+
+                    if time() > deadline:
+                        raise _WorkerDied('took more than %d seconds to start' % _startup_timeout)
+        except:
+            self.stop()
+            raise
+        finally:
+            listener.close()
+            os.unlink(self.sockpath)
+
+        self.sock.settimeout(self.timeout)
+        self.reader = self.sock.makefile('rb')
+
+        logging.debug('TileStache.MapnikWorkers._Worker.start() worker %d is process %d', self.index, self.process.pid)
+
+    def stop(self):
+        """ Kill the worker process, if there is one.
+        """
+        if self.sock is not None:
+            self.reader.close()
+            self.sock.close()
+
+        if self.process is not None and self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+        if self.shm is not None:
+            self.shm.close()
+
+        self.process, self.sock, self.reader, self.shm = None, None, None, None
+
+    def render(self, request):
+        """ Render a request in the worker process, starting it if needed.
+        """
+        if self.process is None or self.process.poll() is not None:
+            self.stop()
+            self.start()
+
+        try:
+            self.sock.sendall(json.dumps(request) + '\n')
+            line = self.reader.readline()
+
+        except socket.timeout:
+            self.stop()
+            raise RenderError('Mapnik render worker took more than %d seconds' % self.timeout)
+
+        except socket.error, e:
+            self.stop()
+            raise _WorkerDied(str(e))
+
+        if not line:
+            self.stop()
+            raise _WorkerDied('closed its connection')
+
+        reply = json.loads(line)
+
+        if 'error' in reply:
+            raise RenderError(reply['error'])
+
+        elif 'grid' in reply:
+            return reply['grid']
+
+        return self.shm.read(reply['size'])
+
+class _SharedMemory:
+    """ A file of memory shared by one worker and its parent.
+
+        The writing side grows the file when an image won't fit, and the
+        reading side maps it again when it finds itself short.
+    """
+    def __init__(self, path, size=None):
+        if size is None:
+            self.file = open(path, 'r+b')
+        else:
+            self.file = open(path, 'w+b')
+            self.file.truncate(size)
+
+        self._map()
+
+    def _map(self):
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.mmap = mmap.mmap(self.file.fileno(), self.size)
+
+    def write(self, data):
+        if len(data) > self.size:
+            self.mmap.close()
+            self.file.truncate(len(data))
+            self._map()
+
+        self.mmap[0:len(data)] = data
+
+    def read(self, size):
+        if size > self.size:
+            self.mmap.close()
+            self._map()
+
+        return self.mmap[0:size]
+
+    def close(self):
+        self.mmap.close()
+        self.file.close()
+
+def main(options):
+    """ Run one worker, rendering requests from its parent until it goes away.
+    """
+    module = __import__(str(options.get('module', 'TileStache.Mapnik')), fromlist=['render_image'])
+
+    if options.get('fonts'):
+        module.register_fonts(options['fonts'])
+
+    mapnik_map = module.get_mapnikMap(str(options['mapfile']))
+    shm = _SharedMemory(options['shm'])
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(options['socket'])
+    reader = sock.makefile('rb')
+
+    while True:
+        line = reader.readline()
+
+        if not line:
+            # the parent is done with us.
+            break
+
+        request = json.loads(line)
+        width, height, bbox = request['width'], request['height'], request['bbox']
+
+        try:
+            if options['kind'] == 'grid':
+                layers, scale, layer_id_key = options['layers'], options['scale'], options['layer_id_key']
+                grid = module.render_grid(mapnik_map, width, height, bbox, layers, scale, layer_id_key)
+                reply = dict(grid=grid)
+
+            else:
+                data = module.render_image(mapnik_map, width, height, bbox).tostring()
+                shm.write(data)
+                reply = dict(size=len(data))
+
+        except Exception:
+            reply = dict(error=format_exc())
+
+        sock.sendall(json.dumps(reply) + '\n')
+
+if __name__ == '__main__':
+    main(json.loads(sys.argv[1]))
@@ -42,7 +42,7 @@ except ImportError:
 def tile_key(layer, coord, format, rev, key_prefix):
     """ Return a tile key string.
     """
-    name = layer.name()
+    name = layer.cacheName()
     tile = '%(zoom)d/%(column)d/%(row)d' % coord.__dict__
     return str('%(key_prefix)s/%(rev)s/%(name)s/%(tile)s.%(format)s' % locals())
 
@@ -0,0 +1,182 @@
+""" Speculative rendering of tiles that are likely to be requested next.
+
+When a client pans a map it soon asks for tiles next to the ones it just got,
+and when it zooms in it asks for their children. A layer with a prefetch policy
+queues renders of those tiles after a tile has been rendered for a cache miss,
+so that they're already cached by the time they're asked for.
+
+Prefetch policies are given per layer, as a dictionary:
+
+    {
+      "cache": ...,
+      "layers":
+      {
+        "example-name":
+        {
+          "provider": { ... },
+          "metatile": { ... },
+          "prefetch": {"neighbors": 1, "children": true}
+        }
+      }
+    }
+
+- "neighbors" is an optional number of rings of adjacent metatiles to render
+  around the one just rendered. Defaults to 0, or none.
+- "children" is an optional boolean for whether to render the metatiles one
+  zoom level deeper that cover the one just rendered. Defaults to false.
+
+Prefetching works in whole metatiles, so a layer with a 4x4 metatile and one
+ring of neighbors queues eight metatile renders covering 128 tiles.
+
+Queued work is done by a single background thread, one metatile at a time, so
+that prefetching never competes with more than one render at a time. The queue
+is bounded, and new work is dropped when it's full. Work already queued isn't
+queued again, and work is skipped if the cache has the tile by the time the
+thread gets to it. Numbers of tiles queued, dropped, skipped, rendered, and
+actually served to a client after being prefetched are available from stats().
+"""
+import logging
+
+from threading import Thread, Lock, local
+from Queue import Queue, Full
+from collections import OrderedDict
+
+from ModestMaps.Core import Coordinate
+
+# number of metatiles waiting to be rendered.
+_queue_size = 1000
+
+# number of prefetched tiles to remember while waiting to see them served.
+_remember_size = 100000
+
+_queue = Queue(_queue_size)
+_queued = set()
+_prefetched = OrderedDict()
+_lock = Lock()
+_local = local()
+_worker = []
+
+_stats = dict(queued=0, dropped=0, skipped=0, rendered=0, served=0)
+
+def stats():
+    """ Return a dictionary of prefetch counts.
+
+        Counts are of metatiles queued, dropped from a full queue, skipped
+        because the cache had them already, and rendered, and of single
+        prefetched tiles that were then served from the cache.
+    """
+    with _lock:
+        return dict(_stats)
+
+def _jobCoords(layer, coord):
+    """ Return a list of first coordinates of metatiles worth prefetching.
+    """
+    metatile = layer.metatile
+    rows, columns = metatile.rows, metatile.columns
+    first = metatile.firstCoord(coord)
+    coords = []
+
+    rings = layer.prefetch_neighbors
+
+    for row in range(-rings, rings + 1):
+        for column in range(-rings, rings + 1):
+            if row or column:
+                coords.append(Coordinate(first.row + rows * row, first.column + columns * column, first.zoom))
+
+    if layer.prefetch_children:
+        for row in range(0, rows * 2, rows):
+            for column in range(0, columns * 2, columns):
+                child = Coordinate(first.row * 2 + row, first.column * 2 + column, first.zoom + 1)
+                coords.append(metatile.firstCoord(child))
+
+    def useful(coord):
+        if coord.row < 0 or coord.column < 0 or max(coord.row, coord.column) >= 2**coord.zoom:
+            return False
+
+        if layer.bounds:
+            # some part of the metatile must be inside the bounds.
+            return [c for c in metatile.allCoords(coord) if not layer.bounds.excludes(c)]
+
+        return True
+
+    return [c for c in coords if useful(c)]
+
+def afterMiss(layer, coord, extension):
+    """ Queue prefetch work after a tile has been rendered for a cache miss.
+
+        Does nothing for layers without a prefetch policy, or when called
+        from prefetch work itself.
+    """
+    if not (getattr(layer, 'prefetch_neighbors', 0) or getattr(layer, 'prefetch_children', False)):
+        return
+
+    if getattr(_local, 'prefetching', False):
+        return
+
+    for other in _jobCoords(layer, coord):
+        key = layer, other, extension
+
+        with _lock:
+            if key in _queued:
+                continue
+
+            try:
+                _queue.put_nowait(key)
+            except Full:
+                _stats['dropped'] += 1
+                continue
+
+            _queued.add(key)
+            _stats['queued'] += 1
+
+    with _lock:
+        if not _worker:
+            worker = Thread(target=_work)
+            worker.setDaemon(True)
+            worker.start()
+            _worker.append(worker)
+
+def noteServed(layer, coord, format):
+    """ Count a tile served from the cache if it was prefetched.
+    """
+    if not _prefetched:
+        return
+
+    with _lock:
+        if _prefetched.pop((layer, coord, format), None):
+            _stats['served'] += 1
+
+def _work():
+    """ Render queued metatiles, forever.
+    """
+    from . import getTile
+
+    _local.prefetching = True
+
+    while True:
+        layer, coord, extension = _queue.get()
+
+        with _lock:
+            _queued.discard((layer, coord, extension))
+
+        try:
+            mimetype, format = layer.getTypeByExtension(extension)
+
+            if layer.config.cache.read(layer, coord, format) is not None:
+                with _lock:
+                    _stats['skipped'] += 1
+                continue
+
+            getTile(layer, coord, extension, 1)
+
+            with _lock:
+                _stats['rendered'] += 1
+
+                for other in layer.metatile.allCoords(coord):
+                    _prefetched[(layer, other, format)] = True
+
+                while len(_prefetched) > _remember_size:
+                    _prefetched.popitem(last=False)
+
+        except:
+            logging.exception('TileStache.Prefetch._work() failed to prefetch %s/%d/%d/%d.%s', layer.name(), coord.zoom, coord.column, coord.row, extension)
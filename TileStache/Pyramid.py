@@ -0,0 +1,133 @@
+""" Building low zoom levels by downsampling tiles from the zoom level below.
+
+A tile at zoom z covers exactly the same area as its four children at zoom z+1,
+so once a deep zoom level has been rendered and cached, the levels above can be
+made by mosaicking children into one double-size image and shrinking it by half.
+For expensive layers, such as a Mapnik world map, this is far cheaper than
+rendering the low zooms, where every feature in the world is in play.
+
+Downsampling is set per layer, as a dictionary:
+
+    {
+      "cache": ...,
+      "layers":
+      {
+        "example-name":
+        {
+          "provider": { ... },
+          "downsample": {"zoom": 9, "filter": "antialias"}
+        }
+      }
+    }
+
+- "zoom" is the zoom level at which real rendering begins. Tiles at lower zoom
+  levels are built from their children, which are themselves read from the
+  cache, downsampled, or rendered as needed.
+- "filter" is an optional resampling filter: "nearest", "bilinear", "bicubic",
+  or "antialias". Defaults to "antialias".
+
+Only PNG and JPEG tiles are downsampled; other formats are rendered as usual,
+and so are tiles at other scales, such as "@2x" tiles, whose children would
+all have to be rendered afresh at that scale.
+Downsampled tiles are encoded with the layer's "png options" or "jpeg options".
+
+The script tilestache-seed.py can also build a pyramid this way with its
+--downsample option, rendering only the deepest zoom level it's given and
+building the rest bottom-up from there.
+"""
+from StringIO import StringIO
+from threading import Lock, local
+from multiprocessing.pool import ThreadPool
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+from ModestMaps.Core import Coordinate
+
+filters = {
+    'nearest': Image.NEAREST,
+    'bilinear': Image.BILINEAR,
+    'bicubic': Image.BICUBIC,
+    'antialias': Image.ANTIALIAS
+    }
+
+_extensions = {'PNG': 'png', 'JPEG': 'jpg'}
+
+# threads for fetching children of a top-level downsampled tile.
+_pool_size = 4
+
+_pool = []
+_pool_lock = Lock()
+_local = local()
+
+def canDownsample(format):
+    """ Return true if tiles of a format can be built by downsampling.
+    """
+    return format in _extensions
+
+def children(coord):
+    """ Return the four child coordinates of a tile, in reading order.
+    """
+    row, column, zoom = int(coord.row) * 2, int(coord.column) * 2, coord.zoom + 1
+
+    return [Coordinate(row, column, zoom), Coordinate(row, column + 1, zoom),
+            Coordinate(row + 1, column, zoom), Coordinate(row + 1, column + 1, zoom)]
+
+def _childImage(layer, coord, extension):
+    """ Return an RGBA image for a child tile, or None if there isn't one.
+
+        Uses getTile(), so the child is read from the cache when possible,
+        and rendered or downsampled itself when not.
+    """
+    from . import getTile
+
+    # children of children are fetched one at a time, in this thread.
+    _local.nested = True
+
+    mimetype, body = getTile(layer, coord, extension, 1)
+
+    if body is None:
+        return None
+
+    return Image.open(StringIO(body)).convert('RGBA')
+
+def _threadPool():
+    """ Return a shared pool of threads for fetching children.
+    """
+    with _pool_lock:
+        if not _pool:
+            _pool.append(ThreadPool(_pool_size))
+
+        return _pool[0]
+
+def downsample(layer, coord, format):
+    """ Build a tile image from its four children, return a PIL image.
+
+        Children are fetched in parallel for a top-level tile, and in turn
+        for tiles deeper in the pyramid. Missing children, e.g. outside
+        the layer bounds, are left transparent.
+    """
+    extension = _extensions[format]
+    coords = children(coord)
+    fetch = lambda child: _childImage(layer, child, extension)
+
+    if getattr(_local, 'nested', False):
+        images = map(fetch, coords)
+    else:
+        images = _threadPool().map(fetch, coords)
+
+    dim = layer.dim
+    mosaic = Image.new('RGBA', (dim * 2, dim * 2), (0, 0, 0, 0))
+
+    for (image, (x, y)) in zip(images, [(0, 0), (dim, 0), (0, dim), (dim, dim)]):
+        if image is not None:
+            mosaic.paste(image, (x, y))
+
+    tile = mosaic.resize((dim, dim), filters[layer.downsample_filter])
+
+    if format == 'JPEG':
+        tile = tile.convert('RGB')
+
+    return tile
@@ -26,19 +26,42 @@ S3 cache parameters:
   use_locks
     Optional boolean flag for whether to use the locking feature on S3.
     True by default. A good reason to set this to false would be the
-    additional price and time required for each lock set in S3.
+    additional price and time required for each lock set in S3. Without
+    S3 locks, concurrent requests for the same tile are still coalesced
+    within a single process so that a tile is only rendered once there.
+
+  host
+    Optional hostname of an S3-compatible service, e.g. "localhost" for
+    a local stand-in used in testing. Defaults to Amazon's own S3 host.
+    Buckets on other hosts are addressed with path-style URLs.
+
+  port
+    Optional port number for the S3-compatible service given in host.
+
+  secure
+    Optional boolean flag for whether to talk HTTPS to S3. True by default.
 
 Access and secret keys are under "Security Credentials" at your AWS account page:
   http://aws.amazon.com/account/
+
+Each thread keeps its own connection to S3, so that HTTP connections can be
+kept alive and reused between requests. Reads are made with a single GET, and
+a missing tile is simply a 404 response.
 """
 from time import time as _time, sleep as _sleep
+from threading import local as _local, Lock as _Lock
 from mimetypes import guess_type
 from time import strptime, time
 from calendar import timegm
 
+from ModestMaps.Core import Coordinate
+
+from .Generations import split_cache_name
+
 try:
     from boto.s3.bucket import Bucket as S3Bucket
-    from boto.s3.connection import S3Connection
+    from boto.s3.connection import S3Connection, OrdinaryCallingFormat
+    from boto.exception import S3ResponseError
 except ImportError:
     # at least we can build the documentation
     pass
@@ -46,7 +69,7 @@ except ImportError:
 def tile_key(layer, coord, format):
     """ Return a tile key string.
     """
-    name = layer.name()
+    name = layer.cacheName()
     tile = '%(zoom)d/%(column)d/%(row)d' % coord.__dict__
     ext = format.lower()
 
@@ -55,51 +78,209 @@ def tile_key(layer, coord, format):
 class Cache:
     """
     """
-    def __init__(self, bucket, access, secret, use_locks=True):
-        self.bucket = S3Bucket(S3Connection(access, secret), bucket)
+    def __init__(self, bucket, access, secret, use_locks=True, host=None, port=None, secure=True):
+        self.bucket_name = bucket
+        self.access = access
+        self.secret = secret
+        self.host = host
+        self.port = port
+        self.secure = bool(secure)
         self.use_locks = bool(use_locks)
+        
+        # per-thread connections, and in-process locks keyed by tile key.
+        self._connections = _local()
+        self._locks, self._locks_lock = {}, _Lock()
+
+    def _bucket(self):
+        """ Return a Bucket for the current thread, connecting if necessary.
+        
+            Boto connections are not safe to share between threads, so each
+            thread gets its own and keeps it around for reuse.
+        """
+        bucket = getattr(self._connections, 'bucket', None)
+        
+        if bucket is None:
+            if self.host:
+                conn = S3Connection(self.access, self.secret, host=self.host,
+                                    port=self.port, is_secure=self.secure,
+                                    calling_format=OrdinaryCallingFormat())
+            else:
+                conn = S3Connection(self.access, self.secret, is_secure=self.secure)
+            
+            bucket = S3Bucket(conn, self.bucket_name)
+            self._connections.bucket = bucket
+        
+        return bucket
+
+    def _acquire_local(self, key_name):
+        """ Block until this process holds the in-process lock for a key.
+        """
+        self._locks_lock.acquire()
+
+        try:
+            lock, count = self._locks.get(key_name, (None, 0))
+            self._locks[key_name] = (lock or _Lock()), count + 1
+            lock = self._locks[key_name][0]
+        finally:
+            self._locks_lock.release()
+        
+        lock.acquire()
+
+    def _release_local(self, key_name):
+        """ Release the in-process lock for a key, forgetting it if unused.
+        """
+        self._locks_lock.acquire()
+
+        try:
+            if key_name not in self._locks:
+                return
+            
+            lock, count = self._locks[key_name]
+            
+            if count > 1:
+                self._locks[key_name] = lock, count - 1
+            else:
+                del self._locks[key_name]
+        finally:
+            self._locks_lock.release()
+        
+        lock.release()
 
     def lock(self, layer, coord, format):
         """ Acquire a cache lock for this tile.
         
             Returns nothing, but blocks until the lock has been acquired.
-            Does nothing and returns immediately if `use_locks` is false.
+            Requests in the same process always wait on each other, but
+            the S3 lock object is only used if `use_locks` is true.
         """
+        key_name = tile_key(layer, coord, format)
+        self._acquire_local(key_name)
+
         if not self.use_locks:
             return
         
-        key_name = tile_key(layer, coord, format)
-        due = _time() + layer.stale_lock_timeout
-        
-        while _time() < due:
-            if not self.bucket.get_key(key_name+'-lock'):
-                break
+        try:
+            bucket = self._bucket()
+            due = _time() + layer.stale_lock_timeout
             
-            _sleep(.2)
+            while _time() < due:
+                if not bucket.get_key(key_name+'-lock'):
+                    break
+                
+                _sleep(.2)
+            
+            key = bucket.new_key(key_name+'-lock')
+            key.set_contents_from_string('locked.', {'Content-Type': 'text/plain'})
         
-        key = self.bucket.new_key(key_name+'-lock')
-        key.set_contents_from_string('locked.', {'Content-Type': 'text/plain'})
+        except:
+            # don't leave other requests for this tile waiting forever.
+            self._release_local(key_name)
+            raise
         
     def unlock(self, layer, coord, format):
         """ Release a cache lock for this tile.
         """
         key_name = tile_key(layer, coord, format)
-        self.bucket.delete_key(key_name+'-lock')
+
+        try:
+            if self.use_locks:
+                self._bucket().delete_key(key_name+'-lock')
+        finally:
+            self._release_local(key_name)
         
     def remove(self, layer, coord, format):
         """ Remove a cached tile.
         """
         key_name = tile_key(layer, coord, format)
-        self.bucket.delete_key(key_name)
+        self._bucket().delete_key(key_name)
+    
+    def removeTiles(self, layer, format, zoom, row1, column1, row2, column2):
+        """ Remove cached tiles in a range of rows and columns at one zoom level.
+        
+            Keys are removed with multi-object deletes of up to 1000 keys each.
+            Keys of short columns are simply listed out, and tall columns are
+            listed from the bucket by prefix instead, to find the keys that
+            are actually there.
+        """
+        bucket = self._bucket()
+        name, ext = layer.cacheName(), format.lower()
+        
+        def keys():
+            for column in range(column1, column2 + 1):
+                prefix = str('%s/%d/%d/' % (name, zoom, column))
+                
+                if row2 - row1 < 1000:
+                    for row in range(row1, row2 + 1):
+                        yield '%s%d.%s' % (prefix, row, ext)
+                    continue
+                
+                for key in bucket.list(prefix=prefix):
+                    y, dot, e = key.name[len(prefix):].partition('.')
+                    
+                    if e == ext and y.isdigit() and row1 <= int(y) <= row2:
+                        yield key.name
+        
+        bucket.delete_keys(keys(), quiet=True)
+    
+    def removeGenerations(self, layer):
+        """ Remove tiles cached under other generations of a layer.
+        
+            Each generation has a key prefix of its own, which is listed
+            and removed with multi-object deletes.
+        """
+        layer_name, current = layer.name(), split_cache_name(layer.cacheName())[1]
+        bucket = self._bucket()
+        
+        for prefix in bucket.list(delimiter='/'):
+            if not prefix.name.endswith('/'):
+                # a key, not a prefix.
+                continue
+            
+            name, generation = split_cache_name(prefix.name[:-1])
+            
+            if name == layer_name and generation != current:
+                bucket.delete_keys(bucket.list(prefix=prefix.name), quiet=True)
+        
+    def listTiles(self, sizes=False):
+        """ Generate a (layer name, coordinate, format) tuple for every cached tile.
+        
+            Lists the whole bucket a page of keys at a time, so this may take
+            a while. With sizes, tuples have a fourth member for the key size.
+        """
+        for key in self._bucket().list():
+            parts = key.name.split('/')
+            
+            if len(parts) != 4 or '.' not in parts[3] or key.name.endswith('-lock'):
+                continue
+            
+            name, z, x, filename = parts
+            y, ext = filename.split('.', 1)
+            
+            try:
+                coord = Coordinate(int(y), int(x), int(z))
+            except ValueError:
+                continue
+            
+            if sizes:
+                yield name, coord, ext, key.size
+            else:
+                yield name, coord, ext
         
     def read(self, layer, coord, format):
         """ Read a cached tile.
+        
+            Makes a single GET request; a 404 response is a cache miss, and
+            the tile age is checked against the Last-Modified response header.
         """
         key_name = tile_key(layer, coord, format)
-        key = self.bucket.get_key(key_name)
+        key = self._bucket().new_key(key_name)
         
-        if key is None:
-            return None
+        try:
+            body = key.get_contents_as_string()
+        except S3ResponseError, e:
+            if e.status == 404:
+                return None
+            raise
         
         if layer.cache_lifespan:
             t = timegm(strptime(key.last_modified, '%a, %d %b %Y %H:%M:%S %Z'))
@@ -107,13 +288,13 @@ class Cache:
             if (time() - t) > layer.cache_lifespan:
                 return None
         
-        return key.get_contents_as_string()
+        return body
         
     def save(self, body, layer, coord, format):
         """ Save a cached tile.
         """
         key_name = tile_key(layer, coord, format)
-        key = self.bucket.new_key(key_name)
+        key = self._bucket().new_key(key_name)
         
         content_type, encoding = guess_type('example.'+format)
         headers = content_type and {'Content-Type': content_type} or {}
@@ -0,0 +1,563 @@
+""" Durable queue of seeding jobs, for seeding with several machines at once.
+
+One tilestache-seed.py command puts metatile jobs in a shared queue, and any
+number of tilestache-seed.py workers on any number of machines take jobs from
+it until none are left:
+
+    tilestache-seed.py -c config.json -l osm -b 52.55 13.28 52.46 13.51 --queue /shared/osm.queue --enqueue 11 12 13
+    tilestache-seed.py -c config.json -l osm --queue /shared/osm.queue --work --workers 8
+    tilestache-seed.py -c config.json -l osm --queue /shared/osm.queue --queue-status
+
+Each job is one metatile's worth of tiles for one layer. Workers claim a few
+jobs at a time with a lease, and renew leases with a heartbeat while they work.
+A job whose lease runs out, for example because its worker died, goes back in
+the queue for another worker to claim. Failed jobs are put back too, and given
+up on after a few attempts. Workers record their progress in the queue, so
+that the status shows throughput for each worker and a finishing time.
+
+Jobs are only tiles, and workers seed them with the tile format, cache, and
+other options of their own command line, which will usually be the same as
+the command that queued the jobs. Workers stop once there is nothing left to
+claim, and jobs leased to workers that died are claimed again by workers that
+are still running or started later.
+
+Queues are given as a path or a URL:
+
+- A plain path is a SQLite database file, created when jobs are first added.
+  It can live on storage shared between machines, as long as the storage
+  supports SQLite's file locking.
+- A redis://host:port/db URL is a Redis server, with an optional name for
+  the queue after a "#", e.g. redis://localhost:6379/0#osm. Requires redis-py.
+"""
+import socket
+import logging
+
+from os import getpid
+from time import time, sleep
+from threading import Thread, Event, Lock, local
+
+try:
+    from json import dumps as json_dumps, loads as json_loads
+except ImportError:
+    from simplejson import dumps as json_dumps, loads as json_loads
+
+# Heroku is missing standard python's sqlite3 package, so this will ImportError.
+from sqlite3 import connect as _connect
+
+try:
+    import redis
+except ImportError:
+    # only needed for queues on a Redis server.
+    pass
+
+from ModestMaps.Core import Coordinate
+
+# jobs added to a queue in each transaction.
+_enqueue_batch = 1000
+
+# Redis scripts, so that a job is never out of both the queued list and the
+# leased set if a worker dies halfway through moving it from one to the other,
+# and a lease is only renewed for a job that's still leased.
+
+_redis_claim = """
+    local member = redis.call('LPOP', KEYS[1])
+
+    if not member then
+        return false
+    end
+
+    local info = cjson.decode(member)
+    info['attempts'] = info['attempts'] + 1
+
+    local key = cjson.encode(info)
+    redis.call('ZADD', KEYS[2], ARGV[1], key)
+
+    return key
+"""
+
+_redis_unlease = """
+    if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then
+        return 0
+    end
+
+    if ARGV[3] == 'first' then
+        redis.call('LPUSH', KEYS[2], ARGV[2])
+    else
+        redis.call('RPUSH', KEYS[2], ARGV[2])
+    end
+
+    return 1
+"""
+
+_redis_renew = """
+    for i = 2, #ARGV do
+        if redis.call('ZSCORE', KEYS[1], ARGV[i]) then
+            redis.call('ZADD', KEYS[1], ARGV[1], ARGV[i])
+        end
+    end
+
+    return 0
+"""
+
+def getQueue(location, lease=300, attempts=3):
+    """ Return a queue for a path or Redis URL.
+
+        Lease is the number of seconds a claimed job is held for without a
+        heartbeat, and attempts the number of times a job is tried at most.
+    """
+    if location.startswith('redis://'):
+        url, sep, name = location.partition('#')
+        return RedisQueue(url, name or 'tilestache-seed', lease, attempts)
+
+    return SQLiteQueue(location, lease, attempts)
+
+def workerName():
+    """ Return a name for this worker process, unique across machines.
+    """
+    return '%s:%d' % (socket.gethostname(), getpid())
+
+def enqueue(queue, layer_name, coordinates, metatile):
+    """ Add a stream of (offset, count, coordinate) tuples to a queue, return a job count.
+
+        Consecutive tiles of a metatile become a single job.
+    """
+    rows, columns = metatile.rows, metatile.columns
+    jobs, job, key, total = [], None, None, 0
+
+    for (offset, count, coord) in coordinates:
+        row, column, zoom = int(coord.row), int(coord.column), coord.zoom
+        coord_key = zoom, row // rows, column // columns
+
+        if coord_key != key:
+            if len(jobs) >= _enqueue_batch:
+                queue.add(layer_name, jobs)
+                total += len(jobs)
+                jobs = []
+
+            job, key = (zoom, []), coord_key
+            jobs.append(job)
+
+        job[1].append((row, column))
+
+    if jobs:
+        queue.add(layer_name, jobs)
+        total += len(jobs)
+
+    return total
+
+class Job:
+    """ A claimed job: one zoom level and a list of (row, column) tiles.
+    """
+    def __init__(self, id, zoom, tiles, attempts, key=None):
+        self.id = id
+        self.zoom = zoom
+        self.tiles = tiles
+        self.attempts = attempts
+        self.key = key
+
+class SQLiteQueue:
+    """ Queue of seeding jobs in a SQLite database file.
+
+        Claims are made in an immediate transaction, so that two workers
+        never claim the same job. Each thread keeps its own connection.
+    """
+    def __init__(self, path, lease=300, attempts=3):
+        self.path = path
+        self.lease = lease
+        self.attempts = attempts
+
+        self._local = local()
+
+        db = self._db()
+        db.execute("""CREATE TABLE IF NOT EXISTS jobs
+                      (
+                        id INTEGER PRIMARY KEY, layer TEXT, zoom INTEGER,
+                        tiles TEXT, size INTEGER, state TEXT, worker TEXT,
+                        expires REAL, attempts INTEGER, error TEXT
+                      )""")
+
+        db.execute('CREATE INDEX IF NOT EXISTS jobs_layer_state ON jobs (layer, state, id)')
+
+        db.execute("""CREATE TABLE IF NOT EXISTS workers
+                      (
+                        name TEXT, layer TEXT, started REAL, seen REAL,
+                        jobs INTEGER, tiles INTEGER,
+                        PRIMARY KEY (name, layer)
+                      )""")
+
+    def _db(self):
+        """ Return a persistent connection for the current thread.
+        """
+        if not hasattr(self._local, 'db'):
+            self._local.db = _connect(self.path, timeout=60, isolation_level=None)
+
+        return self._local.db
+
+    def _transaction(self, func, *args):
+        """ Call func(db, *args) in an immediate transaction, return its result.
+        """
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+
+        try:
+            result = func(db, *args)
+        except:
+            db.execute('ROLLBACK')
+            raise
+        else:
+            db.execute('COMMIT')
+
+        return result
+
+    def _seen(self, db, layer_name, worker, jobs=0, tiles=0):
+        """ Note a sign of life from a worker, with any finished jobs and tiles.
+        """
+        now = time()
+        db.execute('INSERT OR IGNORE INTO workers (name, layer, started, seen, jobs, tiles) VALUES (?, ?, ?, ?, 0, 0)',
+                   (worker, layer_name, now, now))
+        db.execute('UPDATE workers SET seen=?, jobs=jobs+?, tiles=tiles+? WHERE name=? AND layer=?',
+                   (now, jobs, tiles, worker, layer_name))
+
+    def add(self, layer_name, jobs):
+        """ Add a list of (zoom, tiles) jobs.
+        """
+        rows = [(layer_name, zoom, json_dumps(tiles), len(tiles)) for (zoom, tiles) in jobs]
+        q = "INSERT INTO jobs (layer, zoom, tiles, size, state, attempts) VALUES (?, ?, ?, ?, 'queued', 0)"
+
+        self._transaction(lambda db: db.executemany(q, rows))
+
+    def claim(self, layer_name, worker, count):
+        """ Claim up to count jobs for a worker, return a list of Jobs.
+
+            Jobs with expired leases are put back in the queue first.
+        """
+        def claim(db):
+            now = time()
+
+            db.execute("UPDATE jobs SET state='queued', worker=NULL WHERE layer=? AND state='leased' AND expires<?",
+                       (layer_name, now))
+
+            rows = db.execute("SELECT id, zoom, tiles, attempts FROM jobs WHERE layer=? AND state='queued' ORDER BY id LIMIT ?",
+                              (layer_name, count)).fetchall()
+
+            db.executemany("UPDATE jobs SET state='leased', worker=?, expires=?, attempts=attempts+1 WHERE id=?",
+                           [(worker, now + self.lease, id) for (id, z, t, a) in rows])
+
+            self._seen(db, layer_name, worker)
+
+            return [Job(id, zoom, [tuple(tile) for tile in json_loads(tiles)], attempts + 1)
+                    for (id, zoom, tiles, attempts) in rows]
+
+        return self._transaction(claim)
+
+    def renew(self, layer_name, worker, jobs):
+        """ Extend the leases of a worker's jobs.
+        """
+        def renew(db):
+            db.executemany("UPDATE jobs SET expires=? WHERE id=? AND worker=? AND state='leased'",
+                           [(time() + self.lease, job.id, worker) for job in jobs])
+
+            self._seen(db, layer_name, worker)
+
+        self._transaction(renew)
+
+    def complete(self, layer_name, worker, job):
+        """ Mark a job done.
+        """
+        def complete(db):
+            db.execute("UPDATE jobs SET state='done', expires=NULL WHERE id=?", (job.id, ))
+            self._seen(db, layer_name, worker, 1, len(job.tiles))
+
+        self._transaction(complete)
+
+    def fail(self, layer_name, worker, job, error):
+        """ Put a failed job back in the queue, or give up on it after too many attempts.
+        """
+        state = job.attempts < self.attempts and 'queued' or 'failed'
+
+        def fail(db):
+            db.execute('UPDATE jobs SET state=?, worker=NULL, expires=NULL, error=? WHERE id=?', (state, error, job.id))
+            self._seen(db, layer_name, worker)
+
+        self._transaction(fail)
+
+    def release(self, layer_name, worker, jobs):
+        """ Put a worker's unfinished jobs back in the queue, without counting an attempt.
+        """
+        q = "UPDATE jobs SET state='queued', worker=NULL, expires=NULL, attempts=attempts-1 WHERE id=? AND worker=? AND state='leased'"
+        self._transaction(lambda db: db.executemany(q, [(job.id, worker) for job in jobs]))
+
+    def remaining(self, layer_name):
+        """ Return the number of tiles in queued and leased jobs.
+        """
+        q = "SELECT SUM(size) FROM jobs WHERE layer=? AND state IN ('queued', 'leased')"
+        return self._db().execute(q, (layer_name, )).fetchone()[0] or 0
+
+    def status(self, layer_name):
+        """ Return a dictionary of job and tile counts by state, and a list of workers.
+
+            Workers are dictionaries with "name", "started", "seen", "jobs",
+            and "tiles" keys.
+        """
+        db = self._db()
+        counts = dict([(state, (0, 0)) for state in ('queued', 'leased', 'done', 'failed')])
+
+        for (state, jobs, tiles) in db.execute('SELECT state, COUNT(*), SUM(size) FROM jobs WHERE layer=? GROUP BY state', (layer_name, )):
+            counts[str(state)] = jobs, tiles or 0
+
+        rows = db.execute('SELECT name, started, seen, jobs, tiles FROM workers WHERE layer=? ORDER BY name', (layer_name, ))
+        workers = [dict(name=name, started=started, seen=seen, jobs=jobs, tiles=tiles)
+                   for (name, started, seen, jobs, tiles) in rows]
+
+        return dict(counts, workers=workers)
+
+class RedisQueue:
+    """ Queue of seeding jobs on a Redis server.
+
+        Each layer has a list of queued jobs, a sorted set of leased jobs
+        scored by lease expiration, a hash of counts, and a hash of workers.
+        Jobs are JSON strings, and a leased job is put back by whichever
+        worker first removes it from the leased set. Jobs move between the
+        list and the set in Lua scripts, so that each move is atomic.
+        Requires Redis 2.6 or newer.
+    """
+    def __init__(self, url, name, lease=300, attempts=3):
+        self.redis = redis.StrictRedis.from_url(url)
+        self.name = name
+        self.lease = lease
+        self.attempts = attempts
+
+        self._claim = self.redis.register_script(_redis_claim)
+        self._unlease = self.redis.register_script(_redis_unlease)
+        self._renew = self.redis.register_script(_redis_renew)
+
+    def _key(self, layer_name, part):
+        return '%s:%s:%s' % (self.name, layer_name, part)
+
+    def _seen(self, layer_name, worker, jobs=0, tiles=0):
+        """ Note a sign of life from a worker, with any finished jobs and tiles.
+        """
+        key, now = self._key(layer_name, 'workers'), time()
+        info = json_loads(self.redis.hget(key, worker) or 'null') or dict(started=now, jobs=0, tiles=0)
+
+        info.update(seen=now, jobs=info['jobs'] + jobs, tiles=info['tiles'] + tiles)
+        self.redis.hset(key, worker, json_dumps(info))
+
+    def _requeue(self, layer_name, member, queued_member, end='last'):
+        """ Move a job from the leased set back to the queue, return true if it was there.
+        """
+        keys = [self._key(layer_name, 'leased'), self._key(layer_name, 'queued')]
+        return bool(self._unlease(keys=keys, args=[member, queued_member, end]))
+
+    def add(self, layer_name, jobs):
+        """ Add a list of (zoom, tiles) jobs.
+        """
+        first = self.redis.incr(self._key(layer_name, 'ids'), len(jobs)) - len(jobs)
+        pipe = self.redis.pipeline()
+
+        for (index, (zoom, tiles)) in enumerate(jobs):
+            job = dict(id=first + index, zoom=zoom, tiles=tiles, attempts=0)
+            pipe.rpush(self._key(layer_name, 'queued'), json_dumps(job))
+
+        pipe.hincrby(self._key(layer_name, 'counts'), 'queued tiles', sum([len(tiles) for (z, tiles) in jobs]))
+        pipe.execute()
+
+    def claim(self, layer_name, worker, count):
+        """ Claim up to count jobs for a worker, return a list of Jobs.
+
+            Jobs with expired leases are put back in the queue first.
+        """
+        leased, queued = self._key(layer_name, 'leased'), self._key(layer_name, 'queued')
+
+        for member in self.redis.zrangebyscore(leased, '-inf', time()):
+            self._requeue(layer_name, member, member)
+
+        jobs = []
+
+        while len(jobs) < count:
+            member = self._claim(keys=[queued, leased], args=[time() + self.lease])
+
+            if member is None:
+                break
+
+            info = json_loads(member)
+            job = Job(info['id'], info['zoom'], [tuple(tile) for tile in info['tiles']],
+                      info['attempts'], member)
+
+            jobs.append(job)
+
+        self._seen(layer_name, worker)
+
+        return jobs
+
+    def renew(self, layer_name, worker, jobs):
+        """ Extend the leases of a worker's jobs.
+        """
+        if jobs:
+            # jobs done or put back by now are left alone.
+            args = [time() + self.lease] + [job.key for job in jobs]
+            self._renew(keys=[self._key(layer_name, 'leased')], args=args)
+
+        self._seen(layer_name, worker)
+
+    def complete(self, layer_name, worker, job):
+        """ Mark a job done.
+        """
+        if self.redis.zrem(self._key(layer_name, 'leased'), job.key):
+            counts = self._key(layer_name, 'counts')
+            self.redis.hincrby(counts, 'queued tiles', -len(job.tiles))
+            self.redis.hincrby(counts, 'done jobs', 1)
+            self.redis.hincrby(counts, 'done tiles', len(job.tiles))
+
+        self._seen(layer_name, worker, 1, len(job.tiles))
+
+    def fail(self, layer_name, worker, job, error):
+        """ Put a failed job back in the queue, or give up on it after too many attempts.
+        """
+        if job.attempts < self.attempts:
+            self._requeue(layer_name, job.key, job.key)
+
+        elif self.redis.zrem(self._key(layer_name, 'leased'), job.key):
+            counts = self._key(layer_name, 'counts')
+            self.redis.hincrby(counts, 'queued tiles', -len(job.tiles))
+            self.redis.hincrby(counts, 'failed jobs', 1)
+            self.redis.hincrby(counts, 'failed tiles', len(job.tiles))
+            self.redis.rpush(self._key(layer_name, 'failed'), json_dumps(dict(json_loads(job.key), error=error)))
+
+        self._seen(layer_name, worker)
+
+    def release(self, layer_name, worker, jobs):
+        """ Put a worker's unfinished jobs back in the queue, without counting an attempt.
+        """
+        for job in jobs:
+            info = json_loads(job.key)
+            info['attempts'] -= 1
+            self._requeue(layer_name, job.key, json_dumps(info), 'first')
+
+    def remaining(self, layer_name):
+        """ Return the number of tiles in queued and leased jobs.
+        """
+        return int(self.redis.hget(self._key(layer_name, 'counts'), 'queued tiles') or 0)
+
+    def status(self, layer_name):
+        """ Return a dictionary of job and tile counts by state, and a list of workers.
+
+            Tile counts of queued and leased jobs are only known together,
+            and are all given as queued.
+        """
+        counts = self.redis.hgetall(self._key(layer_name, 'counts'))
+        count = lambda name: int(counts.get(name, 0))
+
+        queued_jobs = self.redis.llen(self._key(layer_name, 'queued'))
+        leased_jobs = self.redis.zcard(self._key(layer_name, 'leased'))
+
+        workers = [dict(json_loads(info), name=name)
+                   for (name, info) in sorted(self.redis.hgetall(self._key(layer_name, 'workers')).items())]
+
+        return dict(queued=(queued_jobs, count('queued tiles')), leased=(leased_jobs, 0),
+                    done=(count('done jobs'), count('done tiles')),
+                    failed=(count('failed jobs'), count('failed tiles')),
+                    workers=workers)
+
+class Claims:
+    """ Tiles of jobs claimed from a queue by one worker, for a Seeder.
+
+        coordinates() claims jobs a few at a time and generates their tiles,
+        until the queue has no more jobs to claim. Results for each tile are
+        reported back with tileDone(), and a job is marked done or failed in
+        the queue once all of its tiles are in. A heartbeat thread renews the
+        leases of jobs in progress, and close() puts back any that are left.
+    """
+    def __init__(self, queue, layer_name, worker, count=16):
+        self.queue = queue
+        self.layer_name = layer_name
+        self.worker = worker
+        self.count = count
+
+        # jobs in progress by id, remaining tile counts, and jobs by tile.
+        self._jobs, self._remaining, self._errors, self._tiles = {}, {}, {}, {}
+        self._lock = Lock()
+
+        self._closed = Event()
+        self._heartbeat = Thread(target=self._beat)
+        self._heartbeat.setDaemon(True)
+        self._heartbeat.start()
+
+    def _beat(self):
+        """ Renew leases of jobs in progress, until closed.
+        """
+        while not self._closed.wait(self.queue.lease / 3.):
+            with self._lock:
+                jobs = self._jobs.values()
+
+            try:
+                self.queue.renew(self.layer_name, self.worker, jobs)
+            except:
+                # keep trying, or the leases run out while the jobs are still being seeded.
+                logging.exception('TileStache.SeedQueue.Claims._beat() failed to renew %d leases', len(jobs))
+
+    def coordinates(self):
+        """ Generate a stream of (offset, count, coordinate) tuples for seeding.
+
+            Counts are estimates from the tiles left in the queue, checked
+            every few seconds.
+        """
+        offset, count, checked = 0, 0, 0
+
+        while not self._closed.is_set():
+            jobs = self.queue.claim(self.layer_name, self.worker, self.count)
+
+            if not jobs:
+                break
+
+            if time() - checked > 10:
+                count, checked = offset + self.queue.remaining(self.layer_name), time()
+
+            with self._lock:
+                for job in jobs:
+                    self._jobs[job.id] = job
+                    self._remaining[job.id] = len(job.tiles)
+
+                    for (row, column) in job.tiles:
+                        self._tiles[(row, column, job.zoom)] = job.id
+
+            for job in jobs:
+                for (row, column) in job.tiles:
+                    yield (offset, max(count, offset + 1), Coordinate(row, column, job.zoom))
+                    offset += 1
+
+    def tileDone(self, coord, error=None):
+        """ Note a seeded tile, with an error string if it failed.
+        """
+        with self._lock:
+            id = self._tiles.pop((int(coord.row), int(coord.column), coord.zoom), None)
+
+            if id is None:
+                return
+
+            if error is not None:
+                self._errors[id] = error
+
+            self._remaining[id] -= 1
+
+            if self._remaining[id] > 0:
+                return
+
+            job, error = self._jobs.pop(id), self._errors.pop(id, None)
+            del self._remaining[id]
+
+        if error is None:
+            self.queue.complete(self.layer_name, self.worker, job)
+        else:
+            self.queue.fail(self.layer_name, self.worker, job, error)
+
+    def close(self):
+        """ Stop the heartbeat, and put back jobs that aren't finished.
+        """
+        self._closed.set()
+
+        with self._lock:
+            jobs, self._jobs = self._jobs.values(), {}
+
+        if jobs:
+            self.queue.release(self.layer_name, self.worker, jobs)
@@ -0,0 +1,631 @@
+""" Parallel cache seeding, the engine behind tilestache-seed.py.
+
+Seeding renders a long stream of tiles, one at a time, into a layer's cache.
+Work can be spread over several worker processes, each with a few threads:
+
+  - Processes each build their own Configuration from the same configuration
+    dictionary, so that providers with process-wide state such as Mapnik or
+    OGR never share it between processes.
+  - Threads in one process share a Configuration, and suit providers that
+    spend their time waiting, e.g. on a remote server or database.
+
+Tiles are handed to workers in small batches of jobs, one job for each run of
+tiles from the same metatile. A job is seeded tile by tile in a single thread,
+so the metatile is rendered once for its first tile and the rest are found in
+the cache or among recent tiles, without other threads waiting on its lock.
+metatileCoordinates() makes tiles in metatile order, and visits metatiles along
+a Hilbert curve so that consecutive renders are of neighboring areas, keeping
+database and datasource caches warm. It can skip metatiles already finished
+according to a Journal, see TileStache.Journal. geometryCoordinates() does the
+same for an area given as a GeoJSON geometry instead of a bounding box, and
+requires shapely.
+
+Coordinates are streamed from start to finish and never collected in a list,
+and batches are kept in compact arrays, so memory use stays flat however many
+tiles there are to seed. Results come back to the calling process in the same
+order the tiles went out, so that progress reports, error lists, and progress
+files are written from one place.
+
+Seeding stops early when stop() is called, for example from a SIGINT handler.
+Workers ignore SIGINT themselves, finish the tiles they're working on, and
+release their cache locks as usual before exiting. Each worker flushes its
+cache on the way out, so that tiles still queued for an MBTiles writer thread
+are committed rather than lost, and seeding in just this process flushes the
+cache when it's done, raising any error from the flush.
+"""
+import signal
+
+from sys import stderr
+from array import array
+from traceback import format_exc
+from collections import deque
+from threading import Event as ThreadEvent
+from multiprocessing import Pool, Event as ProcessEvent
+from multiprocessing.pool import ThreadPool
+from multiprocessing.util import Finalize
+
+from math import floor
+
+from ModestMaps.Core import Coordinate
+from ModestMaps.Geo import Location
+
+try:
+    from json import load as json_load
+except ImportError:
+    from simplejson import load as json_load
+
+try:
+    from shapely.geometry import shape, box
+    from shapely.ops import transform, unary_union
+    from shapely.prepared import prep
+except ImportError:
+    # only needed for seeding an area given as a geometry.
+    pass
+
+# furthest latitude from the equator in spherical mercator.
+_max_lat = 85.0511
+
+# tiles handed to a worker at a time.
+_batch_size = 16
+
+# state of the current worker process, set by _initWorker().
+_worker = {}
+
+class Seeder:
+    """ Renders a stream of tiles into a layer's cache.
+
+        Constructor arguments:
+        - config_dict, dirpath: configuration dictionary and directory path,
+          for buildConfiguration(). Used to build a new configuration in
+          each worker process.
+        - layer_name: name of the layer to seed.
+        - extension: filename extension of tiles, e.g. "png".
+        - workers: number of worker processes, default 1 for just this one.
+        - threads: number of threads in each worker process, default 1.
+        - ignore_cached: re-render every tile, whether it's cached or not.
+        - attempts: number of times to try rendering a tile, default 1.
+        - callback: optional JSONP callback to save wrapped JSON tiles with.
+        - layer: optional existing layer for seeding in this process, used
+          instead of building a new configuration when workers is 1. Its
+          metatile size is used to group tiles into jobs, one tile per job
+          without it.
+    """
+    def __init__(self, config_dict, dirpath, layer_name, extension, workers=1, threads=1, ignore_cached=False, attempts=1, callback=None, layer=None):
+        self.config_dict = config_dict
+        self.dirpath = dirpath
+        self.layer_name = layer_name
+        self.extension = extension
+        self.workers = workers
+        self.threads = threads
+        self.ignore_cached = ignore_cached
+        self.attempts = attempts
+        self.callback = callback
+        self.layer = layer
+
+        metatile = layer and layer.metatile
+        self.rows, self.columns = metatile and (metatile.rows, metatile.columns) or (1, 1)
+
+        self._stop = workers > 1 and ProcessEvent() or ThreadEvent()
+
+    def stop(self):
+        """ Stop seeding after tiles already being rendered are done.
+        """
+        self._stop.set()
+
+    def stopped(self):
+        """ Return true if stop() has been called.
+        """
+        return self._stop.is_set()
+
+    def seed(self, coordinates):
+        """ Generate a result dictionary for each (offset, count, coordinate).
+
+            Results have "offset", "total", "tile", "coord", "size", and
+            "error" keys; error is None for success, or a traceback string.
+            Tiles not rendered because of stop() have no result.
+        """
+        args = self.config_dict, self.dirpath, self.layer_name, self.extension, \
+               self.threads, self.ignore_cached, self.attempts, self.callback, self._stop
+
+        if self.workers > 1:
+            # worker processes ignore SIGINT, and rely on stop() instead.
+            pool = Pool(self.workers, _initWorker, args)
+            submit = lambda batch: pool.apply_async(_seedBatch, (batch, ))
+        else:
+            _initWorker(*args, layer=self.layer)
+            pool = None
+            submit = lambda batch: _Finished(_seedBatch(batch))
+
+        pending = deque()
+
+        try:
+            for batch in _batches(coordinates, _batch_size, self.rows, self.columns):
+                if self.stopped():
+                    break
+
+                pending.append(submit(batch))
+
+                # keep a few batches waiting for each worker, and no more.
+                while len(pending) > self.workers * 2:
+                    for result in _wait(pending.popleft()):
+                        yield result
+
+            while pending:
+                for result in _wait(pending.popleft()):
+                    yield result
+
+            if pool is None:
+                # a failed flush loses tiles, so it's left to the caller.
+                flushCache(_worker['layer'].config.cache)
+
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+            elif _worker.get('pool') is not None:
+                # seeding here again builds a new thread pool.
+                _worker['pool'].close()
+                _worker['pool'].join()
+                _worker['pool'] = None
+
+class _Finished:
+    """ Already-finished stand-in for multiprocessing.pool.AsyncResult.
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def wait(self, timeout):
+        pass
+
+    def ready(self):
+        return True
+
+    def get(self):
+        return self.value
+
+def _wait(async_result):
+    """ Return the value of an AsyncResult, staying responsive to signals.
+
+        A plain get() with no timeout blocks signal handlers in Python 2.
+    """
+    while not async_result.ready():
+        async_result.wait(1)
+
+    return async_result.get()
+
+class CoordinateBatch:
+    """ Compact batch of jobs, each a run of tiles from one metatile.
+
+        Tiles are kept in flat arrays rather than as lists of coordinates or
+        tuples, so that batches are small in memory and quick to send to
+        worker processes. All tiles in a batch share one total count.
+    """
+    def __init__(self, count):
+        self.count = count
+        self.offsets = array('d')
+        self.coords = array('l')
+        self.starts = array('l')
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def startJob(self):
+        """ Start a new job with the next tile added.
+        """
+        self.starts.append(len(self.offsets))
+
+    def add(self, offset, row, column, zoom):
+        """ Add a tile to the current job.
+        """
+        self.offsets.append(offset)
+        self.coords.extend((row, column, zoom))
+
+    def jobs(self):
+        """ Return a list of jobs, each a list of (offset, count, (row, column, zoom)) tuples.
+        """
+        ends = list(self.starts[1:]) + [len(self.offsets)]
+        tile = lambda i: (int(self.offsets[i]), self.count, tuple(self.coords[i*3:i*3+3]))
+
+        return [[tile(i) for i in range(start, end)] for (start, end) in zip(self.starts, ends)]
+
+    def __getstate__(self):
+        return self.count, self.offsets.tostring(), self.coords.tostring(), self.starts.tostring()
+
+    def __setstate__(self, state):
+        self.count, offsets, coords, starts = state
+        self.offsets, self.coords, self.starts = array('d'), array('l'), array('l')
+        self.offsets.fromstring(offsets)
+        self.coords.fromstring(coords)
+        self.starts.fromstring(starts)
+
+def _batches(coordinates, size, rows, columns):
+    """ Group a stream of (offset, count, coordinate) tuples into CoordinateBatches.
+
+        Each job is a run of consecutive tiles from one metatile, and a batch
+        has at least size tiles, ending where a job does.
+    """
+    batch, key = None, None
+
+    for (offset, count, coord) in coordinates:
+        row, column, zoom = int(coord.row), int(coord.column), coord.zoom
+        coord_key = zoom, row // rows, column // columns
+
+        if batch is None:
+            batch = CoordinateBatch(count)
+
+        if coord_key != key:
+            if len(batch) >= size:
+                yield batch
+                batch = CoordinateBatch(count)
+
+            batch.startJob()
+            key = coord_key
+
+        batch.add(offset, row, column, zoom)
+
+    if batch is not None:
+        yield batch
+
+def tileAreas(ul, lr, zooms, padding):
+    """ Return a list of (zoom, top row, left column, bottom row, right column) areas.
+
+        Areas cover two corner coordinates at each zoom, with padding.
+    """
+    areas = []
+
+    for zoom in zooms:
+        ul_ = ul.zoomTo(zoom).container().left(padding).up(padding)
+        lr_ = lr.zoomTo(zoom).container().right(padding).down(padding)
+        areas.append((zoom, int(ul_.row), int(ul_.column), int(lr_.row), int(lr_.column)))
+
+    return areas
+
+def metatileCoordinates(ul, lr, zooms, padding, metatile, journal=None, existing=None):
+    """ Generate a stream of (offset, count, coordinate) tuples for seeding.
+
+        Covers the same tiles as a row-by-row flood-fill between two corners,
+        for a list of zooms and padding. Tiles of each metatile come together,
+        and metatiles come in Hilbert curve order across each zoom level.
+
+        Metatiles marked done in an optional Journal are skipped, but still
+        counted in offsets. So are tiles found by an optional existing(zoom,
+        top row, left column, bottom row, right column) function, which
+        returns a set of (row, column) tiles already cached in a range, e.g.
+        with TileStache.Inventory.
+    """
+    areas = [_Area(area, metatile) for area in tileAreas(ul, lr, zooms, padding)]
+
+    return _areaCoordinates(areas, journal, existing)
+
+def loadGeometry(filename, projection):
+    """ Load a GeoJSON file of geographic shapes, return one shapely geometry.
+
+        The geometry is returned in zoom level 0 tile space, with tile columns
+        for x and rows for y, so that a tile at zoom z is a square 2^-z wide.
+    """
+    data = json_load(open(filename, 'r'))
+
+    if data.get('type') == 'FeatureCollection':
+        geometries = [feature['geometry'] for feature in data['features']]
+    elif data.get('type') == 'Feature':
+        geometries = [data['geometry']]
+    else:
+        geometries = [data]
+
+    geometry = unary_union([shape(geometry) for geometry in geometries if geometry])
+
+    def project(lons, lats, zs=None):
+        locations = [Location(max(-_max_lat, min(_max_lat, lat)), lon) for (lon, lat) in zip(lons, lats)]
+        coords = [projection.locationCoordinate(location).zoomTo(0) for location in locations]
+
+        return [coord.column for coord in coords], [coord.row for coord in coords]
+
+    return transform(project, geometry)
+
+def geometryAreas(geometry, zooms):
+    """ Return a list of (zoom, top row, left column, bottom row, right column) areas.
+
+        Areas cover the bounding box of a loadGeometry() result at each zoom.
+    """
+    xmin, ymin, xmax, ymax = geometry.bounds
+    areas = []
+
+    for zoom in zooms:
+        scale, last = 2 ** zoom, 2 ** zoom - 1
+
+        areas.append((zoom, max(0, int(floor(ymin * scale))), max(0, int(floor(xmin * scale))),
+                            min(last, int(floor(ymax * scale))), min(last, int(floor(xmax * scale)))))
+
+    return areas
+
+def geometryCoordinates(geometry, zooms, metatile, journal=None, existing=None):
+    """ Generate a stream of (offset, count, coordinate) tuples for seeding.
+
+        Covers the tiles that intersect a loadGeometry() result at each zoom,
+        grouped and ordered like metatileCoordinates(). Tiles are found by
+        quadtree descent over blocks of metatiles: blocks outside the geometry
+        are dropped whole, and blocks inside it are taken whole, so that only
+        metatiles along its edges need tiles tested one by one.
+    """
+    prepared = prep(geometry)
+    areas = [_Area(area, metatile, prepared) for area in geometryAreas(geometry, zooms)]
+
+    return _areaCoordinates(areas, journal, existing)
+
+def _areaCoordinates(areas, journal, existing):
+    """ Generate a stream of (offset, count, coordinate) tuples for a list of _Areas.
+    """
+    # start with a simple total of all the coordinates we will need.
+    count = sum([area.count() for area in areas])
+    offset = 0
+
+    for area in areas:
+        for (x, y, partial) in area.metatiles():
+            tiles = area.tiles(x, y, partial)
+
+            if not tiles:
+                continue
+
+            if journal and journal.isDone(area.zoom, x, y):
+                offset += len(tiles)
+                continue
+
+            found = existing and existing(area.zoom, *area.limits(x, y, x, y)) or set()
+
+            if journal:
+                journal.expect(area.zoom, x, y, len([tile for tile in tiles if tile not in found]))
+
+            for (row, column) in tiles:
+                if (row, column) not in found:
+                    yield (offset, count, Coordinate(row, column, area.zoom))
+
+                offset += 1
+
+class _Area:
+    """ Tiles to seed at one zoom level, optionally limited to a prepared geometry.
+
+        Metatiles are given in x, y metatile units, and square blocks of them
+        by their upper-left metatile and a power-of-two size.
+    """
+    def __init__(self, area, metatile, prepared=None):
+        self.zoom, self.row1, self.col1, self.row2, self.col2 = area
+        self.rows, self.columns = metatile.rows, metatile.columns
+        self.prepared = prepared
+
+        # bounds of the area in whole metatiles, and a square block to cover it.
+        self.bounds = self.col1 // self.columns, self.row1 // self.rows, \
+                      self.col2 // self.columns, self.row2 // self.rows
+
+        self.size = 1
+
+        while self.size <= max(self.bounds[2] - self.bounds[0], self.bounds[3] - self.bounds[1]):
+            self.size *= 2
+
+    def _box(self, row1, col1, row2, col2):
+        """ Return a shapely box in tile space for a range of tiles.
+        """
+        scale = 2. ** -self.zoom
+        return box(col1 * scale, row1 * scale, (col2 + 1) * scale, (row2 + 1) * scale)
+
+    def test(self, x, y, size):
+        """ Return 0 for a block outside the geometry, 1 for partly inside, 2 for inside.
+        """
+        block = self._box(y * self.rows, x * self.columns,
+                          (y + size) * self.rows - 1, (x + size) * self.columns - 1)
+
+        if not self.prepared.intersects(block):
+            return 0
+
+        if self.prepared.contains(block):
+            return 2
+
+        return 1
+
+    def limits(self, x1, y1, x2, y2):
+        """ Return top row, left column, bottom row, right column of tiles in a rectangle of metatiles.
+        """
+        return max(self.row1, y1 * self.rows), max(self.col1, x1 * self.columns), \
+               min(self.row2, y2 * self.rows + self.rows - 1), min(self.col2, x2 * self.columns + self.columns - 1)
+
+    def tiles(self, x, y, partial):
+        """ Return a list of (row, column) tiles in a metatile.
+
+            Tiles of a metatile only partly inside the geometry are tested.
+        """
+        row1, col1, row2, col2 = self.limits(x, y, x, y)
+        tiles = [(row, column) for row in range(row1, row2 + 1) for column in range(col1, col2 + 1)]
+
+        if partial:
+            tiles = [(row, column) for (row, column) in tiles
+                     if self.prepared.intersects(self._box(row, column, row, column))]
+
+        return tiles
+
+    def metatiles(self):
+        """ Generate (x, y, partial) metatiles in Hilbert curve order.
+        """
+        test = self.prepared and self.test or None
+        bounds = self.bounds
+
+        return _hilbert(bounds[0], bounds[1], self.size, False, False, bounds, test)
+
+    def count(self):
+        """ Return the number of tiles in the area.
+        """
+        if self.prepared is None:
+            return (self.row2 + 1 - self.row1) * (self.col2 + 1 - self.col1)
+
+        return self._count(self.bounds[0], self.bounds[1], self.size, self.test)
+
+    def _count(self, x, y, size, test):
+        """ Return the number of tiles in a block of metatiles.
+        """
+        xmin, ymin, xmax, ymax = self.bounds
+        x1, y1, x2, y2 = max(x, xmin), max(y, ymin), min(x + size - 1, xmax), min(y + size - 1, ymax)
+
+        if x1 > x2 or y1 > y2:
+            return 0
+
+        if test is not None:
+            result = test(x, y, size)
+
+            if result == 0:
+                return 0
+
+            if result == 2:
+                test = None
+
+        if test is None:
+            row1, col1, row2, col2 = self.limits(x1, y1, x2, y2)
+            return (row2 + 1 - row1) * (col2 + 1 - col1)
+
+        if size == 1:
+            return len(self.tiles(x, y, True))
+
+        half = size // 2
+
+        return sum([self._count(x + qx * half, y + qy * half, half, test)
+                    for (qx, qy) in [(0, 0), (0, 1), (1, 1), (1, 0)]])
+
+# quadrants of a Hilbert curve in visiting order, each with the swap and flip
+# it adds to the curve inside it. Swap exchanges x and y, flip reverses both.
+_quadrants = [((0, 0), (True, False)), ((0, 1), (False, False)),
+              ((1, 1), (False, False)), ((1, 0), (True, True))]
+
+def _hilbert(x, y, size, swap, flip, bounds, test=None):
+    """ Generate (x, y, partial) cells of a square in Hilbert curve order.
+
+        The square has a power-of-two size and its upper-left corner at x, y.
+        Only cells inside (xmin, ymin, xmax, ymax) bounds are generated,
+        and quadrants entirely outside them are skipped without a visit.
+
+        An optional test(x, y, size) of square blocks returns 0 for blocks
+        to skip, 2 for blocks to take whole without testing inside them, and
+        1 for blocks to look into further. Partial is true for cells that
+        still tested 1 on their own.
+    """
+    xmin, ymin, xmax, ymax = bounds
+
+    if x > xmax or y > ymax or x + size <= xmin or y + size <= ymin:
+        return
+
+    if test is not None:
+        result = test(x, y, size)
+
+        if result == 0:
+            return
+
+        if result == 2:
+            test = None
+
+    if size == 1:
+        yield x, y, test is not None
+        return
+
+    half = size // 2
+
+    for ((qx, qy), (add_swap, add_flip)) in _quadrants:
+        if swap:
+            qx, qy = qy, qx
+
+        if flip:
+            qx, qy = 1 - qx, 1 - qy
+
+        for cell in _hilbert(x + qx * half, y + qy * half, half, swap != add_swap, flip != add_flip, bounds, test):
+            yield cell
+
+def _initWorker(config_dict, dirpath, layer_name, extension, threads, ignore_cached, attempts, callback, stop, layer=None):
+    """ Set up a worker process with its own configuration and thread pool.
+    """
+    from .Config import buildConfiguration
+
+    if layer is None:
+        # not sharing with the parent process, so ignore ^C and wait for stop().
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        config = buildConfiguration(config_dict, dirpath)
+        layer = config.layers[layer_name]
+
+        # pool workers leave with os._exit(), so atexit functions never run.
+        Finalize(None, flushCache, (config.cache, ), exitpriority=10)
+
+    _worker.update(layer=layer, extension=extension, ignore_cached=ignore_cached,
+                   attempts=attempts, callback=callback, stop=stop)
+
+    _worker['pool'] = threads > 1 and ThreadPool(threads) or None
+
+def flushCache(cache):
+    """ Write out tiles or updates that a cache is holding back, if it can.
+
+        The MBTiles cache queues tiles for its writer thread, and LimitedDisk
+        buffers last-read times, so both lose work if a process just exits.
+    """
+    if hasattr(cache, 'flush'):
+        cache.flush()
+
+def _seedBatch(batch):
+    """ Seed a CoordinateBatch of jobs, return a list of results.
+    """
+    if _worker['pool'] is None:
+        results = map(_seedJob, batch.jobs())
+    else:
+        results = _worker['pool'].map(_seedJob, batch.jobs())
+
+    return [result for job_results in results for result in job_results]
+
+def _seedJob(job):
+    """ Seed a list of (offset, count, coordinate tuple) tiles from one metatile in turn.
+
+        Returns a list of results, cut short if seeding has been stopped.
+    """
+    results = []
+
+    for tile in job:
+        if _worker['stop'].is_set():
+            break
+
+        results.append(_seedOne(tile))
+
+    return results
+
+def _seedOne(tile):
+    """ Render one tile with retries, return a result dictionary.
+    """
+    offset, count, (row, column, zoom) = tile
+    layer, extension = _worker['layer'], _worker['extension']
+    coord = Coordinate(row, column, zoom)
+
+    result = {'offset': offset + 1, 'total': count, 'coord': (row, column, zoom),
+              'tile': '%s/%d/%d/%d.%s' % (layer.name(), zoom, column, row, extension),
+              'size': None, 'error': None}
+
+    for attempt in range(_worker['attempts'], 0, -1):
+        try:
+            result['size'] = _seedTile(layer, coord, extension)
+
+        except:
+            result['error'] = format_exc()
+
+            if attempt > 1:
+                print >> stderr, 'Failed %s, will try %s more.' % (result['tile'], ['no', 'once', 'twice'][attempt - 1])
+
+        else:
+            result['error'] = None
+            break
+
+    return result
+
+def _seedTile(layer, coord, extension):
+    """ Render a single tile, and its JSONP version if called for, return its size.
+    """
+    from . import getTile
+
+    mimetype, content = getTile(layer, coord, extension, 1, _worker['ignore_cached'])
+    callback = _worker['callback']
+
+    if 'json' in mimetype and callback:
+        js_body = '%s(%s);' % (callback, content)
+        layer.config.cache.save(js_body, layer, coord, 'JS')
+
+    return content and len(content) or 0
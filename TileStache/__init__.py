@@ -38,6 +38,7 @@ _previous_configs = {}
 
 import Core
 import Config
+import Prefetch
 
 # regular expression for PATH_INFO
 _pathinfo_pat = re.compile(r'^/?(?P<l>\w.+)/(?P<z>\d+)/(?P<x>-?\d+)/(?P<y>-?\d+)\.(?P<e>\w+)$')
@@ -80,6 +81,9 @@ def getTile(layer, coord, extension, tile_scale, ignore_cached=False):
         body = Core._getRecentTile(layer, coord, format, tile_scale)
         tile_from = 'recent tiles'
     
+    if body is not None and tile_from == 'cache':
+        Prefetch.noteServed(layer, coord, format)
+    
     # If no tile was found, dig deeper
     if body is None:
         try:
@@ -130,6 +134,9 @@ def getTile(layer, coord, extension, tile_scale, ignore_cached=False):
                     cache.save(body, layer, coord, format)
 
                 tile_from = 'layer.render()'
+                
+                # Tiles nearby are likely to be asked for next.
+                Prefetch.afterMiss(layer, coord, extension)
 
         finally:
             if lockCoord:
@@ -6,11 +6,24 @@ West Oakland (http://sta.mn/ck) in the "osm" layer, for zoom levels 12-15:
 
     tilestache-clean.py -c ./config.json -l osm -b 37.79 -122.35 37.83 -122.25 -e png 12 13 14 15
 
+With a "generations" file in the configuration, a whole layer can be flushed
+at once, and the tiles of its old generations removed later at low priority:
+
+    tilestache-clean.py -c ./config.json -l osm --bump-generation
+    tilestache-clean.py -c ./config.json -l osm --collect-generations
+
+Tiles past the "cache lifespan" of their layer can be swept from a Disk cache,
+here for every layer, looking at no more than 500 files a second:
+
+    tilestache-clean.py -c ./config.json -l ALL --sweep-expired --rate 500
+
 See `tilestache-clean.py --help` for more information.
 """
 
+import os
 from sys import stderr, path
 from optparse import OptionParser
+from multiprocessing.pool import ThreadPool
 
 try:
     from json import dump as json_dump
@@ -28,9 +41,16 @@ and TileStache ends up with an empty in selected areas cache. Bounding box is
 given as a pair of lat/lon coordinates, e.g. "37.788 -122.349 37.833 -122.246".
 Output is a list of tile paths as they are created.
 
+Areas are removed in large chunks, several at once, with bulk removal where
+the cache supports it: multi-object deletes for S3, ranged deletes for MBTiles,
+and whole directories for Disk. Other caches remove tiles one by one.
+
 Configuration, bbox, and layer options are required; see `%prog --help` for info.""")
 
-defaults = dict(extension='png', padding=0, verbose=True, bbox=(37.777, -122.352, 37.839, -122.226))
+defaults = dict(extension='png', padding=0, verbose=True, threads=8, rate=2000, bbox=(37.777, -122.352, 37.839, -122.226))
+
+# most tiles in one chunk of an area, see areaChunks().
+_chunk_tiles = 1000000
 
 parser.set_defaults(**defaults)
 
@@ -63,52 +83,62 @@ parser.add_option('-i', '--include-path', dest='include',
 parser.add_option('--tile-list', dest='tile_list',
                   help='Optional file of tile coordinates, a simple text list of Z/X/Y coordinates. Overrides --bbox and --padding.')
 
-def generateCoordinates(ul, lr, zooms, padding):
-    """ Generate a stream of (offset, count, coordinate) tuples for seeding.
+parser.add_option('--threads', dest='threads', type='int',
+                  help='Number of threads removing tiles at once. Default value is %s.' % repr(defaults['threads']))
+
+parser.add_option('--bump-generation', dest='bump_generation',
+                  help='Invalidate every cached tile of the layer at once by incrementing its generation, instead of cleaning tiles one by one. Requires a "generations" file in the configuration.',
+                  action='store_true')
+
+parser.add_option('--collect-generations', dest='collect_generations',
+                  help='Remove tiles cached under old generations of the layer, at low process priority, instead of cleaning tiles one by one. Works with Disk, S3 and Multi caches.',
+                  action='store_true')
+
+parser.add_option('--sweep-expired', dest='sweep_expired',
+                  help='Remove tiles older than the "cache lifespan" of the layer, and directories left empty, at low process priority, instead of cleaning tiles in an area. Works with Disk and Multi caches.',
+                  action='store_true')
+
+parser.add_option('--rate', dest='rate', type='int',
+                  help='Most files looked at per second by --sweep-expired, or 0 for no limit. Default value is %s.' % repr(defaults['rate']))
+
+def areaChunks(ul, lr, zooms, padding):
+    """ Return a list of (zoom, row1, column1, row2, column2) chunks for removal.
     
-        Flood-fill coordinates based on two corners, a list of zooms and padding.
+        Areas at each zoom are limited to the edges of the world and cut into
+        strips of whole columns, of at most a million tiles each. Strips are
+        10, 100, or 1000 columns wide where they can be, so that they line up
+        with directories of Disk caches.
     """
-    # start with a simple total of all the coordinates we will need.
-    count = 0
+    chunks = []
     
-    for zoom in zooms:
-        ul_ = ul.zoomTo(zoom).container().left(padding).up(padding)
-        lr_ = lr.zoomTo(zoom).container().right(padding).down(padding)
+    for (zoom, row1, column1, row2, column2) in tileAreas(ul, lr, zooms, padding):
+        size = 2**zoom
+        row1, column1 = max(row1, 0), max(column1, 0)
+        row2, column2 = min(row2, size - 1), min(column2, size - 1)
         
-        rows = lr_.row + 1 - ul_.row
-        cols = lr_.column + 1 - ul_.column
+        width = 1000
         
-        count += int(rows * cols)
-
-    # now generate the actual coordinates.
-    # offset starts at zero
-    offset = 0
+        while width > 1 and width * (row2 + 1 - row1) > _chunk_tiles:
+            width //= 10
+        
+        for column in range(column1 - column1 % width, column2 + 1, width):
+            chunks.append((zoom, row1, max(column, column1), row2, min(column + width - 1, column2)))
     
-    for zoom in zooms:
-        ul_ = ul.zoomTo(zoom).container().left(padding).up(padding)
-        lr_ = lr.zoomTo(zoom).container().right(padding).down(padding)
-
-        for row in range(int(ul_.row), int(lr_.row + 1)):
-            for column in range(int(ul_.column), int(lr_.column + 1)):
-                coord = Coordinate(row, column, zoom)
-                
-                yield (offset, count, coord)
-                
-                offset += 1
+    return chunks
 
 def listCoordinates(filename):
     """ Generate a stream of (offset, count, coordinate) tuples for seeding.
     
         Read coordinates from a file with one Z/X/Y coordinate per line.
+        The file is read twice, once to count and once to generate, so that
+        the whole list is never held in memory.
     """
-    coords = (line.strip().split('/') for line in open(filename, 'r'))
-    coords = (map(int, (row, column, zoom)) for (zoom, column, row) in coords)
-    coords = [Coordinate(*args) for args in coords]
-    
-    count = len(coords)
+    lines = lambda: (line.strip() for line in open(filename, 'r') if line.strip())
+    count = sum(1 for line in lines())
     
-    for (offset, coord) in enumerate(coords):
-        yield (offset, count, coord)
+    for (offset, line) in enumerate(lines()):
+        zoom, column, row = map(int, line.split('/'))
+        yield (offset, count, Coordinate(row, column, zoom))
 
 if __name__ == '__main__':
     options, zooms = parser.parse_args()
@@ -119,7 +149,8 @@ if __name__ == '__main__':
 
     from TileStache import parseConfigfile, getTile
     from TileStache.Core import KnownUnknown
-    from TileStache.Caches import Disk, Multi
+    from TileStache.Caches import Disk, Multi, removeTiles
+    from TileStache.Seeding import tileAreas
     
     from ModestMaps.Core import Coordinate
     from ModestMaps.Geo import Location
@@ -164,46 +195,104 @@ if __name__ == '__main__':
         if options.padding < 0:
             raise KnownUnknown('A negative padding will not work.')
 
+        if options.threads < 1:
+            raise KnownUnknown('At least one thread is needed.')
+
         padding = options.padding
         tile_list = options.tile_list
 
+        if options.bump_generation and config.generations is None:
+            raise KnownUnknown('Configuration has no "generations" file, so --bump-generation will not work.')
+
+        if options.collect_generations and not hasattr(config.cache, 'removeGenerations'):
+            raise KnownUnknown('Configured cache does not know how to remove old generations.')
+
+        if options.sweep_expired and not hasattr(config.cache, 'sweepExpired'):
+            raise KnownUnknown('Configured cache does not know how to sweep expired tiles.')
+
+        if options.rate < 0:
+            raise KnownUnknown('A negative rate will not work.')
+
     except KnownUnknown, e:
         parser.error(str(e))
 
-    for layer in layers:
+    if options.bump_generation or options.collect_generations or options.sweep_expired:
+        if options.collect_generations or options.sweep_expired:
+            # be nice to everything else on the machine.
+            os.nice(10)
+        
+        for layer in layers:
+            if options.bump_generation:
+                generation = config.generations.bump(layer.name())
+
+                if options.verbose:
+                    print >> stderr, '%s: generation %d to %d' % (layer.name(), generation - 1, generation)
+            
+            if options.collect_generations:
+                if options.verbose:
+                    print >> stderr, '%s: removing generations other than %s...' % (layer.name(), layer.cacheName()),
+
+                config.cache.removeGenerations(layer)
+
+                if options.verbose:
+                    print >> stderr, 'done'
+            
+            if options.sweep_expired and layer.cache_lifespan:
+                if options.verbose:
+                    print >> stderr, '%s: removing tiles older than %d seconds...' % (layer.name(), layer.cache_lifespan),
+
+                count = config.cache.sweepExpired(layer, options.threads, options.rate or None)
+
+                if options.verbose:
+                    print >> stderr, '%d removed' % count
+            
+            elif options.sweep_expired and options.verbose:
+                print >> stderr, '%s: no cache lifespan, nothing to sweep' % layer.name()
+        
+        layers = []
 
+    pool = ThreadPool(options.threads)
+    
+    for layer in layers:
+        try:
+            mimetype, format = layer.getTypeByExtension(extension)
+        except:
+            #
+            # It's not uncommon for layers to lack support for certain
+            # extensions, so just don't attempt to remove a cached tile
+            # for an unsupported format.
+            #
+            continue
+        
         if tile_list:
-            coordinates = listCoordinates(tile_list)
+            def remove(tile):
+                offset, count, coord = tile
+                config.cache.remove(layer, coord, format)
+                path = '%s/%d/%d/%d.%s' % (layer.name(), coord.zoom, coord.column, coord.row, extension)
+                return offset, count, path
+            
+            results = pool.imap(remove, listCoordinates(tile_list), 64)
+        
         else:
             ul = layer.projection.locationCoordinate(northwest)
             lr = layer.projection.locationCoordinate(southeast)
-    
-            coordinates = generateCoordinates(ul, lr, zooms, padding)
+            chunks = areaChunks(ul, lr, zooms, padding)
+            
+            def remove(chunk):
+                offset, (zoom, row1, column1, row2, column2) = chunk
+                removeTiles(config.cache, layer, format, zoom, row1, column1, row2, column2)
+                path = '%s/%d/%d-%d/%d-%d.%s' % (layer.name(), zoom, column1, column2, row1, row2, extension)
+                return offset, len(chunks), path
+            
+            results = pool.imap(remove, enumerate(chunks))
         
-        for (offset, count, coord) in coordinates:
-            path = '%s/%d/%d/%d.%s' % (layer.name(), coord.zoom, coord.column, coord.row, extension)
-    
+        for (offset, count, path) in results:
             progress = {"tile": path,
                         "offset": offset + 1,
                         "total": count}
     
             if options.verbose:
-                print >> stderr, '%(offset)d of %(total)d...' % progress,
-    
-            try:
-                mimetype, format = layer.getTypeByExtension(extension)
-            except:
-                #
-                # It's not uncommon for layers to lack support for certain
-                # extensions, so just don't attempt to remove a cached tile
-                # for an unsupported format.
-                #
-                pass
-            else:
-                config.cache.remove(layer, coord, format)
-    
-            if options.verbose:
-                print >> stderr, '%(tile)s' % progress
+                print >> stderr, '%(offset)d of %(total)d... %(tile)s' % progress
                     
             if progressfile:
                 fp = open(progressfile, 'w')
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+"""tilestache-expire.py will keep your cache up to date.
+
+This script is intended to be run directly. This example removes the tiles
+expired by an osm2pgsql update from the "osm" layer, at zoom levels 10-18:
+
+    tilestache-expire.py -c ./config.json -l osm --min-zoom 10 --max-zoom 18 expire.list
+
+This one watches a directory for new expiry files, and renders the tiles they
+expire afresh:
+
+    tilestache-expire.py -c ./config.json -l osm --min-zoom 10 --max-zoom 18 --render --watch /var/lib/expiry
+
+See `tilestache-expire.py --help` for more information.
+"""
+
+import logging
+
+from sys import stderr, path, exit
+from os.path import realpath, dirname
+from optparse import OptionParser
+from urlparse import urlparse
+from urllib import urlopen
+from itertools import chain
+from time import sleep
+
+try:
+    from json import load as json_load
+except ImportError:
+    from simplejson import load as json_load
+
+#
+# Most imports can be found below, after the --include-path option is known.
+#
+
+parser = OptionParser(usage="""%prog [options] [file...]
+
+Reads expired tile lists such as the ones written by osm2pgsql, a simple text
+list of Z/X/Y coordinates, and removes the expired tiles of a single layer from
+your cache or renders them anew. Each expired tile is propagated to its parents
+and children at zoom levels in the range given, and all the files read at once
+are collapsed to a set of unique metatiles, so no tile is dealt with twice.
+
+With --watch, runs until interrupted and checks a directory for new expiry
+files every few seconds. Files are marked done by adding ".done" to their
+names, or removed with --remove-files.
+
+Configuration and layer options are required; see `%prog --help` for info.""")
+
+defaults = dict(extension='png', verbose=True, workers=1, threads=1, interval=10)
+
+parser.set_defaults(**defaults)
+
+parser.add_option('-c', '--config', dest='config',
+                  help='Path to configuration file.')
+
+parser.add_option('-l', '--layer', dest='layer',
+                  help='Layer name from configuration.')
+
+parser.add_option('-e', '--extension', dest='extension',
+                  help='Optional file type for rendered tiles. Default value is %s.' % repr(defaults['extension']))
+
+parser.add_option('-q', action='store_false', dest='verbose',
+                  help='Suppress chatty output.')
+
+parser.add_option('-i', '--include-path', dest='include',
+                  help="Add the following colon-separated list of paths to Python's include path (aka sys.path)")
+
+parser.add_option('--min-zoom', dest='minzoom', type='int',
+                  help='Lowest zoom level to propagate expired tiles up to. Default is the zoom level of each expired tile.')
+
+parser.add_option('--max-zoom', dest='maxzoom', type='int',
+                  help='Highest zoom level to propagate expired tiles down to. Default is the zoom level of each expired tile.')
+
+parser.add_option('--render', dest='render', action='store_true',
+                  help='Render expired tiles anew after removing them from the cache.')
+
+parser.add_option('--workers', dest='workers', type='int',
+                  help='Number of worker processes to render with, see tilestache-seed.py. Default value is %s.' % repr(defaults['workers']))
+
+parser.add_option('--threads', dest='threads', type='int',
+                  help='Number of threads in each worker process to render with, see tilestache-seed.py. Default value is %s.' % repr(defaults['threads']))
+
+parser.add_option('--watch', dest='watch',
+                  help='Directory to watch for new expiry files, instead of reading the files given.')
+
+parser.add_option('--interval', dest='interval', type='int',
+                  help='Seconds between checks of the --watch directory. Default value is %s.' % repr(defaults['interval']))
+
+parser.add_option('--remove-files', dest='remove_files', action='store_true',
+                  help='Remove expiry files from the --watch directory once they are done, instead of renaming them.')
+
+def parseConfigfile(configpath):
+    """ Parse a configuration file and return a raw dictionary and dirpath.
+
+        Return value can be passed to TileStache.Config.buildConfiguration().
+    """
+    config_dict = json_load(urlopen(configpath))
+
+    scheme, host, path, p, q, f = urlparse(configpath)
+
+    if scheme == '':
+        scheme = 'file'
+        path = realpath(path)
+
+    dirpath = '%s://%s%s' % (scheme, host, dirname(path).rstrip('/') + '/')
+
+    return config_dict, dirpath
+
+def expireFiles(filenames, layer, extension, minzoom, maxzoom, seeder, verbose):
+    """ Remove tiles expired by a list of files and maybe render them, return a count of failed tiles.
+
+        Tiles are all removed before any are rendered, so that each metatile
+        is rendered just once and the rest of its tiles are found in the cache.
+    """
+    tiles = chain(*[Expiry.readExpiry(filename) for filename in filenames])
+    metatiles = Expiry.expiredMetatiles(tiles, layer.metatile, minzoom, maxzoom)
+    mimetype, format = layer.getTypeByExtension(extension)
+
+    if verbose:
+        print >> stderr, '%d metatiles expired by %s' % (len(metatiles), ', '.join(filenames))
+
+    for (offset, count, coord) in Expiry.expiredCoordinates(metatiles, layer.metatile):
+        layer.config.cache.remove(layer, coord, format)
+
+        if verbose:
+            path = '%s/%d/%d/%d.%s' % (layer.name(), coord.zoom, coord.column, coord.row, extension)
+            print >> stderr, '%d of %d... removed %s' % (offset + 1, count, path)
+
+    if seeder is None:
+        return 0
+
+    failures = 0
+
+    for progress in seeder.seed(Expiry.expiredCoordinates(metatiles, layer.metatile)):
+        if progress['error'] is None:
+            if verbose:
+                print >> stderr, '%(offset)d of %(total)d... %(tile)s' % progress
+
+        else:
+            failures += 1
+            print >> stderr, '%(offset)d of %(total)d... failed %(tile)s:\n%(error)s' % progress
+
+    return failures
+
+if __name__ == '__main__':
+    options, filenames = parser.parse_args()
+
+    # show lines of expiry files that are skipped as malformed.
+    logging.basicConfig(level=logging.WARNING, format='%(message)s')
+
+    if options.include:
+        for p in options.include.split(':'):
+            path.insert(0, p)
+
+    from TileStache.Core import KnownUnknown
+    from TileStache.Config import buildConfiguration
+    from TileStache.Seeding import Seeder
+    from TileStache import Expiry
+
+    try:
+        if options.config is None:
+            raise KnownUnknown('Missing required configuration (--config) parameter.')
+
+        if options.layer is None:
+            raise KnownUnknown('Missing required layer (--layer) parameter.')
+
+        config_dict, config_dirpath = parseConfigfile(options.config)
+
+        if options.layer not in config_dict['layers']:
+            raise KnownUnknown('"%s" is not a layer I know about. Here are some that I do know about: %s.' % (options.layer, ', '.join(sorted(config_dict['layers'].keys()))))
+
+        config_dict['layers'][options.layer]['write_cache'] = True
+
+        config = buildConfiguration(config_dict, config_dirpath)
+        layer = config.layers[options.layer]
+
+        if options.minzoom is not None and options.maxzoom is not None and options.minzoom > options.maxzoom:
+            raise KnownUnknown('Minimum zoom (--min-zoom) must not be more than maximum zoom (--max-zoom).')
+
+        if options.workers < 1 or options.threads < 1:
+            raise KnownUnknown('At least one worker and one thread are needed.')
+
+        if options.watch and filenames:
+            raise KnownUnknown('Expiry files are read from the --watch directory, not given by name.')
+
+        if not options.watch and not filenames:
+            raise KnownUnknown('Missing expiry files, or a directory to --watch for them.')
+
+        # fail early on an unsupported extension.
+        layer.getTypeByExtension(options.extension)
+
+    except KnownUnknown, e:
+        parser.error(str(e))
+
+    seeder = None
+
+    if options.render:
+        seeder = Seeder(config_dict, config_dirpath, options.layer, options.extension,
+                        workers=options.workers, threads=options.threads,
+                        layer=layer)
+
+    args = layer, options.extension, options.minzoom, options.maxzoom, seeder, options.verbose
+
+    if not options.watch:
+        failures = expireFiles(filenames, *args)
+        exit(failures and 1 or 0)
+
+    while True:
+        filenames = Expiry.newExpiryFiles(options.watch)
+
+        if filenames:
+            # bad lines are skipped one by one in Expiry.readExpiry().
+            expireFiles(filenames, *args)
+
+            # failed tiles are reported, but not tried again.
+            for filename in filenames:
+                Expiry.markDone(filename, options.remove_files)
+
+        else:
+            sleep(options.interval)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+"""tilestache-inventory.py will count your cache.
+
+This script is intended to be run directly, with a configuration whose cache
+is an Inventory cache. This example rebuilds the inventory from a complete
+listing of the cache behind it, and then shows what's in the "osm" layer:
+
+    tilestache-inventory.py -c ./config.json --rebuild
+    tilestache-inventory.py -c ./config.json -l osm
+
+See `tilestache-inventory.py --help` for more information.
+"""
+
+from sys import stderr, stdout, path
+from optparse import OptionParser
+
+#
+# Most imports can be found below, after the --include-path option is known.
+#
+
+parser = OptionParser(usage="""%prog [options]
+
+Shows tile counts, coverage of the world, and byte totals for each zoom level
+of each layer in the inventory of an Inventory cache. Coverage is the fraction
+of all tiles at a zoom level that are cached. See TileStache.Inventory for more
+information about Inventory caches.
+
+Configuration option is required; see `%prog --help` for info.""")
+
+defaults = dict(verbose=True)
+
+parser.set_defaults(**defaults)
+
+parser.add_option('-c', '--config', dest='config',
+                  help='Path to configuration file.')
+
+parser.add_option('-l', '--layer', dest='layer',
+                  help='Optional layer name from configuration, to show just that layer.')
+
+parser.add_option('-i', '--include-path', dest='include',
+                  help="Add the following colon-separated list of paths to Python's include path (aka sys.path)")
+
+parser.add_option('-q', action='store_false', dest='verbose',
+                  help='Suppress chatty output.')
+
+parser.add_option('--rebuild', dest='rebuild',
+                  help='Replace the inventory with a complete listing of the cache behind it first, which may take a while. Works with Disk, S3 and MBTiles caches.',
+                  action='store_true')
+
+if __name__ == '__main__':
+    options, args = parser.parse_args()
+
+    if options.include:
+        for p in options.include.split(':'):
+            path.insert(0, p)
+
+    from TileStache import parseConfigfile
+    from TileStache.Core import KnownUnknown
+
+    try:
+        if options.config is None:
+            raise KnownUnknown('Missing required configuration (--config) parameter.')
+
+        config = parseConfigfile(options.config)
+
+        if not hasattr(config.cache, 'stats'):
+            raise KnownUnknown('Configured cache is not an Inventory cache.')
+
+        if options.layer is None:
+            layer_name = None
+
+        elif options.layer not in config.layers:
+            raise KnownUnknown('"%s" is not a layer I know about. Here are some that I do know about: %s.' % (options.layer, ', '.join(sorted(config.layers.keys()))))
+
+        else:
+            layer_name = config.layers[options.layer].cacheName()
+
+        if options.rebuild:
+            if options.verbose:
+                print >> stderr, 'Rebuilding inventory from %s...' % config.cache.cache.__class__.__name__,
+
+            config.cache.rebuild()
+
+            if options.verbose:
+                print >> stderr, 'done'
+
+    except KnownUnknown, e:
+        parser.error(str(e))
+
+    print >> stdout, '%-24s %-8s %4s %12s %10s %14s' % ('layer', 'format', 'zoom', 'tiles', 'coverage', 'bytes')
+
+    for stat in config.cache.stats(layer_name):
+        stat['coverage'] = '%.4f%%' % (stat['coverage'] * 100)
+        stat['bytes'] = stat['bytes'] is None and '?' or stat['bytes']
+
+        print >> stdout, '%(layer)-24s %(format)-8s %(zoom)4d %(tiles)12d %(coverage)10s %(bytes)14s' % stat
@@ -9,7 +9,10 @@ West Oakland (http://sta.mn/ck) in the "osm" layer, for zoom levels 12-15:
 See `tilestache-seed.py --help` for more information.
 """
 
-from sys import stderr, path
+import signal
+from sys import stderr, stdout, path, exit
+from time import time
+from datetime import timedelta
 from os.path import realpath, dirname
 from optparse import OptionParser
 from urlparse import urlparse
@@ -37,15 +40,27 @@ Example:
 
     tilestache-seed.py -b 52.55 13.28 52.46 13.51 -c tilestache.cfg -l osm 11 12 13
 
+Use every core of a big machine, one process each with its own configuration:
+
+    tilestache-seed.py --workers 16 -b 52.55 13.28 52.46 13.51 -c tilestache.cfg -l osm 11 12 13
+
+Share the work between machines, with one command to queue it up and any
+number of workers to do it, here on shared storage:
+
+    tilestache-seed.py --queue /shared/osm.queue --enqueue -b 52.55 13.28 52.46 13.51 -c tilestache.cfg -l osm 11 12 13
+    tilestache-seed.py --queue /shared/osm.queue --work --workers 16 -c tilestache.cfg -l osm
+    tilestache-seed.py --queue /shared/osm.queue --queue-status -c tilestache.cfg -l osm
+
 Protip: extract tiles from an MBTiles tileset to a directory like this:
 
     tilestache-seed.py --from-mbtiles filename.mbtiles --output-directory dirname
 
 Configuration, bbox, and layer options are required; see `%prog --help` for info.""")
 
-defaults = dict(padding=0, verbose=True, enable_retries=False, bbox=(37.777, -122.352, 37.839, -122.226))
+defaults = dict(padding=0, verbose=True, enable_retries=False, workers=1, threads=1, downsample_filter='antialias', bbox=(37.777, -122.352, 37.839, -122.226))
 
-parser.set_defaults(**defaults)
+# bbox really defaults to None, so that --from-mbtiles can tell if one was given.
+parser.set_defaults(**dict(defaults, bbox=None))
 
 parser.add_option('-c', '--config', dest='config',
                   help='Path to configuration file, typically required.')
@@ -84,11 +99,14 @@ parser.add_option('--to-s3', dest='s3_output',
                   nargs=3)
 
 parser.add_option('--from-mbtiles', dest='mbtiles_input',
-                  help='Optional input file for tiles, will be read as an MBTiles 1.1 tileset. See http://mbtiles.org for more information. Overrides --extension, --bbox and --padding (this may change).')
+                  help='Optional input file for tiles, will be read as an MBTiles 1.1 tileset. See http://mbtiles.org for more information. Tiles are copied straight to the output without rendering, limited to --bbox and zoom levels only if given. Overrides --extension and --padding.')
 
 parser.add_option('--tile-list', dest='tile_list',
                   help='Optional file of tile coordinates, a simple text list of Z/X/Y coordinates. Overrides --bbox and --padding.')
 
+parser.add_option('--geometry', dest='geometry',
+                  help='Optional GeoJSON file of polygons in geographic coordinates, such as a country outline, to seed only tiles that touch them. Overrides --bbox and --padding, and requires shapely.')
+
 parser.add_option('--error-list', dest='error_list',
                   help='Optional file of failed tile coordinates, a simple text list of Z/X/Y coordinates. If provided, failed tiles will be logged to this file instead of stopping tilestache-seed.')
 
@@ -99,66 +117,129 @@ parser.add_option('--enable-retries', dest='enable_retries',
 parser.add_option('-x', '--ignore-cached', action='store_true', dest='ignore_cached',
                   help='Re-render every tile, whether it is in the cache already or not.')
 
+parser.add_option('--skip-existing', dest='skip_existing', action='store_true',
+                  help='Skip tiles that are already cached according to the inventory of an Inventory cache, without reading them from the cache. Only for seeding a --bbox or --geometry area.')
+
+parser.add_option('--downsample', dest='downsample', action='store_true',
+                  help='Render only the deepest zoom level given, and build the others from their four cached children, deepest first. PNG and JPEG tiles only.')
+
+parser.add_option('--downsample-filter', dest='downsample_filter',
+                  help='Resampling filter for --downsample: nearest, bilinear, bicubic, or antialias. Default value is %s.' % repr(defaults['downsample_filter']))
+
+parser.add_option('--workers', dest='workers', type='int',
+                  help='Number of worker processes to seed with, each with its own copy of the configuration. Default value is %s.' % repr(defaults['workers']))
+
+parser.add_option('--threads', dest='threads', type='int',
+                  help='Number of threads in each worker process, useful for providers that spend time waiting on a network. Default value is %s.' % repr(defaults['threads']))
+
+parser.add_option('--journal', dest='journal',
+                  help='Optional directory for a journal of finished metatiles, one small bitmap file per zoom level. Only for seeding a --bbox or --geometry area.')
+
+parser.add_option('--resume', dest='resume', action='store_true',
+                  help='Skip metatiles already finished according to the --journal, e.g. after an earlier run was stopped. Area, zoom levels, and padding should be the same as before.')
+
+parser.add_option('--queue', dest='queue',
+                  help='Optional shared queue of seeding jobs, for use with --enqueue, --work, or --queue-status: a path to a SQLite file, or a redis://host:port/db URL. See TileStache.SeedQueue for more information.')
+
+parser.add_option('--enqueue', dest='enqueue', action='store_true',
+                  help='Add the metatiles of a --bbox or --geometry area or a --tile-list to the --queue, instead of seeding them.')
+
+parser.add_option('--work', dest='work', action='store_true',
+                  help='Seed jobs claimed from the --queue until there are none left, instead of an area. Failed jobs go back in the queue instead of stopping tilestache-seed.')
+
+parser.add_option('--queue-status', dest='queue_status', action='store_true',
+                  help='Show jobs left in the --queue, throughput of each worker, and an estimated finishing time.')
+
 parser.add_option('--jsonp-callback', dest='callback',
                   help='Add a JSONP callback for tiles with a json mime-type, causing "*.js" tiles to be written to the cache wrapped in the callback function. Ignored for non-JSON tiles.')
 
-def generateCoordinates(ul, lr, zooms, padding):
+def listCoordinates(filename):
     """ Generate a stream of (offset, count, coordinate) tuples for seeding.
     
-        Flood-fill coordinates based on two corners, a list of zooms and padding.
+        Read coordinates from a file with one Z/X/Y coordinate per line.
+        The file is read twice, once to count and once to generate, so that
+        the whole list is never held in memory.
+    """
+    lines = lambda: (line.strip() for line in open(filename, 'r') if line.strip())
+    count = sum(1 for line in lines())
+    
+    for (offset, line) in enumerate(lines()):
+        zoom, column, row = map(int, line.split('/'))
+        yield (offset, count, Coordinate(row, column, zoom))
+
+def printQueueStatus(queue, layer_name):
+    """ Print job counts, worker throughput, and an estimated finishing time.
     """
-    # start with a simple total of all the coordinates we will need.
-    count = 0
+    status, now = queue.status(layer_name), time()
+    
+    for state in ('queued', 'leased', 'done', 'failed'):
+        print >> stdout, '%-8s %10d jobs %12d tiles' % ((state, ) + status[state])
+    
+    print >> stdout, ''
+    print >> stdout, '%-32s %10s %12s %10s %10s' % ('worker', 'jobs', 'tiles', 'tiles/s', 'last seen')
+    
+    rate = 0
     
-    for zoom in zooms:
-        ul_ = ul.zoomTo(zoom).container().left(padding).up(padding)
-        lr_ = lr.zoomTo(zoom).container().right(padding).down(padding)
+    for worker in status['workers']:
+        worker['rate'] = worker['tiles'] / max(worker['seen'] - worker['started'], 1)
+        worker['ago'] = '%ds ago' % (now - worker['seen'])
         
-        rows = lr_.row + 1 - ul_.row
-        cols = lr_.column + 1 - ul_.column
+        print >> stdout, '%(name)-32s %(jobs)10d %(tiles)12d %(rate)10.2f %(ago)10s' % worker
         
-        count += int(rows * cols)
-
-    # now generate the actual coordinates.
-    # offset starts at zero
-    offset = 0
+        if now - worker['seen'] < queue.lease:
+            # still working, probably.
+            rate += worker['rate']
     
-    for zoom in zooms:
-        ul_ = ul.zoomTo(zoom).container().left(padding).up(padding)
-        lr_ = lr.zoomTo(zoom).container().right(padding).down(padding)
-
-        for row in range(int(ul_.row), int(lr_.row + 1)):
-            for column in range(int(ul_.column), int(lr_.column + 1)):
-                coord = Coordinate(row, column, zoom)
-                
-                yield (offset, count, coord)
-                
-                offset += 1
+    remaining = queue.remaining(layer_name)
+    
+    print >> stdout, ''
+    
+    if remaining and rate:
+        print >> stdout, '%d tiles left at %.2f tiles/s, done in about %s' % (remaining, rate, timedelta(seconds=int(remaining / rate)))
+    elif remaining:
+        print >> stdout, '%d tiles left, and no workers at work' % remaining
+    else:
+        print >> stdout, 'Nothing left to do'
 
-def listCoordinates(filename):
-    """ Generate a stream of (offset, count, coordinate) tuples for seeding.
+def tilesetTiles(filename, zooms, bounds):
+    """ Generate a stream of (offset, count, coordinate, content) tuples for copying.
     
-        Read coordinates from a file with one Z/X/Y coordinate per line.
+        Read tiles from an MBTiles tileset filename, optionally limited to
+        a list of zooms and a pair of upper-left and lower-right coordinates.
     """
-    coords = (line.strip().split('/') for line in open(filename, 'r'))
-    coords = (map(int, (row, column, zoom)) for (zoom, column, row) in coords)
-    coords = [Coordinate(*args) for args in coords]
-    
-    count = len(coords)
+    count = MBTiles.count_tiles(filename, zooms, bounds)
+    tiles = MBTiles.iter_tiles(filename, zooms, bounds)
     
-    for (offset, coord) in enumerate(coords):
-        yield (offset, count, coord)
+    for (offset, (coord, content)) in enumerate(tiles):
+        yield (offset, count, coord, content)
 
-def tilesetCoordinates(filename):
-    """ Generate a stream of (offset, count, coordinate) tuples for seeding.
+def copyTiles(layer, tiles, extension, verbose, progressfile):
+    """ Save a stream of tiles from tilesetTiles() straight to a layer cache.
     
-        Read coordinates from an MBTiles tileset filename.
+        The cache is flushed at the end, so that an error writing out
+        tiles it held back is raised here rather than lost at exit.
     """
-    coords = MBTiles.list_tiles(filename)
-    count = len(coords)
+    mimetype, format = layer.getTypeByExtension(extension)
     
-    for (offset, coord) in enumerate(coords):
-        yield (offset, count, coord)
+    for (offset, count, coord, content) in tiles:
+        layer.config.cache.save(content, layer, coord, format)
+        
+        path = '%s/%d/%d/%d.%s' % (layer.name(), coord.zoom, coord.column, coord.row, extension)
+
+        progress = {"tile": path,
+                    "offset": offset + 1,
+                    "total": count,
+                    "size": '%dKB' % (len(content) / 1024)}
+        
+        if verbose:
+            print >> stderr, '%(offset)d of %(total)d... %(tile)s (%(size)s)' % progress
+        
+        if progressfile:
+            fp = open(progressfile, 'w')
+            json_dump(progress, fp)
+            fp.close()
+    
+    flushCache(layer.config.cache)
 
 def parseConfigfile(configpath):
     """ Parse a configuration file and return a raw dictionary and dirpath.
@@ -188,6 +269,11 @@ if __name__ == '__main__':
     from TileStache.Core import KnownUnknown
     from TileStache.Config import buildConfiguration
     from TileStache import MBTiles
+    from TileStache import Pyramid
+    from TileStache.Seeding import Seeder, metatileCoordinates, tileAreas, flushCache
+    from TileStache.Seeding import loadGeometry, geometryCoordinates, geometryAreas
+    from TileStache.Journal import Journal
+    from TileStache import SeedQueue
     import TileStache
     
     from ModestMaps.Core import Coordinate
@@ -272,11 +358,11 @@ if __name__ == '__main__':
         # create a real config object
         
         config = buildConfiguration(config_dict, config_dirpath)
-        layer = config.layers[options.layer]
+        layer = config.layers[options.layer or 'tiles-layer']
         
         # do the actual work
         
-        lat1, lon1, lat2, lon2 = options.bbox
+        lat1, lon1, lat2, lon2 = options.bbox or defaults['bbox']
         south, west = min(lat1, lat2), min(lon1, lon2)
         north, east = max(lat1, lat2), max(lon1, lon2)
 
@@ -294,84 +380,170 @@ if __name__ == '__main__':
         
         if options.padding < 0:
             raise KnownUnknown('A negative padding will not work.')
+        
+        if options.workers < 1 or options.threads < 1:
+            raise KnownUnknown('At least one worker and one thread are needed.')
+        
+        if options.downsample and zooms:
+            if options.downsample_filter not in Pyramid.filters:
+                raise KnownUnknown('"%s" is not a downsample filter I know about. Here are some that I do know about: %s.' % (options.downsample_filter, ', '.join(sorted(Pyramid.filters))))
+            
+            # children must be in the cache before their parents are built.
+            zooms.sort(reverse=True)
+            layer.downsample_zoom = zooms[0]
+            layer.downsample_filter = options.downsample_filter
+            
+            # worker processes build their layers from the dictionary.
+            layer_dict['downsample'] = dict(zoom=zooms[0], filter=options.downsample_filter)
 
         padding = options.padding
         tile_list = options.tile_list
         error_list = options.error_list
+        geometry, journal, existing, queue = None, None, None, None
+        
+        if options.geometry:
+            try:
+                import shapely
+            except ImportError:
+                raise KnownUnknown('Seeding a --geometry area requires shapely.')
+            
+            geometry = loadGeometry(options.geometry, layer.projection)
+        
+        if options.resume and not options.journal:
+            raise KnownUnknown('Resuming needs a --journal directory.')
+        
+        if options.journal:
+            if tile_list or options.mbtiles_input:
+                raise KnownUnknown('A --journal only works for seeding a --bbox or --geometry area, not with --tile-list or --from-mbtiles.')
+            
+            if geometry is not None:
+                areas = geometryAreas(geometry, zooms)
+            else:
+                areas = tileAreas(ul, lr, zooms, padding)
+            
+            journal = Journal(options.journal, layer.metatile, areas, options.resume)
+        
+        if options.queue:
+            if len(filter(None, (options.enqueue, options.work, options.queue_status))) != 1:
+                raise KnownUnknown('A --queue needs exactly one of --enqueue, --work, or --queue-status.')
+            
+            if options.mbtiles_input or options.journal:
+                raise KnownUnknown('A --queue does not work with --from-mbtiles or --journal.')
+            
+            queue = SeedQueue.getQueue(options.queue)
+        
+        elif options.enqueue or options.work or options.queue_status:
+            raise KnownUnknown('Queueing, working, and queue status need a --queue.')
+        
+        if options.skip_existing:
+            if not hasattr(layer.config.cache, 'existingTiles'):
+                raise KnownUnknown('Skipping existing tiles needs an Inventory cache, see TileStache.Inventory.')
+            
+            if options.ignore_cached:
+                raise KnownUnknown('Skipping existing tiles (--skip-existing) and re-rendering them (-x) do not mix.')
+            
+            mimetype, format = layer.getTypeByExtension(extension)
+            existing = lambda zoom, *limits: layer.config.cache.existingTiles(layer, format, zoom, *limits)
 
     except KnownUnknown, e:
         parser.error(str(e))
 
-    if tile_list:
-        coordinates = listCoordinates(tile_list)
-    elif options.mbtiles_input:
-        coordinates = tilesetCoordinates(options.mbtiles_input)
-    else:
-        coordinates = generateCoordinates(ul, lr, zooms, padding)
+    layer_name = options.layer or 'tiles-layer'
+    claims = None
     
-    coordinates = list(coordinates)
+    if queue is not None and options.queue_status:
+        printQueueStatus(queue, layer_name)
+        exit(0)
     
-    for (offset, count, coord) in coordinates:
-        path = '%s/%d/%d/%d.%s' % (layer.name(), coord.zoom, coord.column, coord.row, extension)
-
-        progress = {"tile": path,
-                    "offset": offset + 1,
-                    "total": count}
-
+    if options.mbtiles_input and not tile_list:
         #
-        # Fetch a tile.
+        # Tiles are already made, so copy them straight across.
         #
+        bounds = options.bbox and (ul, lr) or None
+        tiles = tilesetTiles(options.mbtiles_input, zooms or None, bounds)
+        copyTiles(layer, tiles, extension, options.verbose, options.progressfile)
+        coordinates = []
+    
+    elif queue is not None and options.work:
+        claims = SeedQueue.Claims(queue, layer_name, SeedQueue.workerName())
+        coordinates = claims.coordinates()
+    elif tile_list:
+        coordinates = listCoordinates(tile_list)
+    elif geometry is not None:
+        coordinates = geometryCoordinates(geometry, zooms, layer.metatile, journal, existing)
+    else:
+        coordinates = metatileCoordinates(ul, lr, zooms, padding, layer.metatile, journal, existing)
+    
+    if queue is not None and options.enqueue:
+        count = SeedQueue.enqueue(queue, layer_name, coordinates, layer.metatile)
         
-        attempts = options.enable_retries and 3 or 1
-        rendered = False
+        if options.verbose:
+            print >> stderr, 'Queued %d jobs' % count
         
-        while not rendered:
-            if options.verbose:
-                print >> stderr, '%(offset)d of %(total)d...' % progress,
+        exit(0)
     
-            try:
-                mimetype, content = getTile(layer, coord, extension, options.ignore_cached)
-                
-                if 'json' in mimetype and options.callback:
-                    js_path = '%s/%d/%d/%d.js' % (layer.name(), coord.zoom, coord.column, coord.row)
-                    js_body = '%s(%s);' % (options.callback, content)
-                    js_size = len(js_body) / 1024
-                    
-                    layer.config.cache.save(js_body, layer, coord, 'JS')
-                    print >> stderr, '%s (%dKB)' % (js_path, js_size),
+    attempts = options.enable_retries and 3 or 1
+    
+    seeder = Seeder(config_dict, config_dirpath, layer_name, extension,
+                    workers=options.workers, threads=options.threads,
+                    ignore_cached=options.ignore_cached, attempts=attempts,
+                    callback=options.callback, layer=layer)
+    
+    def stop_seeding(signum, frame):
+        if not seeder.stopped():
+            print >> stderr, 'Stopping after tiles in progress, interrupt again to quit now.'
+            seeder.stop()
+        else:
+            raise KeyboardInterrupt()
+    
+    signal.signal(signal.SIGINT, stop_seeding)
+    failed = None
+    
+    try:
+        for progress in seeder.seed(coordinates):
+            coord = Coordinate(*progress.pop('coord'))
+            error = progress.pop('error')
             
-                elif options.callback:
-                    print >> stderr, '(callback ignored)',
+            if journal and error is None:
+                journal.tileDone(coord)
+            elif journal:
+                journal.tileFailed(coord)
             
-            except:
-                #
-                # Something went wrong: try again? Log the error?
-                #
-                attempts -= 1
-
+            if claims:
+                claims.tileDone(coord, error)
+            
+            if error is None:
+                progress['size'] = '%dKB' % (progress['size'] / 1024)
+            
+                if options.verbose:
+                    print >> stderr, '%(offset)d of %(total)d... %(tile)s (%(size)s)' % progress
+            
+            elif error_list or claims:
                 if options.verbose:
-                    print >> stderr, 'Failed %s, will try %s more.' % (progress['tile'], ['no', 'once', 'twice'][attempts])
-                
-                if attempts == 0:
-                    if not error_list:
-                        raise
-                    
+                    print >> stderr, '%(offset)d of %(total)d... failed %(tile)s' % progress
+            
+                if error_list:
                     fp = open(error_list, 'a')
                     fp.write('%(zoom)d/%(column)d/%(row)d\n' % coord.__dict__)
                     fp.close()
-                    break
             
-            else:
-                #
-                # Successfully got the tile.
-                #
-                rendered = True
-                progress['size'] = '%dKB' % (len(content) / 1024)
+            elif failed is None:
+                # stop the rest, and report this once all's quiet.
+                failed = progress['tile'], error
+                seeder.stop()
+            
+            if options.progressfile:
+                fp = open(options.progressfile, 'w')
+                json_dump(progress, fp)
+                fp.close()
+    
+    finally:
+        if journal:
+            journal.close()
         
-                if options.verbose:
-                    print >> stderr, '%(tile)s (%(size)s)' % progress
-                
-        if options.progressfile:
-            fp = open(options.progressfile, 'w')
-            json_dump(progress, fp)
-            fp.close()
+        if claims:
+            claims.close()
+    
+    if failed:
+        print >> stderr, 'Failed %s:\n%s' % failed
+        exit(1)
@@ -1,7 +1,26 @@
-from unittest import TestCase
+from unittest import TestCase, SkipTest
+from time import time, sleep
 from . import utils
+import gc
+
+from weakref import ref
 import memcache
 
+from ModestMaps.Core import Coordinate
+from TileStache import S3
+from TileStache.Caches import Disk, Memory, Multi, _filtered_multis
+from TileStache.Generations import Generations
+from TileStache.Config import buildConfiguration
+from TileStache.Core import KnownUnknown
+from TileStache.Inventory import Cache as Inventory
+from TileStache import Inventory as Inventory_module
+from TileStache.Goodies.Caches.SharedMemory import Cache as SharedMemory
+from multiprocessing import Process
+from tempfile import mkdtemp
+from shutil import rmtree
+from os import utime
+from os.path import exists, join as pathjoin
+
 class CacheTests(TestCase):
     '''Tests various Cache configurations that reads from cfg file'''
 
@@ -68,6 +87,528 @@ class CacheTests(TestCase):
             'Memcache returned a value even though it should have been empty')
 
 
+class S3CacheTests(TestCase):
+    '''Tests S3 cache against moto's stand-in for S3'''
+
+    def setUp(self):
+        try:
+            from boto.s3.connection import S3Connection
+            import moto
+        except ImportError:
+            raise SkipTest('S3 tests need boto and moto')
+
+        # the S3 cache uses boto 2, which newer moto only mocks under this name.
+        mock_s3 = getattr(moto, 'mock_s3_deprecated', moto.mock_s3)
+
+        self.mock = mock_s3()
+        self.mock.start()
+
+        S3Connection('access', 'secret').create_bucket('tiles')
+        self.cache = S3.Cache('tiles', 'access', 'secret', use_locks=False)
+
+    def tearDown(self):
+        self.mock.stop()
+
+    def test_s3_read_save(self):
+        '''Miss on a missing tile, then read back a saved one'''
+
+        layer, coord = utils.FakeLayer('s3_osm'), Coordinate(1, 2, 3)
+
+        self.assertEqual(self.cache.read(layer, coord, 'PNG'), None)
+
+        self.cache.lock(layer, coord, 'PNG')
+        self.cache.save('tile bytes', layer, coord, 'PNG')
+        self.cache.unlock(layer, coord, 'PNG')
+
+        self.assertEqual(self.cache.read(layer, coord, 'PNG'), 'tile bytes')
+
+        self.cache.remove(layer, coord, 'PNG')
+        self.assertEqual(self.cache.read(layer, coord, 'PNG'), None)
+
+
+class SlowTier:
+    '''Dictionary-backed cache tier that takes a while to answer reads'''
+
+    def __init__(self, delay, tiles=None):
+        self.delay = delay
+        self.tiles = tiles or {}
+
+    def read(self, layer, coord, format):
+        sleep(self.delay)
+        return self.tiles.get((coord, format), None)
+
+    def save(self, body, layer, coord, format):
+        self.tiles[(coord, format)] = body
+
+
+class ListedTier (SlowTier):
+    '''Cache tier that can list its tiles, for building filters'''
+
+    def __init__(self, delay, tiles=None, layer_name=None):
+        SlowTier.__init__(self, delay, tiles)
+        self.layer_name = layer_name
+
+    def listTiles(self, sizes=False):
+        for (coord, format) in self.tiles:
+            yield self.layer_name, coord, format
+
+
+class CountedTier (ListedTier):
+    '''Cache tier that counts its listings'''
+
+    listings = 0
+
+    def listTiles(self, sizes=False):
+        self.listings += 1
+        return ListedTier.listTiles(self, sizes)
+
+
+class BrokenTier (SlowTier):
+    '''Cache tier whose listing fails'''
+
+    def listTiles(self, sizes=False):
+        raise IOError('Listing failed')
+
+
+class MultiCacheTests(TestCase):
+    '''Tests Multi cache tier probing, backfill and counters'''
+
+    def test_multi_sequential(self):
+        '''Find a tile in the second tier and save it back to the first'''
+
+        coord = Coordinate(0, 0, 0)
+        first, second = SlowTier(0), SlowTier(0, {(coord, 'PNG'): 'tile'})
+        cache = Multi([first, second])
+
+        self.assertEqual(cache.read(None, coord, 'PNG'), 'tile')
+        self.assertEqual(first.tiles[(coord, 'PNG')], 'tile')
+        self.assertEqual((cache.hits, cache.misses), ([0, 1], [1, 0]))
+
+    def test_multi_hedged(self):
+        '''Answer from the second tier while the first is still slow'''
+
+        coord = Coordinate(0, 0, 0)
+        first, second = SlowTier(1.0), SlowTier(0, {(coord, 'PNG'): 'tile'})
+        cache = Multi([first, second], hedge=50)
+
+        start = time()
+        self.assertEqual(cache.read(None, coord, 'PNG'), 'tile')
+        self.assertTrue(time() - start < 0.5, 'Hedged read waited for the slow tier')
+        self.assertEqual(cache.hits, [0, 1])
+
+    def test_multi_hedged_late(self):
+        '''Count a hit from a slow tier that answers after another tier'''
+
+        coord = Coordinate(0, 0, 0)
+        first, second = SlowTier(0.3, {(coord, 'PNG'): 'tile'}), SlowTier(0, {(coord, 'PNG'): 'tile'})
+        cache = Multi([first, second], hedge=50)
+
+        self.assertEqual(cache.read(None, coord, 'PNG'), 'tile')
+        sleep(0.6)
+
+        self.assertEqual(cache.hits, [1, 1])
+        self.assertEqual(cache.lates, [1, 0])
+
+    def test_multi_filter(self):
+        '''Skip a filtered tier until a tile has been saved to it'''
+
+        layer, coord = utils.FakeLayer('filtered'), Coordinate(0, 0, 0)
+        first, second = SlowTier(0), ListedTier(0)
+        cache = Multi([first, second], filters=[None, {'capacity': 1000}])
+        cache.rebuildFilters()
+
+        self.assertEqual(cache.read(layer, coord, 'PNG'), None)
+        self.assertEqual(cache.skips, [0, 1])
+
+        cache.save('tile', layer, coord, 'PNG')
+        first.tiles.clear()
+
+        self.assertEqual(cache.read(layer, coord, 'PNG'), 'tile')
+        self.assertEqual(cache.hits, [0, 1])
+
+    def test_multi_filter_unusable(self):
+        '''Never skip a tier whose filter could not be built'''
+
+        layer, coord = utils.FakeLayer('filtered'), Coordinate(0, 0, 0)
+        tiles = {(coord, 'PNG'): 'tile'}
+        cache = Multi([SlowTier(0, dict(tiles)), BrokenTier(0, dict(tiles))],
+                      filters=[{'capacity': 1000}, {'capacity': 1000}])
+
+        self.assertEqual(cache.filters[0], None)
+
+        cache.tiers[0].tiles.clear()
+        self.assertEqual(cache.read(layer, coord, 'PNG'), 'tile')
+        self.assertEqual(cache.skips, [0, 0])
+
+    def test_multi_filter_file(self):
+        '''Build a filter from a listing, and merge saved filters'''
+
+        tmp = mkdtemp(prefix='tilestache-filter-')
+        path = pathjoin(tmp, 'tier.bloom')
+        layer, coord1, coord2 = utils.FakeLayer('filtered'), Coordinate(0, 0, 1), Coordinate(1, 1, 1)
+
+        try:
+            one = Multi([ListedTier(0, {(coord1, 'PNG'): 'one'}, 'filtered')], filters=[{'capacity': 1000, 'path': path}])
+            one.rebuildFilters()
+            two = Multi([ListedTier(0, {}, 'filtered')], filters=[{'capacity': 1000, 'path': path}])
+
+            self.assertEqual(two.read(layer, coord1, 'PNG'), None)
+            self.assertEqual(two.skips, [0])
+
+            two.save('two', layer, coord2, 'PNG')
+            one.saveFilters()
+            two.saveFilters()
+
+            three = Multi([ListedTier(0, {}, 'filtered')], filters=[{'capacity': 1000, 'path': path}])
+            self.assertFalse(three._excludes(0, layer, coord1, 'PNG'))
+            self.assertFalse(three._excludes(0, layer, coord2, 'PNG'))
+
+        finally:
+            rmtree(tmp)
+
+    def test_multi_filter_background(self):
+        '''Build a filter in the background, and forget discarded caches'''
+
+        tmp = mkdtemp(prefix='tilestache-filter-')
+        layer, coord = utils.FakeLayer('filtered'), Coordinate(0, 0, 1)
+        tier = CountedTier(0, {(coord, 'PNG'): 'tile'}, 'filtered')
+
+        try:
+            cache = Multi([tier], filters=[{'capacity': 1000, 'path': pathjoin(tmp, 'tier.bloom')}])
+            self.assertEqual(tier.listings, 0, 'Filter was built at startup')
+            self.assertTrue(cache in _filtered_multis)
+
+            self.assertEqual(cache.read(layer, Coordinate(1, 1, 1), 'PNG'), None)
+            sleep(0.2)
+
+            self.assertEqual(tier.listings, 1)
+            self.assertTrue(cache._excludes(0, layer, Coordinate(1, 1, 1), 'PNG'))
+            self.assertFalse(cache._excludes(0, layer, coord, 'PNG'))
+            self.assertTrue(exists(pathjoin(tmp, 'tier.bloom')))
+
+            cache_ref = ref(cache)
+            del cache
+            gc.collect()
+            self.assertEqual(cache_ref(), None, 'Discarded cache was kept for saving at exit')
+
+        finally:
+            rmtree(tmp)
+
+
+class MemoryCacheTests(TestCase):
+    '''Tests Memory cache limits and lifespans'''
+
+    def test_memory_limit(self):
+        '''Discard least-recently used tiles to stay under the byte limit'''
+
+        layer = utils.FakeLayer('memory')
+        cache = Memory(limit=10)
+
+        cache.save('aaaa', layer, Coordinate(0, 0, 1), 'PNG')
+        cache.save('bbbb', layer, Coordinate(0, 1, 1), 'PNG')
+        cache.read(layer, Coordinate(0, 0, 1), 'PNG')
+        cache.save('cccc', layer, Coordinate(1, 0, 1), 'PNG')
+
+        self.assertEqual(cache.read(layer, Coordinate(0, 0, 1), 'PNG'), 'aaaa')
+        self.assertEqual(cache.read(layer, Coordinate(0, 1, 1), 'PNG'), None)
+        self.assertEqual(cache.read(layer, Coordinate(1, 0, 1), 'PNG'), 'cccc')
+        self.assertEqual(cache.size, 8)
+
+    def test_memory_lifespan(self):
+        '''Ignore tiles older than the layer cache lifespan'''
+
+        layer = utils.FakeLayer('memory', cache_lifespan=1)
+        cache = Memory()
+
+        cache.save('tile', layer, Coordinate(0, 0, 0), 'PNG')
+        self.assertEqual(cache.read(layer, Coordinate(0, 0, 0), 'PNG'), 'tile')
+
+        sleep(1.1)
+        self.assertEqual(cache.read(layer, Coordinate(0, 0, 0), 'PNG'), None)
+        self.assertEqual(cache.size, 0)
+
+
+def _bump_generations(path, count):
+    for i in range(count):
+        Generations(path).bump('osm')
+
+class GenerationCacheTests(TestCase):
+    '''Tests per-layer cache generations'''
+
+    def setUp(self):
+        self.dirpath = mkdtemp(prefix='tilestache-test-')
+
+    def tearDown(self):
+        rmtree(self.dirpath)
+
+    def test_generations_file(self):
+        '''Bump a layer generation and see it from another reader'''
+
+        path = pathjoin(self.dirpath, 'generations.json')
+        writer, reader = Generations(path), Generations(path, interval=0)
+
+        self.assertEqual(reader.get('osm'), 0)
+        self.assertEqual(writer.bump('osm'), 1)
+        self.assertEqual(writer.bump('osm'), 2)
+        self.assertEqual(reader.get('osm'), 2)
+        self.assertEqual(reader.get('roads'), 0)
+
+    def test_generations_processes(self):
+        '''Lose no bumps made by several processes at once'''
+
+        path = pathjoin(self.dirpath, 'generations.json')
+        processes = [Process(target=_bump_generations, args=(path, 5)) for i in range(4)]
+
+        for process in processes:
+            process.start()
+
+        for process in processes:
+            process.join()
+
+        self.assertEqual(Generations(path).get('osm'), 20)
+
+    def test_generations_layer_names(self):
+        '''Refuse layer names that look like they have a generation'''
+
+        layer = {'provider': {'name': 'proxy', 'url': 'http://example.com/{Z}/{X}/{Y}.png'}}
+        config = {'cache': {'name': 'Test'}, 'layers': {'osm@2': layer}, 'generations': 'generations.json'}
+
+        self.assertRaises(KnownUnknown, buildConfiguration, config, self.dirpath + '/')
+
+        del config['generations']
+        self.assertTrue('osm@2' in buildConfiguration(config, self.dirpath + '/').layers)
+
+    def test_disk_generations(self):
+        '''Miss tiles of old generations, then remove them'''
+
+        cachepath = pathjoin(self.dirpath, 'cache')
+        cache, coord = Disk(cachepath), Coordinate(0, 0, 0)
+        old, new = utils.FakeLayer('osm'), utils.FakeLayer('osm', generation=1)
+
+        cache.save('old tile', old, coord, 'PNG')
+        self.assertEqual(cache.read(new, coord, 'PNG'), None)
+
+        cache.save('new tile', new, coord, 'PNG')
+        cache.removeGenerations(new)
+
+        self.assertFalse(exists(pathjoin(cachepath, 'osm')))
+        self.assertEqual(cache.read(new, coord, 'PNG'), 'new tile')
+
+
+class DiskRemovalTests(TestCase):
+    '''Tests bulk removal of tile ranges from a Disk cache'''
+
+    def setUp(self):
+        self.dirpath = mkdtemp(prefix='tilestache-test-')
+
+    def tearDown(self):
+        rmtree(self.dirpath)
+
+    def test_disk_remove_tiles(self):
+        '''Remove a range of tiles, and a whole zoom level'''
+
+        cache, layer = Disk(self.dirpath), utils.FakeLayer('osm')
+
+        for row in range(4):
+            for column in range(4):
+                cache.save('tile', layer, Coordinate(row, column, 2), 'PNG')
+
+        cache.save('json', layer, Coordinate(0, 0, 2), 'JSON')
+        cache.removeTiles(layer, 'PNG', 2, 1, 1, 2, 3)
+
+        left = set([(coord.row, coord.column) for (name, coord, format) in cache.listTiles() if format == 'png'])
+        self.assertEqual(len(left), 10)
+        self.assertFalse((1, 1) in left or (2, 3) in left)
+        self.assertTrue((0, 1) in left and (1, 0) in left)
+
+        cache.removeTiles(layer, 'PNG', 2, 0, 0, 3, 3)
+
+        self.assertEqual([format for (name, coord, format) in cache.listTiles()], ['json'])
+        self.assertEqual(cache.read(layer, Coordinate(0, 0, 2), 'JSON'), 'json')
+
+    def test_disk_sweep_expired(self):
+        '''Sweep tiles past their lifespan, and the directories they leave'''
+
+        cache, layer = Disk(self.dirpath, dirs='portable'), utils.FakeLayer('osm', cache_lifespan=60)
+
+        cache.save('old', layer, Coordinate(0, 0, 1), 'PNG')
+        cache.save('new', layer, Coordinate(1, 1, 1), 'PNG')
+        utime(pathjoin(self.dirpath, 'osm', '1', '0', '0.png'), (0, 0))
+
+        self.assertEqual(cache.sweepExpired(layer, threads=2), 1)
+        self.assertFalse(exists(pathjoin(self.dirpath, 'osm', '1', '0')))
+        self.assertEqual(cache.read(layer, Coordinate(1, 1, 1), 'PNG'), 'new')
+
+
+class HookedListing:
+    '''Cache wrapper whose listing calls a function after its first tile'''
+
+    def __init__(self, cache, hook):
+        self.cache = cache
+        self.hook = hook
+
+    def listTiles(self, sizes=False):
+        for (index, tile) in enumerate(self.cache.listTiles(sizes)):
+            if index == 1:
+                self.hook()
+
+            yield tile
+
+
+class InventoryCacheTests(TestCase):
+    '''Tests the Inventory cache index'''
+
+    def setUp(self):
+        self.dirpath = mkdtemp(prefix='tilestache-test-')
+        self.disk = Disk(pathjoin(self.dirpath, 'cache'), dirs='portable')
+
+    def tearDown(self):
+        rmtree(self.dirpath)
+
+    def test_inventory_save_remove(self):
+        '''Index tiles as they are saved and removed'''
+
+        cache, layer = Inventory(pathjoin(self.dirpath, 'inventory.db'), self.disk), utils.FakeLayer('osm')
+
+        cache.save('tile one', layer, Coordinate(1, 1, 1), 'PNG')
+        cache.save('tile two', layer, Coordinate(1, 0, 1), 'PNG')
+        cache.remove(layer, Coordinate(1, 1, 1), 'PNG')
+
+        self.assertTrue(cache.has(layer, Coordinate(1, 0, 1), 'PNG'))
+        self.assertFalse(cache.has(layer, Coordinate(1, 1, 1), 'PNG'))
+        self.assertEqual(cache.existingTiles(layer, 'PNG', 1, 0, 0, 1, 1), set([(1, 0)]))
+
+        stats = cache.stats('osm')
+        self.assertEqual(len(stats), 1)
+        self.assertEqual((stats[0]['zoom'], stats[0]['tiles'], stats[0]['bytes']), (1, 1, 8))
+        self.assertEqual(stats[0]['coverage'], .25)
+
+    def test_inventory_rebuild(self):
+        '''Rebuild an index from a listing of the cache behind it'''
+
+        layer = utils.FakeLayer('osm')
+        self.disk.save('tile one', layer, Coordinate(0, 0, 0), 'PNG')
+        self.disk.save('tile two', layer, Coordinate(1, 1, 1), 'PNG')
+
+        cache = Inventory(pathjoin(self.dirpath, 'inventory.db'), self.disk, trust=True)
+        self.assertEqual(cache.read(layer, Coordinate(0, 0, 0), 'PNG'), None)
+
+        cache.rebuild()
+        self.assertEqual(cache.read(layer, Coordinate(0, 0, 0), 'PNG'), 'tile one')
+        self.assertEqual(sorted([(s['zoom'], s['tiles']) for s in cache.stats()]), [(0, 1), (1, 1)])
+
+    def test_inventory_rebuild_live(self):
+        '''Go on indexing saved tiles while an index is rebuilt, and keep them'''
+
+        path, layer = pathjoin(self.dirpath, 'inventory.db'), utils.FakeLayer('osm')
+        other = Inventory(path, Memory())
+
+        for coord in (Coordinate(0, 0, 0), Coordinate(1, 1, 1)):
+            self.disk.save('tile', layer, coord, 'PNG')
+
+        # the index knows a tile that's gone, and learns one mid-rebuild.
+        other.save('gone', layer, Coordinate(3, 3, 3), 'PNG')
+        save = lambda: other.save('new', layer, Coordinate(2, 2, 2), 'PNG')
+
+        cache = Inventory(path, HookedListing(self.disk, save))
+        batch, Inventory_module._rebuild_batch = Inventory_module._rebuild_batch, 1
+
+        try:
+            start = time()
+            cache.rebuild()
+        finally:
+            Inventory_module._rebuild_batch = batch
+
+        self.assertTrue(time() - start < 5, 'Saving a tile waited for the rebuild')
+        self.assertEqual(sorted([(c.zoom, c.column, c.row) for (n, c, f) in cache.listTiles()]),
+                         [(0, 0, 0), (1, 1, 1), (2, 2, 2)])
+
+
+# a shared memory table with one set of eight 1KB slots.
+_shared_slabs, _shared_size = [1024], 4096 + 8 * (32 + 1024) + 1
+
+def _save_shared_tile(path, body):
+    SharedMemory(path, _shared_size, _shared_slabs).save(body, utils.FakeLayer('shared'), Coordinate(1, 2, 3), 'PNG')
+
+class SharedMemoryCacheTests(TestCase):
+    '''Tests the SharedMemory cache table'''
+
+    def setUp(self):
+        self.dirpath = mkdtemp(prefix='tilestache-test-')
+        self.path = pathjoin(self.dirpath, 'table')
+        self.layer = utils.FakeLayer('shared')
+
+    def tearDown(self):
+        rmtree(self.dirpath)
+
+    def test_shared_read_save(self):
+        '''Save, read and remove a tile'''
+
+        cache, coord = SharedMemory(self.path, _shared_size, _shared_slabs), Coordinate(1, 2, 3)
+
+        self.assertEqual(cache.read(self.layer, coord, 'PNG'), None)
+
+        cache.save('tile bytes', self.layer, coord, 'PNG')
+        self.assertEqual(cache.read(self.layer, coord, 'PNG'), 'tile bytes')
+
+        cache.remove(self.layer, coord, 'PNG')
+        self.assertEqual(cache.read(self.layer, coord, 'PNG'), None)
+
+        cache.save('x' * 2048, self.layer, coord, 'PNG')
+        self.assertEqual(cache.read(self.layer, coord, 'PNG'), None, 'Tile too big for any slot was cached')
+
+    def test_shared_eviction(self):
+        '''Evict the one tile in a full set that was not read recently'''
+
+        cache = SharedMemory(self.path, _shared_size, _shared_slabs)
+        coords = [Coordinate(row, 0, 5) for row in range(9)]
+
+        for coord in coords[:8]:
+            cache.save('tile %d' % coord.row, self.layer, coord, 'PNG')
+
+        for coord in coords[:7]:
+            self.assertEqual(cache.read(self.layer, coord, 'PNG'), 'tile %d' % coord.row)
+
+        cache.save('tile 8', self.layer, coords[8], 'PNG')
+
+        self.assertEqual(cache.read(self.layer, coords[7], 'PNG'), None)
+
+        for coord in coords[:7] + coords[8:]:
+            self.assertEqual(cache.read(self.layer, coord, 'PNG'), 'tile %d' % coord.row)
+
+    def test_shared_corrupt_slot(self):
+        '''Read a slot with a bad checksum as empty'''
+
+        cache, coord = SharedMemory(self.path, _shared_size, _shared_slabs), Coordinate(1, 2, 3)
+        cache.save('tile bytes', self.layer, coord, 'PNG')
+
+        file = open(self.path, 'r+b')
+        offset = file.read().index('tile bytes')
+        file.seek(offset)
+        file.write('TILE')
+        file.close()
+
+        self.assertEqual(cache.read(self.layer, coord, 'PNG'), None)
+
+    def test_shared_processes(self):
+        '''Read a tile saved by another process'''
+
+        cache = SharedMemory(self.path, _shared_size, _shared_slabs)
+
+        process = Process(target=_save_shared_tile, args=(self.path, 'from afar'))
+        process.start()
+        process.join()
+
+        self.assertEqual(process.exitcode, 0)
+        self.assertEqual(cache.read(self.layer, Coordinate(1, 2, 3), 'PNG'), 'from afar')
+
+    def test_shared_mismatch(self):
+        '''Replace a table made with other parameters, leaving old users alone'''
 
+        old = SharedMemory(self.path, _shared_size, _shared_slabs)
+        old.save('old tile', self.layer, Coordinate(1, 2, 3), 'PNG')
 
+        new = SharedMemory(self.path, _shared_size * 2, _shared_slabs)
 
+        self.assertEqual(new.read(self.layer, Coordinate(1, 2, 3), 'PNG'), None)
+        self.assertEqual(old.read(self.layer, Coordinate(1, 2, 3), 'PNG'), 'old tile')
@@ -0,0 +1,53 @@
+'''
+Stand-in for the rendering functions of TileStache.Mapnik, so that render
+workers can be tested without Mapnik. The "mapfile" is a scratch directory,
+and the first number of each bbox tells a worker how to behave:
+
+    0: render normally,
+    1: die the first time, render in the worker that comes after,
+    2: hang until killed,
+    3: raise an exception.
+
+Images are filled with the second number of the bbox, and grids are just the
+process ID of the worker that rendered them.
+'''
+import os
+
+from time import sleep
+from os.path import join, exists
+
+class FakeImage:
+
+    def __init__(self, data):
+        self.data = data
+
+    def tostring(self):
+        return self.data
+
+def register_fonts(dirpath):
+    pass
+
+def get_mapnikMap(mapfile):
+    return mapfile
+
+def _behave(dirpath, bbox):
+    if bbox[0] == 1:
+        flag = join(dirpath, 'died')
+
+        if not exists(flag):
+            open(flag, 'w').close()
+            os._exit(1)
+
+    elif bbox[0] == 2:
+        sleep(60)
+
+    elif bbox[0] == 3:
+        raise ValueError('Bad bbox')
+
+def render_image(mmap, width, height, bbox):
+    _behave(mmap, bbox)
+    return FakeImage(chr(int(bbox[1])) * (width * height * 4))
+
+def render_grid(mmap, width, height, bbox, layers, scale, layer_id_key=None):
+    _behave(mmap, bbox)
+    return dict(pid=os.getpid())
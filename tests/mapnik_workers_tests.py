@@ -0,0 +1,141 @@
+import os
+import gc
+
+from unittest import TestCase
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import join as pathjoin
+
+from TileStache.MapnikWorkers import RenderFarm, RenderError, getFarm, _SharedMemory
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    else:
+        return True
+
+class MapnikWorkersTests(TestCase):
+    '''Tests render workers with a stand-in for Mapnik, see mapnik_stub.py'''
+
+    def setUp(self):
+        self.dirpath = mkdtemp(prefix='tilestache-test-')
+        self.farms = []
+
+    def tearDown(self):
+        for farm in self.farms:
+            farm.close()
+
+        rmtree(self.dirpath)
+
+    def options(self, kind):
+        return dict(kind=kind, mapfile=self.dirpath, fonts=None, module='tests.mapnik_stub',
+                    layers=[[0, None]], scale=4, layer_id_key=None)
+
+    def farm(self, kind, size=1, timeout=300):
+        farm = RenderFarm(self.options(kind), size, timeout)
+        self.farms.append(farm)
+
+        return farm
+
+    def test_shared_memory_grow(self):
+        '''Grow the shared memory on write, and map it again on read'''
+
+        path = pathjoin(self.dirpath, 'shm')
+        writer, reader = _SharedMemory(path, 16), _SharedMemory(path)
+
+        writer.write('a' * 8)
+        self.assertEqual(reader.read(8), 'a' * 8)
+
+        writer.write('b' * 1000)
+        self.assertEqual(writer.size, 1000)
+        self.assertEqual(reader.read(1000), 'b' * 1000)
+        self.assertEqual(reader.size, 1000)
+
+        writer.close()
+        reader.close()
+
+    def test_render_image(self):
+        '''Bring back images larger than the first shared memory'''
+
+        farm = self.farm('image')
+
+        self.assertEqual(farm.render(dict(width=8, height=8, bbox=(0, 65, 0, 0))), 'A' * 256)
+        self.assertEqual(farm.render(dict(width=600, height=600, bbox=(0, 66, 0, 0))), 'B' * 1440000)
+        self.assertEqual(farm.render(dict(width=8, height=8, bbox=(0, 67, 0, 0))), 'C' * 256)
+
+    def test_render_error(self):
+        '''Pass on errors from a worker, and keep the worker'''
+
+        farm = self.farm('grid')
+        pid = farm.render(dict(width=8, height=8, bbox=(0, 0, 0, 0)))['pid']
+
+        self.assertRaises(RenderError, farm.render, dict(width=8, height=8, bbox=(3, 0, 0, 0)))
+        self.assertEqual(farm.render(dict(width=8, height=8, bbox=(0, 0, 0, 0)))['pid'], pid)
+
+    def test_worker_died(self):
+        '''Start a worker again when it dies, and try its request once more'''
+
+        farm = self.farm('grid')
+        pid = farm.render(dict(width=8, height=8, bbox=(0, 0, 0, 0)))['pid']
+
+        again = farm.render(dict(width=8, height=8, bbox=(1, 0, 0, 0)))['pid']
+
+        self.assertNotEqual(again, pid)
+        self.assertFalse(_alive(pid), 'Dead worker was not cleaned up')
+
+    def test_worker_timeout(self):
+        '''Kill a worker that takes too long, and start a fresh one after'''
+
+        farm = self.farm('grid', timeout=1)
+        pid = farm.render(dict(width=8, height=8, bbox=(0, 0, 0, 0)))['pid']
+
+        self.assertRaises(RenderError, farm.render, dict(width=8, height=8, bbox=(2, 0, 0, 0)))
+        self.assertFalse(_alive(pid), 'Slow worker was not killed')
+
+        again = farm.render(dict(width=8, height=8, bbox=(0, 0, 0, 0)))['pid']
+        self.assertNotEqual(again, pid)
+
+    def test_workers_after_fork(self):
+        '''Start fresh workers in a forked process, leaving the parent's alone'''
+
+        farm = self.farm('grid')
+        pid = farm.render(dict(width=8, height=8, bbox=(0, 0, 0, 0)))['pid']
+
+        read, write = os.pipe()
+        child = os.fork()
+
+        if child == 0:
+            # in the child, report a worker pid and leave without cleaning up after the parent.
+            try:
+                os.close(read)
+                os.write(write, str(farm.render(dict(width=8, height=8, bbox=(0, 0, 0, 0)))['pid']))
+                farm.close()
+            finally:
+                os._exit(0)
+
+        os.close(write)
+        reader = os.fdopen(read)
+        child_pid = reader.read()
+        reader.close()
+        os.waitpid(child, 0)
+
+        self.assertTrue(child_pid.isdigit(), 'Child process failed to render')
+        self.assertNotEqual(int(child_pid), pid)
+        self.assertEqual(farm.render(dict(width=8, height=8, bbox=(0, 0, 0, 0)))['pid'], pid)
+
+    def test_farm_shared(self):
+        '''Share a farm between providers, and stop its workers once they're gone'''
+
+        farm = getFarm(self.options('grid'), 1)
+
+        self.assertTrue(getFarm(self.options('grid'), 1) is farm)
+        self.assertFalse(getFarm(self.options('grid'), 2) is farm)
+
+        pid = farm.render(dict(width=8, height=8, bbox=(0, 0, 0, 0)))['pid']
+
+        del farm
+        gc.collect()
+
+        self.assertFalse(_alive(pid), 'Unused farm kept its workers')
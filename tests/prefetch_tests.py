@@ -0,0 +1,113 @@
+from unittest import TestCase
+from time import time, sleep
+from Queue import Queue
+
+from ModestMaps.Core import Coordinate
+from TileStache import Prefetch, getTile
+from . import utils
+
+class ColumnBounds:
+    '''Stand-in for layer bounds, excluding tiles right of a column'''
+
+    def __init__(self, column):
+        self.column = column
+
+    def excludes(self, coord):
+        return coord.column > self.column
+
+class PrefetchTests(TestCase):
+    '''Tests prefetch planning, queueing, and counting'''
+
+    def setUp(self):
+        self.queue, self.worker = Prefetch._queue, list(Prefetch._worker)
+
+        with Prefetch._lock:
+            Prefetch._queued.clear()
+            Prefetch._prefetched.clear()
+
+            for key in Prefetch._stats:
+                Prefetch._stats[key] = 0
+
+    def tearDown(self):
+        Prefetch._queue = self.queue
+        Prefetch._worker[:] = self.worker
+
+    def hold(self, size):
+        '''Queue work in a fresh queue of a given size, with no worker to take it'''
+
+        Prefetch._queue = Queue(size)
+        Prefetch._worker[:] = ['held']
+
+    def coords(self, layer, coord):
+        return sorted([(c.zoom, c.column, c.row) for c in Prefetch._jobCoords(layer, coord)])
+
+    def test_prefetch_edges(self):
+        '''Plan only metatiles inside the world'''
+
+        layer = utils.solid_layer(metatile={'rows': 2, 'columns': 2}, prefetch={'neighbors': 1, 'children': True})
+
+        self.assertEqual(self.coords(layer, Coordinate(1, 1, 2)), [(2, 0, 2), (2, 2, 0), (2, 2, 2),
+                                                                  (3, 0, 0), (3, 0, 2), (3, 2, 0), (3, 2, 2)])
+
+        self.assertEqual(self.coords(layer, Coordinate(0, 0, 0)), [(1, 0, 0)])
+
+    def test_prefetch_bounds(self):
+        '''Plan only metatiles with some part inside the layer bounds'''
+
+        layer = utils.solid_layer(metatile={'rows': 2, 'columns': 2}, prefetch={'neighbors': 1})
+        layer.bounds = ColumnBounds(2)
+
+        self.assertEqual(self.coords(layer, Coordinate(2, 2, 3)), [(3, 0, 0), (3, 0, 2), (3, 0, 4),
+                                                                  (3, 2, 0), (3, 2, 4)])
+
+    def test_prefetch_dedup(self):
+        '''Queue each metatile just once while it waits'''
+
+        layer = utils.solid_layer(prefetch={'neighbors': 1})
+        self.hold(100)
+
+        Prefetch.afterMiss(layer, Coordinate(1, 1, 2), 'png')
+        Prefetch.afterMiss(layer, Coordinate(1, 1, 2), 'png')
+        Prefetch.afterMiss(layer, Coordinate(1, 2, 2), 'png')
+
+        self.assertEqual(Prefetch.stats()['queued'], 12)
+        self.assertEqual(Prefetch._queue.qsize(), 12)
+
+    def test_prefetch_full(self):
+        '''Drop new work when the queue is full'''
+
+        layer = utils.solid_layer(prefetch={'neighbors': 1})
+        self.hold(3)
+
+        Prefetch.afterMiss(layer, Coordinate(1, 1, 2), 'png')
+
+        stats = Prefetch.stats()
+        self.assertEqual((stats['queued'], stats['dropped']), (3, 5))
+
+    def test_prefetch_work(self):
+        '''Skip tiles already cached, render others, and count them when served'''
+
+        layer = utils.solid_layer(prefetch={'neighbors': 1})
+        layer.config.cache.save('tile', layer, Coordinate(1, 1, 1), 'PNG')
+
+        getTile(layer, Coordinate(0, 0, 1), 'png', 1)
+
+        due = time() + 5
+
+        while time() < due:
+            stats = Prefetch.stats()
+
+            if stats['skipped'] + stats['rendered'] == 3:
+                break
+
+            sleep(.05)
+
+        self.assertEqual((stats['queued'], stats['skipped'], stats['rendered']), (3, 1, 2))
+        self.assertEqual(sorted(layer.provider.renders), [(1, 0, 0, 1), (1, 0, 1, 1), (1, 1, 0, 1)])
+
+        getTile(layer, Coordinate(0, 1, 1), 'png', 1)
+        getTile(layer, Coordinate(1, 1, 1), 'png', 1)
+        getTile(layer, Coordinate(0, 1, 1), 'png', 1)
+
+        self.assertEqual(Prefetch.stats()['served'], 1)
+        self.assertEqual(len(layer.provider.renders), 3)
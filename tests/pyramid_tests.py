@@ -0,0 +1,102 @@
+from unittest import TestCase
+from StringIO import StringIO
+
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
+from ModestMaps.Core import Coordinate
+from TileStache import Pyramid, getTile
+from . import utils
+
+RED, GREEN, BLUE, WHITE = (0xFF, 0, 0, 0xFF), (0, 0xFF, 0, 0xFF), (0, 0, 0xFF, 0xFF), (0xFF, 0xFF, 0xFF, 0xFF)
+
+def png(color):
+    '''Encode a solid tile of one color'''
+
+    buff = StringIO()
+    Image.new('RGBA', (256, 256), color).save(buff, 'PNG')
+    return buff.getvalue()
+
+class ColumnBounds:
+    '''Stand-in for layer bounds, excluding tiles right of a column'''
+
+    def __init__(self, column):
+        self.column = column
+
+    def excludes(self, coord):
+        return coord.column > self.column
+
+class PyramidTests(TestCase):
+    '''Tests building low zoom tiles from their children'''
+
+    def test_children(self):
+        '''List children in reading order'''
+
+        self.assertEqual([(c.zoom, c.column, c.row) for c in Pyramid.children(Coordinate(1, 2, 3))],
+                         [(4, 4, 2), (4, 5, 2), (4, 4, 3), (4, 5, 3)])
+
+    def test_downsample_mosaic(self):
+        '''Shrink four cached children into place, without rendering'''
+
+        layer = utils.solid_layer(downsample={'zoom': 1})
+        colors = [RED, GREEN, BLUE, WHITE]
+
+        for (child, color) in zip(Pyramid.children(Coordinate(0, 0, 0)), colors):
+            layer.config.cache.save(png(color), layer, child, 'PNG')
+
+        tile = layer.render(Coordinate(0, 0, 0), 'PNG')
+
+        self.assertEqual(tile.size, (256, 256))
+        self.assertEqual([tile.getpixel(xy) for xy in [(64, 64), (192, 64), (64, 192), (192, 192)]], colors)
+        self.assertEqual(layer.provider.renders, [])
+
+    def test_downsample_missing(self):
+        '''Leave missing children transparent'''
+
+        layer = utils.solid_layer(downsample={'zoom': 1})
+        layer.bounds = ColumnBounds(0)
+
+        tile = layer.render(Coordinate(0, 0, 0), 'PNG')
+
+        self.assertEqual([tile.getpixel(xy) for xy in [(64, 64), (192, 64), (64, 192), (192, 192)]],
+                         [RED, (0, 0, 0, 0), RED, (0, 0, 0, 0)])
+        self.assertEqual(sorted(layer.provider.renders), [(1, 0, 0, 1), (1, 0, 1, 1)])
+
+    def test_downsample_deep(self):
+        '''Render only at the downsample zoom, caching every level above it'''
+
+        layer = utils.solid_layer(downsample={'zoom': 2})
+        mimetype, body = getTile(layer, Coordinate(0, 0, 0), 'png', 1)
+
+        self.assertEqual(Image.open(StringIO(body)).convert('RGBA').getpixel((128, 128)), RED)
+        self.assertEqual(sorted(set([render[0] for render in layer.provider.renders])), [2])
+        self.assertEqual(len(layer.provider.renders), 16)
+
+        for child in Pyramid.children(Coordinate(0, 0, 0)):
+            self.assertNotEqual(layer.config.cache.read(layer, child, 'PNG'), None)
+
+    def test_downsample_bottom_up(self):
+        '''Seed the deepest zoom first, as tilestache-seed.py --downsample does'''
+
+        layer = utils.solid_layer(downsample={'zoom': 1})
+
+        for zoom in (1, 0):
+            for row in range(2**zoom):
+                for column in range(2**zoom):
+                    getTile(layer, Coordinate(row, column, zoom), 'png', 1)
+
+        self.assertEqual(len(layer.provider.renders), 4)
+        self.assertEqual(sorted(set([render[0] for render in layer.provider.renders])), [1])
+
+    def test_downsample_formats(self):
+        '''Render tiles at other scales, and drop alpha for JPEG'''
+
+        layer = utils.solid_layer(downsample={'zoom': 1})
+
+        tile = layer.render(Coordinate(0, 0, 0), 'PNG', 2)
+        self.assertEqual(layer.provider.renders, [(0, 0, 0, 2)])
+
+        tile = layer.render(Coordinate(0, 0, 0), 'JPEG')
+        self.assertEqual(tile.mode, 'RGB')
@@ -0,0 +1,294 @@
+from unittest import TestCase
+from time import sleep
+from tempfile import mkdtemp
+from shutil import rmtree
+from os.path import join as pathjoin
+from threading import activeCount
+
+from ModestMaps.Core import Coordinate
+from . import utils
+from TileStache.Core import Metatile, KnownUnknown
+from TileStache.Journal import Journal
+from TileStache.Seeding import Seeder, metatileCoordinates, tileAreas, _worker
+from TileStache.Caches import Memory
+from TileStache.SeedQueue import SQLiteQueue, Claims, enqueue
+from TileStache.Expiry import readExpiry, expiredMetatiles, expiredCoordinates
+
+class JournalTests(TestCase):
+    '''Tests the completion journal of resumable seeding'''
+
+    def setUp(self):
+        self.dirpath = mkdtemp(prefix='tilestache-test-')
+        self.path = pathjoin(self.dirpath, 'journal')
+        self.metatile = Metatile(rows=2, columns=2)
+
+        # tiles 0-7 in both directions at zoom 3, 16 metatiles of 2x2.
+        self.areas = [(3, 0, 0, 7, 7)]
+
+    def tearDown(self):
+        rmtree(self.dirpath)
+
+    def test_journal_round_trip(self):
+        '''Mark a metatile done when all its expected tiles are, and keep it'''
+
+        journal = Journal(self.path, self.metatile, self.areas)
+        journal.expect(3, 1, 1, 4)
+
+        for (row, column) in [(2, 2), (2, 3), (3, 2)]:
+            journal.tileDone(Coordinate(row, column, 3))
+
+        self.assertFalse(journal.isDone(3, 1, 1))
+
+        journal.tileDone(Coordinate(3, 3, 3))
+        self.assertTrue(journal.isDone(3, 1, 1))
+
+        journal.expect(3, 2, 2, 2)
+        journal.tileDone(Coordinate(4, 4, 3))
+        journal.tileFailed(Coordinate(4, 5, 3))
+        journal.tileDone(Coordinate(5, 4, 3))
+        self.assertFalse(journal.isDone(3, 2, 2), 'Metatile with a failed tile was marked done')
+
+        journal.expect(3, 3, 3, 0)
+        journal.close()
+
+        journal = Journal(self.path, self.metatile, self.areas, resume=True)
+        self.assertEqual([journal.isDone(3, x, y) for (x, y) in [(1, 1), (2, 2), (3, 3), (0, 0)]], [True, False, True, False])
+        journal.close()
+
+        journal = Journal(self.path, self.metatile, self.areas)
+        self.assertFalse(journal.isDone(3, 1, 1), 'Journal without resume kept old work')
+        journal.close()
+
+    def test_journal_mismatch(self):
+        '''Refuse to resume a journal made for another area or metatile size'''
+
+        Journal(self.path, self.metatile, self.areas).close()
+
+        self.assertRaises(KnownUnknown, Journal, self.path, self.metatile, [(3, 0, 0, 7, 6)], resume=True)
+        self.assertRaises(KnownUnknown, Journal, self.path, Metatile(rows=4, columns=4), self.areas, resume=True)
+
+    def test_journal_resume(self):
+        '''Skip metatiles finished before, still counting them in offsets'''
+
+        ul, lr = Coordinate(1, 1, 3), Coordinate(6, 6, 3)
+        areas = tileAreas(ul, lr, [3, 4], 0)
+
+        journal = Journal(self.path, self.metatile, areas)
+        first = list(metatileCoordinates(ul, lr, [3, 4], 0, self.metatile, journal))
+        done = first[:len(first) // 2]
+
+        for (offset, count, coord) in done:
+            journal.tileDone(coord)
+
+        journal.close()
+
+        journal = Journal(self.path, self.metatile, areas, resume=True)
+        rest = list(metatileCoordinates(ul, lr, [3, 4], 0, self.metatile, journal))
+        journal.close()
+
+        tiles = lambda coordinates: set([(c.zoom, c.row, c.column) for (o, n, c) in coordinates])
+
+        self.assertTrue(len(rest) < len(first))
+        self.assertEqual(tiles(rest) | tiles(done), tiles(first))
+        self.assertEqual(rest[0][1], first[0][1])
+
+        # tiles of unfinished metatiles keep their original offsets.
+        offsets = dict([((c.zoom, c.row, c.column), o) for (o, n, c) in first])
+        self.assertEqual([o for (o, n, c) in rest], [offsets[(c.zoom, c.row, c.column)] for (o, n, c) in rest])
+
+
+class FlushedMemory (Memory):
+    '''Memory cache that counts its flushes, and maybe fails them'''
+
+    def __init__(self, fail=False):
+        Memory.__init__(self)
+        self.fail = fail
+        self.flushes = 0
+
+    def flush(self):
+        self.flushes += 1
+
+        if self.fail:
+            raise IOError('Lost some tiles')
+
+class SeederTests(TestCase):
+    '''Tests seeding in this process'''
+
+    def seeder(self, cache):
+        layer = utils.solid_layer()
+        layer.config.cache = cache
+
+        return Seeder(None, None, 'solid', 'png', threads=2, layer=layer)
+
+    def test_seed_flush(self):
+        '''Flush the cache when done, and leave no threads behind'''
+
+        cache = FlushedMemory()
+        seeder = self.seeder(cache)
+        coordinates = [(offset, 4, Coordinate(row, column, 1)) for (offset, (row, column)) in enumerate([(0, 0), (0, 1), (1, 0), (1, 1)])]
+
+        results = list(seeder.seed(coordinates))
+        threads = activeCount()
+
+        self.assertEqual([result['error'] for result in results], [None] * 4)
+        self.assertEqual(cache.flushes, 1)
+        self.assertEqual(_worker['pool'], None)
+
+        for attempt in range(3):
+            list(seeder.seed(coordinates))
+
+        self.assertEqual(cache.flushes, 4)
+        self.assertEqual(activeCount(), threads, 'Seeding again left threads behind')
+
+    def test_seed_flush_failed(self):
+        '''Raise an error from flushing the cache'''
+
+        seeder = self.seeder(FlushedMemory(fail=True))
+        self.assertRaises(IOError, list, seeder.seed([(0, 1, Coordinate(0, 0, 0))]))
+
+
+class FlakyQueue:
+    '''Stand-in queue whose first lease renewal fails'''
+
+    lease = .06
+
+    def __init__(self):
+        self.renewals = 0
+
+    def renew(self, layer_name, worker, jobs):
+        self.renewals += 1
+
+        if self.renewals == 1:
+            raise IOError('Queue is unreachable')
+
+class SeedQueueTests(TestCase):
+    '''Tests claims, leases and attempts of the SQLite seeding queue'''
+
+    def setUp(self):
+        self.dirpath = mkdtemp(prefix='tilestache-test-')
+        self.path = pathjoin(self.dirpath, 'queue.db')
+
+    def tearDown(self):
+        rmtree(self.dirpath)
+
+    def test_queue_claim(self):
+        '''Group tiles into metatile jobs, and never claim one job twice'''
+
+        queue = SQLiteQueue(self.path)
+        corners = [(0, 0), (0, 2), (2, 0), (2, 2)]
+        tiles = [(0, 0, Coordinate(row + r, column + c, 2)) for (row, column) in corners for r in (0, 1) for c in (0, 1)]
+
+        self.assertEqual(enqueue(queue, 'osm', tiles, Metatile(rows=2, columns=2)), 4)
+
+        first, second = queue.claim('osm', 'one', 3), queue.claim('osm', 'two', 3)
+        self.assertEqual((len(first), len(second)), (3, 1))
+        self.assertEqual(len(set([job.id for job in first + second])), 4)
+        self.assertEqual(queue.claim('osm', 'three', 3), [])
+
+        for job in first:
+            queue.complete('osm', 'one', job)
+
+        status = queue.status('osm')
+        self.assertEqual((status['done'], status['leased']), ((3, 12), (1, 4)))
+        self.assertEqual(queue.remaining('osm'), 4)
+
+    def test_queue_expiry(self):
+        '''Claim a job again once its lease has run out'''
+
+        queue = SQLiteQueue(self.path, lease=.1)
+        queue.add('osm', [(2, [(0, 0)])])
+
+        job = queue.claim('osm', 'dead', 1)[0]
+        self.assertEqual(queue.claim('osm', 'alive', 1), [])
+
+        sleep(.2)
+
+        again = queue.claim('osm', 'alive', 1)
+        self.assertEqual([(j.id, j.attempts) for j in again], [(job.id, 2)])
+
+    def test_queue_attempts(self):
+        '''Put failed jobs back, give up after the last attempt, and release for free'''
+
+        queue = SQLiteQueue(self.path, attempts=2)
+        queue.add('osm', [(2, [(0, 0)])])
+
+        queue.fail('osm', 'one', queue.claim('osm', 'one', 1)[0], 'Oops')
+        job = queue.claim('osm', 'one', 1)[0]
+        self.assertEqual(job.attempts, 2)
+
+        queue.release('osm', 'one', [job])
+        job = queue.claim('osm', 'one', 1)[0]
+        self.assertEqual(job.attempts, 2, 'Released job counted an attempt')
+
+        queue.fail('osm', 'one', job, 'Oops again')
+        self.assertEqual(queue.claim('osm', 'one', 1), [])
+        self.assertEqual(queue.status('osm')['failed'], (1, 1))
+
+    def test_claims_heartbeat(self):
+        '''Keep renewing leases after a renewal fails'''
+
+        queue = FlakyQueue()
+        claims = Claims(queue, 'osm', 'one')
+
+        sleep(.2)
+        claims._closed.set()
+
+        self.assertTrue(queue.renewals >= 2, 'Heartbeat stopped after a failed renewal')
+
+class ExpiryTests(TestCase):
+    '''Tests reading and propagating expired tile lists'''
+
+    def setUp(self):
+        self.dirpath = mkdtemp(prefix='tilestache-test-')
+
+    def tearDown(self):
+        rmtree(self.dirpath)
+
+    def test_expiry_read(self):
+        '''Skip malformed lines one by one, keeping the rest of the file'''
+
+        filename = pathjoin(self.dirpath, 'expire.list')
+        open(filename, 'w').write('14/8190/5447\n\n14/8190\nbad line\n2/4/0\n14/8191/5447\n')
+
+        self.assertEqual(list(readExpiry(filename)), [(14, 8190, 5447), (14, 8191, 5447)])
+
+    def test_expiry_propagation(self):
+        '''Dirty one metatile at each zoom, parents and children alike'''
+
+        metatiles = expiredMetatiles([(14, 8190, 5447)], Metatile(rows=4, columns=4), 12, 16)
+
+        self.assertEqual(sorted(metatiles), [(12, 511, 340), (13, 1023, 680), (14, 2047, 1361),
+                                             (15, 4095, 2723), (16, 8190, 5447)])
+
+        # without a range, tiles stay at their own zoom.
+        self.assertEqual(expiredMetatiles([(14, 8190, 5447)], Metatile(rows=4, columns=4)), set([(14, 2047, 1361)]))
+
+    def test_expiry_children(self):
+        '''Find every metatile covered by the children of a tile'''
+
+        metatiles = expiredMetatiles([(1, 1, 0)], Metatile(rows=2, columns=2), 1, 3)
+        self.assertEqual(sorted(metatiles), [(1, 0, 0), (2, 1, 0), (3, 2, 0), (3, 2, 1), (3, 3, 0), (3, 3, 1)])
+
+    def test_expiry_dedup(self):
+        '''Deal with each metatile only once, however many tiles dirty it'''
+
+        tiles = [(14, 8188 + x, 5444 + y) for x in range(4) for y in range(4)] * 2
+        metatile = Metatile(rows=4, columns=4)
+        metatiles = expiredMetatiles(tiles, metatile, 13, 14)
+
+        self.assertEqual(sorted(metatiles), [(13, 1023, 680), (14, 2047, 1361)])
+
+        coordinates = list(expiredCoordinates(metatiles, metatile))
+        keys = [(c.zoom, c.row, c.column) for (o, n, c) in coordinates]
+
+        self.assertEqual(len(keys), 32)
+        self.assertEqual(len(set(keys)), 32)
+        self.assertEqual([o for (o, n, c) in coordinates], range(32))
+        self.assertEqual(set([n for (o, n, c) in coordinates]), set([32]))
+
+    def test_expiry_world_edge(self):
+        '''Keep metatile tiles inside the world at low zooms'''
+
+        coordinates = list(expiredCoordinates(set([(1, 0, 0)]), Metatile(rows=4, columns=4)))
+        self.assertEqual(sorted([(c.row, c.column) for (o, n, c) in coordinates]), [(0, 0), (0, 1), (1, 0), (1, 1)])
+
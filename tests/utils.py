@@ -13,9 +13,16 @@ except ImportError:
     from queue import Queue, Empty  # python 3.x
 
 
+try:
+    from PIL import Image
+except ImportError:
+    import Image
+
 from ModestMaps.Core import Coordinate
 from TileStache import getTile, parseConfigfile
 from TileStache.Core import KnownUnknown
+from TileStache.Config import buildConfiguration
+from TileStache.Generations import cache_name
 
 def request(config_file_content, layer_name, format, row, column, zoom):
     '''
@@ -33,6 +40,47 @@ def request(config_file_content, layer_name, format, row, column, zoom):
 
     return tile_mimetype, tile_content
 
+class FakeLayer:
+    '''
+    Minimal stand-in for TileStache.Core.Layer, enough for
+    caches that only need a name, a generation and a few lifespan settings
+    '''
+    def __init__(self, name, cache_lifespan=None, stale_lock_timeout=15, generation=0):
+        self._name = name
+        self.cache_lifespan = cache_lifespan
+        self.stale_lock_timeout = stale_lock_timeout
+        self.generation = generation
+
+    def name(self):
+        return self._name
+
+    def cacheName(self):
+        return cache_name(self._name, self.generation)
+
+class SolidProvider:
+    '''
+    Provider of solid-colour tiles that remembers what it rendered,
+    for layers built with buildConfiguration() in tests
+    '''
+    def __init__(self, layer, color=(0xFF, 0x00, 0x00, 0xFF)):
+        self.layer = layer
+        self.color = tuple(color)
+        self.renders = []
+
+    def renderTile(self, width, height, srs, coord, tile_scale=1):
+        self.renders.append((coord.zoom, coord.column, coord.row, tile_scale))
+        return Image.new('RGBA', (width, height), self.color)
+
+def solid_layer(**layer_dict):
+    '''
+    Helper method to build a layer of SolidProvider tiles in a Memory cache,
+    with optional extra layer configuration
+    '''
+    layer_dict['provider'] = layer_dict.get('provider', {'class': 'tests.utils:SolidProvider'})
+    config = buildConfiguration({'cache': {'name': 'Memory'}, 'layers': {'solid': layer_dict}})
+
+    return config.layers['solid']
+
 def create_temp_file(buffer):
     '''
     Helper method to create temp file on disk. Caller is responsible